@@ -0,0 +1,368 @@
+import os
+import sqlite3
+from datetime import date, datetime, timedelta
+from typing import Any, List, Literal, Optional, Union
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from table_store import NULL_PARTITION, PartitionedTable
+from utils import *
+
+
+class MessageAggregates:
+    """
+    Materialized counts of the message table, per time bucket, page and value.
+
+    Counts are kept in a SQLite database for two grains: per day and per week
+    (buckets start on Mondays). Every bucket counts the messages of each page, and
+    their users and purposes (the `dimensions`), so a run only adds the counts of its
+    new rows and time series are read without scanning the message table.
+
+    Daily counts follow the retention of the message table, while weekly counts are
+    kept as long-term history. The hash and day of every counted row are kept too, so
+    counts can be reconciled with a table they were not written atomically with.
+
+    Attributes:
+        path (str): The path of the database file.
+        dimensions (List[str]): The list columns counted.
+        _conn (sqlite3.Connection): The connection to the database.
+    """
+
+    def __init__(self, path: str, dimensions: List[str] = ("user", "purpose")):
+        self.path = path
+        self.dimensions = list(dimensions)
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS rollups (
+                grain TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                page_id TEXT NOT NULL,
+                dimension TEXT NOT NULL,
+                value TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (grain, dimension, bucket, page_id, value)
+            ) WITHOUT ROWID
+            """)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+
+        # counts of earlier versions do not know their rows, they are rebuilt
+        if not self._conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'counted'"
+        ).fetchone():
+            self._conn.execute("DELETE FROM meta WHERE key = 'initialized'")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS counted (
+                row_hash INTEGER PRIMARY KEY,
+                day TEXT
+            ) WITHOUT ROWID
+            """)
+
+        # the flat per-day counts of earlier versions are rebuilt as rollups
+        if self._conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'counts'"
+        ).fetchone():
+            self._conn.execute("DROP TABLE counts")
+            self._conn.execute("DELETE FROM meta WHERE key = 'initialized'")
+
+    def __enter__(self) -> "MessageAggregates":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    @property
+    def initialized(self) -> bool:
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'initialized'"
+        ).fetchone()
+        return row is not None
+
+    def _deltas(self, df: DataFrame, time_col: str) -> List[tuple]:
+        if df.empty:
+            return []
+
+        # the buckets of every row, in the timezone of the table
+        days = df[time_col].dt.normalize()
+        buckets = {
+            "day": days.dt.strftime("%Y-%m-%d"),
+            "week": (days - pd.to_timedelta(days.dt.weekday, unit="D")).dt.strftime(
+                "%Y-%m-%d"
+            ),
+        }
+        page_ids = (
+            df["page_id"].fillna("").astype(str)
+            if "page_id" in df.columns
+            else Series("", index=df.index)
+        )
+
+        deltas = []
+        for grain, bucket in buckets.items():
+            # the messages themselves
+            keys = DataFrame({"bucket": bucket, "page_id": page_ids, "value": ""})
+            counts = keys.value_counts(["bucket", "page_id", "value"])
+            deltas += [
+                (grain, b, p, "message", v, int(c)) for (b, p, v), c in counts.items()
+            ]
+
+            for dimension in self.dimensions:
+                keys = DataFrame(
+                    {"bucket": bucket, "page_id": page_ids, "value": df[dimension]}
+                ).explode("value")
+                keys = keys[keys["value"].notna() & (keys["value"] != "")]
+                counts = keys.value_counts(["bucket", "page_id", "value"])
+                deltas += [
+                    (grain, b, p, dimension, str(v), int(c))
+                    for (b, p, v), c in counts.items()
+                ]
+
+        return deltas
+
+    def _counted(
+        self, df: DataFrame, time_col: str, row_hashes: Optional[Series]
+    ) -> List[tuple]:
+        if df.empty:
+            return []
+
+        if row_hashes is None:
+            row_hashes = hash_dataframe_rows(df)
+
+        # SQLite integers are signed
+        signed_hashes = row_hashes.to_numpy(dtype="uint64").view("int64").tolist()
+        days = df[time_col].dt.strftime("%Y-%m-%d").astype(object)
+        return list(zip(signed_hashes, days.where(days.notna(), None)))
+
+    def num_counted(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM counted").fetchone()[0]
+
+    def counted_rows(self) -> DataFrame:
+        """
+        Read the hash and day of every counted row.
+
+        Returns:
+            DataFrame: The uint64 `row_hash` and the `day` (None for rows without a time)
+                columns.
+        """
+        rows = self._conn.execute("SELECT row_hash, day FROM counted").fetchall()
+        row_hashes = np.array([r[0] for r in rows], dtype="int64").view("uint64")
+        return DataFrame({"row_hash": row_hashes, "day": [r[1] for r in rows]})
+
+    def add(
+        self,
+        df: DataFrame,
+        time_col: str = "inserted_at",
+        row_hashes: Optional[Series] = None,
+    ) -> None:
+        """
+        Add the counts of new message rows.
+
+        Args:
+            df (DataFrame): The new rows.
+            time_col (str): The datetime column of the rows. Defaults to "inserted_at".
+            row_hashes (Optional[Series]): The hashes of the rows, computed by default.
+        """
+        deltas = self._deltas(df, time_col)
+        counted = self._counted(df, time_col, row_hashes)
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO counted (row_hash, day) VALUES (?, ?)", counted
+            )
+            self._conn.executemany(
+                """
+                INSERT INTO rollups (grain, bucket, page_id, dimension, value, count)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (grain, dimension, bucket, page_id, value) DO UPDATE
+                SET count = count + excluded.count
+                """,
+                deltas,
+            )
+
+    def rebuild(
+        self,
+        df: DataFrame,
+        time_col: str = "inserted_at",
+        row_hashes: Optional[Series] = None,
+    ) -> None:
+        """
+        Recount every message row, e.g. to initialize the counts from a table.
+
+        Weekly counts older than the rows are lost.
+        """
+        deltas = self._deltas(df, time_col)
+        counted = self._counted(df, time_col, row_hashes)
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM rollups")
+            self._conn.execute("DELETE FROM counted")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO counted (row_hash, day) VALUES (?, ?)", counted
+            )
+            self._conn.executemany(
+                """
+                INSERT INTO rollups (grain, bucket, page_id, dimension, value, count)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                deltas,
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('initialized', ?)",
+                (datetime.now().isoformat(),),
+            )
+
+    def reconcile(self, table: PartitionedTable) -> None:
+        """
+        Make the counts match the rows of a table, after a run stopped between writing
+        the table and the counts.
+
+        Uncounted rows of the table are added, and the days removed from the table but
+        not from the counts are dropped. Any other counted row missing from the table
+        cannot be uncounted, so the counts are rebuilt.
+
+        The row hashes are only compared when the number of counted rows differs from
+        the number of rows of the table, which both interrupted writes leave behind.
+        """
+        if self.num_counted() == len(table):
+            return
+
+        counted = self.counted_rows()
+        stored_hashes = table.row_hashes()
+        extra = counted[~counted["row_hash"].isin(stored_hashes)]
+
+        # rows of the days removed from the table but still counted
+        days = [day for day in table.partitions() if day != NULL_PARTITION]
+        if (
+            not extra.empty
+            and extra["day"].notna().all()
+            and (not days or extra["day"].max() < days[0])
+        ):
+            last_day = datetime.strptime(extra["day"].max(), "%Y-%m-%d")
+            self.drop_before(last_day + timedelta(days=1))
+            extra = extra.iloc[0:0]
+
+        if not extra.empty:
+            print(
+                f"UserWarning: {len(extra)} counted rows are not in the table, "
+                "rebuilding the aggregates"
+            )
+            self.rebuild(table.load(), row_hashes=stored_hashes)
+        elif (missing := ~stored_hashes.isin(counted["row_hash"])).any():
+            # the hashes are read in the order of the rows
+            print(f"Counting {missing.sum()} uncounted rows of the table")
+            self.add(table.load()[missing.values], row_hashes=stored_hashes[missing])
+
+    def drop_before(self, bound: Union[date, datetime]) -> int:
+        """
+        Remove the daily counts of the days before `bound`.
+
+        Returns:
+            int: The number of removed counts.
+        """
+        bound = bound.date() if isinstance(bound, datetime) else bound
+        with self._conn:
+            self._conn.execute("BEGIN")
+            cursor = self._conn.execute(
+                "DELETE FROM rollups WHERE grain = 'day' AND bucket < ?", (str(bound),)
+            )
+            self._conn.execute("DELETE FROM counted WHERE day < ?", (str(bound),))
+
+        return cursor.rowcount
+
+    def counts(self, dimension: str) -> DataFrame:
+        """
+        Count the values of a dimension over the retained days, from the most to the
+        least frequent one.
+
+        Returns:
+            DataFrame: The `dimension` and `count` columns, like `quantify_data`.
+        """
+        rows = self._conn.execute(
+            """
+            SELECT value, SUM(count) AS total FROM rollups
+            WHERE grain = 'day' AND dimension = ?
+            GROUP BY value
+            HAVING total > 0
+            ORDER BY total DESC, value
+            """,
+            (dimension,),
+        ).fetchall()
+
+        return DataFrame(rows, columns=[dimension, "count"])
+
+    def query_rollup(
+        self,
+        dimension: str = "message",
+        grain: Literal["day", "week"] = "day",
+        page_id: Optional[str] = None,
+        values: Optional[List[str]] = None,
+        since: Optional[Union[date, str]] = None,
+        until: Optional[Union[date, str]] = None,
+    ) -> DataFrame:
+        """
+        Read a time series of counts.
+
+        Args:
+            dimension (str): "message" to count messages, or one of `dimensions`.
+                Defaults to "message".
+            grain (Literal["day", "week"]): The size of the buckets. Defaults to "day".
+            page_id (Optional[str]): The page to count, all pages by default.
+            values (Optional[List[str]]): The values to count, all values by default.
+            since (Optional[Union[date, str]]): The first bucket (included).
+            until (Optional[Union[date, str]]): The last bucket (included).
+
+        Returns:
+            DataFrame: The counts, indexed by the start of the buckets, with one column
+                per value (a single `count` column for messages).
+        """
+        query = (
+            "SELECT bucket, value, SUM(count) FROM rollups"
+            " WHERE grain = ? AND dimension = ?"
+        )
+        params = [grain, dimension]
+        if page_id is not None:
+            query += " AND page_id = ?"
+            params.append(page_id)
+        if values is not None:
+            query += f" AND value IN ({', '.join('?' * len(values))})"
+            params += list(values)
+        if since is not None:
+            query += " AND bucket >= ?"
+            params.append(str(since))
+        if until is not None:
+            query += " AND bucket <= ?"
+            params.append(str(until))
+        query += " GROUP BY bucket, value ORDER BY bucket"
+
+        rows = self._conn.execute(query, params).fetchall()
+        df = DataFrame(rows, columns=["bucket", "value", "count"])
+        df["bucket"] = pd.to_datetime(df["bucket"])
+
+        series = df.pivot(index="bucket", columns="value", values="count")
+        series = series.fillna(0).astype(int)
+        series.columns.name = None
+        if dimension == "message":
+            series.columns = ["count"][: len(series.columns)]
+
+        return series
+
+
+def get_aggregates_path(config: dict) -> str:
+    default_path = os.path.join(config["data-directory"], "aggregates.db")
+    return get_project_path(config.get("aggregates-database", default_path))
+
+
+def query_rollup(config: dict, *args, **kwargs) -> DataFrame:
+    """
+    Read a time series of counts of the pipeline's message table, see
+    `MessageAggregates.query_rollup`.
+    """
+    with MessageAggregates(get_aggregates_path(config)) as aggregates:
+        return aggregates.query_rollup(*args, **kwargs)
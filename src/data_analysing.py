@@ -1,16 +1,17 @@
+import asyncio
 import re
 import sys
 from time import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from functools import lru_cache
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from threading import Lock
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 from tqdm import tqdm
 
 from llm import *
+from llm_cache import *
 from prompt import (ImportantQuestions,  # prompt; output structure
                     ScoredMessages, UserMessagesInfo,
                     classifying_important_question_prompt,
@@ -18,11 +19,22 @@ from prompt import (ImportantQuestions,  # prompt; output structure
 from utils import *
 
 load_dotenv()
-LLM_CONFIG = load_yaml(os.path.join(PROJECT_DIRECTORY, "config.yaml"))["llm"]
+_CONFIG = load_yaml(os.path.join(PROJECT_DIRECTORY, "config.yaml"))
+LLM_CONFIG = _CONFIG["llm"]
+BATCH_CONFIG = _CONFIG.get("llm-batching", {})
+
+# token budget of a request, overridden per provider by the `llm-batching` section
+DEFAULT_BATCH_BUDGET = {
+    "max_input_tokens": 6000,
+    "max_output_tokens": 4000,
+    "output_tokens_per_message": 30,
+}
 
 
 def keyword_filter(
-    patterns: List[str], messages: List[dict], get_keyword: Optional[bool] = True
+    patterns: Union[List[str], PatternMatcher],
+    messages: List[dict],
+    get_keyword: Optional[bool] = True,
 ) -> List[dict]:
     """
     Filter messages based on the presence or absence of specified keywords.
@@ -31,7 +43,8 @@ def keyword_filter(
     It returns a list of messages that either contain or do not contain the specified keywords, depending on the `get_keyword` flag.
 
     Args:
-        patterns (List[str]): A list of keywords to filter by.
+        patterns (Union[List[str], PatternMatcher]): A list of keywords to filter by, or a
+            matcher built from them. Lists are compiled once and cached.
         messages (List[dict]): A list of messages to filter.
         get_keyword (Optional[bool], optional): If True, returns messages containing the keywords.
             If False, returns messages not containing the keywords. Defaults to True.
@@ -39,12 +52,8 @@ def keyword_filter(
     Returns:
         List[dict]: A list of messages that meet the filtering criteria.
     """
-    synthetic_pattern = r"\b(" + "|".join(patterns) + r")\b"
-    result = [
-        m
-        for m in messages
-        if bool(re.search(synthetic_pattern, m["message"].lower())) == get_keyword
-    ]
+    matcher = get_pattern_matcher(patterns, word_boundary=True)
+    result = [m for m in messages if matcher.matches(m["message"]) == get_keyword]
 
     return result
 
@@ -70,18 +79,17 @@ def handle_template_message(
             - `other_message`: A list of messages that were not found in the `templates` dictionary.
     """
 
-    def match_templates(s, templates: List[Dict[str, Any]]):
-        for template in templates:
-            pattern = re.compile(template["pattern"], re.IGNORECASE)
-            if pattern.search(s):
-                return {k: v for k, v in template.items() if k != "pattern"}
-        return {}
+    # one combined regex tells which template matches first
+    matcher = get_pattern_matcher([template["pattern"] for template in templates])
+    template_info = [
+        {k: v for k, v in template.items() if k != "pattern"} for template in templates
+    ]
 
     template_message = []
     other_message = []
     for m in messages:
-        key = m["message"].lower()
-        if u_and_p := match_templates(key, templates):
+        idx = matcher.search(m["message"])
+        if idx is not None and (u_and_p := template_info[idx]):
             m.update(u_and_p)
             template_message.append(m)
         else:
@@ -90,6 +98,121 @@ def handle_template_message(
     return template_message, other_message
 
 
+def get_batch_budget(provider: str) -> Dict[str, int]:
+    # the `llm` section is passed to the models, so budgets have their own section
+    budget = dict(DEFAULT_BATCH_BUDGET)
+    budget.update(BATCH_CONFIG.get(provider, {}))
+    return budget
+
+
+def get_llm_caller(
+    provider: Literal["groq", "google", "snc"], prompt: ChatPromptTemplate
+) -> LLMCaller:
+    if provider == "google":
+        return GoogleAICaller(LLM_CONFIG[provider], prompt)
+    elif provider == "groq":
+        return GroqAICaller(LLM_CONFIG[provider], prompt)
+    else:
+        return SambaNovaCloudAICaller(LLM_CONFIG[provider], prompt)
+
+
+def _parse_batch_response(response: Any, i: int, end_idx: int) -> Optional[list]:
+    """
+    Parse the response of the batch `[i, end_idx)`, or return None if it is truncated or
+    has the wrong size.
+    """
+    try:
+        parsed_response = parse_llm_output(response)
+        print(parsed_response)
+        if len(parsed_response) != end_idx - i:
+            raise ValueError(
+                f"Wrong size, expected {end_idx - i} items but received {len(parsed_response)}"
+            )
+    except Exception as exc:
+        print(f"Error while parsing LLM output for batch {i} - {end_idx - 1}")
+        print(exc)
+        print(response)
+        return None
+
+    return parsed_response
+
+
+def _echoes_batch(parsed_response: list, batch: List[str]) -> bool:
+    # structured items must repeat their message, as the pipelines require
+    return all(
+        not isinstance(item, dict) or item.get("message") == message
+        for item, message in zip(parsed_response, batch)
+    )
+
+
+def _submit_batches(
+    planner: BatchPlanner,
+    pending: Dict[Any, Tuple[int, int, int]],
+    submit: Callable[[int, int], Any],
+) -> None:
+    # batches are planned only when they can be sent
+    while planner and len(pending) < NUM_WORKERS:
+        i, end_idx, level = planner.next()
+        pending[submit(i, end_idx)] = (i, end_idx, level)
+
+
+def _store_batch_result(
+    future: Any,
+    batch: Tuple[int, int, int],
+    messages: List[str],
+    planner: BatchPlanner,
+    cache: LLMResponseCache,
+    res: list,
+    progress: tqdm,
+) -> None:
+    """
+    Store the result of the finished batch `[i, end_idx)` in `res`, or plan its retry.
+
+    Args:
+        future (Any): The finished future or task of the batch, returning the response, its cache key
+            and whether it was cached.
+        batch (Tuple[int, int, int]): The start, end and split level of the batch.
+        messages (List[str]): All the messages of the call.
+        planner (BatchPlanner): The planner of the batches of the call.
+        cache (LLMResponseCache): The cache of the LLM responses.
+        res (list): The parsed responses of the call.
+        progress (tqdm): The progress bar of the call.
+    """
+    i, end_idx, level = batch
+    try:
+        response, key, is_cached = future.result()
+        print(response)
+    except Exception as exc:
+        print(f"Error while generating response for batch {i} - {end_idx - 1}")
+        progress.update(end_idx - i)
+        return
+
+    parsed_response = _parse_batch_response(response, i, end_idx)
+    if parsed_response is None:
+        if not planner.fail(i, end_idx, level):
+            progress.update(end_idx - i)
+        return
+
+    res[i:end_idx] = parsed_response
+    progress.update(end_idx - i)
+
+    # only responses of the right size repeating their messages are cached
+    if (
+        not is_cached
+        and isinstance(response, str)
+        and _echoes_batch(parsed_response, messages[i:end_idx])
+    ):
+        cache.set(key, response)
+
+
+def _print_cache_stats(cache: LLMResponseCache) -> None:
+    stats = cache.stats()
+    print(
+        f"LLM cache: {stats['hits']} hits, {stats['misses']} misses "
+        f"({stats['hit_rate']:.0%} hit rate)"
+    )
+
+
 def call_llm(
     messages: List[str],
     prompt: ChatPromptTemplate,
@@ -102,68 +225,266 @@ def call_llm(
     Calls the specified LLM provider to generate responses for a list of messages.
 
     This function takes a list of messages, a prompt template, batch size, LLM provider, and an optional description.
-    It uses a thread pool executor to process the messages in batches and returns a list of responses.
+    It packs the messages into batches fitting the token budget of the provider (see `BatchPlanner`), processes
+    them with a thread pool executor and returns a list of responses. A batch whose response is truncated or has
+    the wrong size is retried split in two, then message by message, and the batches planned after it are smaller.
 
     Args:
         messages (List[str]): A list of messages to be processed by the LLM.
         prompt (ChatPromptTemplate): A prompt template to be used for generating responses.
-        batch_size (int, optional): The number of messages to process in each batch. Defaults to 50.
+        batch_size (int, optional): The maximum number of messages in each batch. Defaults to 50.
         provider (Literal['groq', 'google', 'snc'], optional): The LLM provider to use. Defaults to 'groq'.
         desc (Optional[str], optional): An optional description for the progress bar. Defaults to None.
 
     Returns:
         List[Union[dict, bool, float, None]]: A parsed list of responses generated by the LLM.
     """
-    if provider == "google":
-        chain = GoogleAICaller(LLM_CONFIG[provider], prompt)
-    elif provider == "groq":
-        chain = GroqAICaller(LLM_CONFIG[provider], prompt)
-    else:
-        chain = SambaNovaCloudAICaller(LLM_CONFIG[provider], prompt)
+    chain = get_llm_caller(provider, prompt)
+
+    # responses are cached on disk, across stages and runs
+    cache = get_llm_cache()
+    model = LLM_CONFIG[provider].get("model", LLM_CONFIG[provider].get("model_name"))
+
+    def cached_invoke(batch: List[str]) -> Tuple[str, str, bool]:
+        key = make_cache_key(provider, model, prompt, batch)
+        if (response := cache.get(key)) is not None:
+            return response, key, True
+
+        return chain.invoke({"input": str(batch)}), key, False
 
-    @lru_cache(maxsize=None)
-    def cached_invoke(input_str):
-        return chain.invoke({"input": input_str})
+    # pack messages by estimated tokens, as the batches are sent
+    planner = BatchPlanner(
+        messages,
+        prompt_tokens=estimate_tokens(prompt.pretty_repr()),
+        max_batch_size=batch_size,
+        **get_batch_budget(provider),
+    )
 
     res = [None for _ in range(len(messages))]
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-        future = {
-            executor.submit(lambda: cached_invoke(str(messages[i : i + batch_size]))): i
-            for i in range(0, len(messages), batch_size)
-        }
-        for f in tqdm(
-            as_completed(future),
-            total=len(future),
-            desc=(desc or "Loading"),
-            file=sys.stdout,
-        ):
-            i = future[f]
-            end_idx = min(i + batch_size, len(messages))
-
-            try:
-                response = f.result()
-                print(response)
-            except Exception as exc:
-                print(f"Error while generating response for batch {i} - {end_idx - 1}")
-                continue
-
-            try:
-                parsed_response = parse_llm_output(response)
-                print(parsed_response)
-                if len(parsed_response) != end_idx - i:
-                    print("Wrong size while query LLM, shutting down!")
-                    break
-
-                for j, idx in enumerate(range(i, end_idx)):
-                    res[idx] = parsed_response[j]
-            except Exception as exc:
-                print(f"Error while parsing LLM output for batch {i} - {end_idx - 1}")
-                print(exc)
-                print(response)
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor, tqdm(
+        total=len(messages), desc=(desc or "Loading"), file=sys.stdout
+    ) as progress:
+        pending = {}
+        while planner or pending:
+            _submit_batches(
+                planner,
+                pending,
+                lambda i, end_idx: executor.submit(cached_invoke, messages[i:end_idx]),
+            )
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                batch = pending.pop(f)
+                _store_batch_result(f, batch, messages, planner, cache, res, progress)
+
+    _print_cache_stats(cache)
+
+    return res
+
+
+async def acall_llm(
+    messages: List[str],
+    prompt: ChatPromptTemplate,
+    response_format: Optional[BaseModel] = None,
+    batch_size: int = 50,
+    provider: Literal["groq", "google", "snc"] = "groq",
+    desc: Optional[str] = None,
+    semaphore: Optional[asyncio.Semaphore] = None,
+) -> List[Union[dict, bool, float, None]]:
+    """
+    Calls the specified LLM provider to generate responses for a list of messages, asynchronously.
+
+    This function works like `call_llm`, but every batch is a task of the running event loop instead of
+    a thread. Calls from several stages and providers can run on the same loop and share `semaphore`,
+    which bounds the number of requests in flight.
+
+    Args:
+        messages (List[str]): A list of messages to be processed by the LLM.
+        prompt (ChatPromptTemplate): A prompt template to be used for generating responses.
+        batch_size (int, optional): The maximum number of messages in each batch. Defaults to 50.
+        provider (Literal['groq', 'google', 'snc'], optional): The LLM provider to use. Defaults to 'groq'.
+        desc (Optional[str], optional): An optional description for the progress bar. Defaults to None.
+        semaphore (Optional[asyncio.Semaphore], optional): The concurrency budget of the requests.
+            Defaults to a budget of `NUM_WORKERS` requests for this call only.
+
+    Returns:
+        List[Union[dict, bool, float, None]]: A parsed list of responses generated by the LLM.
+    """
+    chain = get_llm_caller(provider, prompt)
+    semaphore = semaphore or asyncio.Semaphore(NUM_WORKERS)
+
+    # responses are cached on disk, across stages and runs
+    cache = get_llm_cache()
+    model = LLM_CONFIG[provider].get("model", LLM_CONFIG[provider].get("model_name"))
+
+    async def cached_invoke(batch: List[str]) -> Tuple[str, str, bool]:
+        key = make_cache_key(provider, model, prompt, batch)
+        if (response := cache.get(key)) is not None:
+            return response, key, True
+
+        async with semaphore:
+            return await chain.ainvoke({"input": str(batch)}), key, False
+
+    # pack messages by estimated tokens, as the batches are sent
+    planner = BatchPlanner(
+        messages,
+        prompt_tokens=estimate_tokens(prompt.pretty_repr()),
+        max_batch_size=batch_size,
+        **get_batch_budget(provider),
+    )
+
+    res = [None for _ in range(len(messages))]
+    with tqdm(
+        total=len(messages), desc=(desc or "Loading"), file=sys.stdout
+    ) as progress:
+        pending = {}
+        while planner or pending:
+            _submit_batches(
+                planner,
+                pending,
+                lambda i, end_idx: asyncio.create_task(
+                    cached_invoke(messages[i:end_idx])
+                ),
+            )
+
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                batch = pending.pop(task)
+                _store_batch_result(
+                    task, batch, messages, planner, cache, res, progress
+                )
+
+    _print_cache_stats(cache)
 
     return res
 
 
+def _lookup_memo(
+    messages: List[str], prompt: ChatPromptTemplate, stage: str, desc: Optional[str]
+) -> Tuple[List[str], Dict[str, dict], Dict[str, str]]:
+    """
+    Look up the remembered results of messages.
+
+    Returns:
+        Tuple[List[str], Dict[str, dict], Dict[str, str]]: The normalized text of every
+            message, the known results by text, and the distinct unknown messages by text.
+    """
+    keys = [normalize_message_text(m) for m in messages]
+    known = get_message_memo().get_many(stage, prompt_hash(prompt), keys)
+
+    # send every unknown text once
+    unseen = {}
+    for message, key in zip(messages, keys):
+        if key not in known and key not in unseen:
+            unseen[key] = message
+    print(f"{desc or stage}: {len(messages) - len(unseen)} messages resolved locally")
+
+    return keys, known, unseen
+
+
+def _merge_memo(
+    messages: List[str],
+    prompt: ChatPromptTemplate,
+    stage: str,
+    keys: List[str],
+    known: Dict[str, dict],
+    unseen: Dict[str, str],
+    output: List[Any],
+) -> List[Optional[dict]]:
+    """
+    Remember the results of the unknown messages and merge them with the known ones.
+    """
+    new_results = {
+        key: {k: v for k, v in result.items() if k != "message"}
+        for (key, message), result in zip(unseen.items(), output)
+        if isinstance(result, dict) and result.get("message") == message
+    }
+    get_message_memo().set_many(stage, prompt_hash(prompt), new_results)
+    known.update(new_results)
+
+    # other results are returned as they are, for the pipelines to reject
+    failed = dict(zip(unseen, output))
+
+    return [
+        {"message": message, **known[key]} if key in known else failed.get(key)
+        for message, key in zip(messages, keys)
+    ]
+
+
+def call_llm_with_memo(
+    messages: List[str],
+    prompt: ChatPromptTemplate,
+    stage: str,
+    response_format: Optional[BaseModel] = None,
+    batch_size: int = 50,
+    provider: Literal["groq", "google", "snc"] = "groq",
+    desc: Optional[str] = None,
+) -> List[Optional[dict]]:
+    """
+    Calls `call_llm` for the messages whose result is not known yet.
+
+    Results are remembered per stage and prompt, by normalized message text. Known
+    messages are resolved locally, and every other distinct text is sent once. A
+    result is remembered only if it repeats its message, as the pipelines require.
+
+    Args:
+        messages (List[str]): A list of messages to be processed by the LLM.
+        prompt (ChatPromptTemplate): A prompt template to be used for generating responses.
+        stage (str): The name of the pipeline stage.
+        batch_size (int, optional): The number of messages to process in each batch. Defaults to 50.
+        provider (Literal['groq', 'google', 'snc'], optional): The LLM provider to use. Defaults to 'groq'.
+        desc (Optional[str], optional): An optional description for the progress bar. Defaults to None.
+
+    Returns:
+        List[Optional[dict]]: The result of every message. Remembered results carry the
+            text of their message, other results are returned as the LLM gave them.
+    """
+    keys, known, unseen = _lookup_memo(messages, prompt, stage, desc)
+
+    output = []
+    if unseen:
+        output = call_llm(
+            messages=list(unseen.values()),
+            prompt=prompt,
+            response_format=response_format,
+            batch_size=batch_size,
+            provider=provider,
+            desc=desc,
+        )
+
+    return _merge_memo(messages, prompt, stage, keys, known, unseen, output)
+
+
+async def acall_llm_with_memo(
+    messages: List[str],
+    prompt: ChatPromptTemplate,
+    stage: str,
+    response_format: Optional[BaseModel] = None,
+    batch_size: int = 50,
+    provider: Literal["groq", "google", "snc"] = "groq",
+    desc: Optional[str] = None,
+    semaphore: Optional[asyncio.Semaphore] = None,
+) -> List[Optional[dict]]:
+    """
+    Calls `acall_llm` for the messages whose result is not known yet, see `call_llm_with_memo`.
+    """
+    keys, known, unseen = _lookup_memo(messages, prompt, stage, desc)
+
+    output = []
+    if unseen:
+        output = await acall_llm(
+            messages=list(unseen.values()),
+            prompt=prompt,
+            response_format=response_format,
+            batch_size=batch_size,
+            provider=provider,
+            desc=desc,
+            semaphore=semaphore,
+        )
+
+    return _merge_memo(messages, prompt, stage, keys, known, unseen, output)
+
+
 def classify_inquiry_pipeline(
     messages: List[dict],
     min_score: float,
@@ -189,18 +510,27 @@ def classify_inquiry_pipeline(
             - `error_messages`: A list of messages that do not meet the minimum score threshold.
     """
     input = [m["message"] for m in messages]
-    output = call_llm(
+    output = call_llm_with_memo(
         messages=input,
         prompt=classifying_inquiry_prompt,
+        stage="inquiry",
         response_format=response_format,
         batch_size=batch_size,
         provider=provider,
         desc="Classify inquiry",
     )
 
+    return _split_scored_messages(messages, output, min_score)
+
+
+def _split_scored_messages(
+    messages: List[dict], output: List[Optional[dict]], min_score: float
+) -> Tuple[List[dict], List[dict]]:
     classified_messages = []
     error_messages = []
     for message, scored_message in zip(messages, output):
+        # a failed batch leaves no result
+        scored_message = scored_message if isinstance(scored_message, dict) else {}
         if message["message"] != scored_message.get("message"):
             error_messages.append(message)
         elif scored_message.get("score", 0.0) >= min_score:
@@ -275,19 +605,27 @@ def classify_question_pipeline(
     """
     # classify by LLM
     input = [m["message"] for m in messages]
-    output = call_llm(
+    output = call_llm_with_memo(
         messages=input,
         prompt=classifying_important_question_prompt,
+        stage="question",
         response_format=response_format,
         batch_size=batch_size,
         provider=provider,
         desc="Classify question",
     )
 
-    # get output to return
+    return _split_labeled_messages(messages, output)
+
+
+def _split_labeled_messages(
+    messages: List[dict], output: List[Optional[dict]]
+) -> Tuple[List[dict], List[dict]]:
     classified_messages = []
     error_messages = []
     for message, labeled_message in zip(messages, output):
+        # a failed batch leaves no result
+        labeled_message = labeled_message if isinstance(labeled_message, dict) else {}
         if message["message"] != labeled_message.get("message"):
             error_messages.append(message)
         elif labeled_message.get("important") == True:
@@ -320,15 +658,22 @@ def extract_user_purpose_pipeline(
     """
     # classify by LLM
     input = [m["message"] for m in messages]
-    output = call_llm(
+    output = call_llm_with_memo(
         messages=input,
         prompt=extracting_user_purpose_prompt,
+        stage="user-purpose",
         response_format=response_format,
         batch_size=batch_size,
         provider=provider,
         desc="Extract inquiry",
     )
 
+    return _split_extracted_messages(messages, output)
+
+
+def _split_extracted_messages(
+    messages: List[dict], output: List[Optional[dict]]
+) -> Tuple[List[dict], List[dict]]:
     extracted_messages = []
     error_messages = []
     for mess, u_and_p in zip(messages, output):
@@ -389,26 +734,18 @@ def analyse_message_pipeline(
         template_messages, messages = handle_template_message(template, messages)
         extracted_messages += template_messages
 
-    # filter to avoid exceed limit tokens
-    messages = messages[-400:]
-    error_messages = messages[:-400]
-
     # extract user and purpose
     classified_mess, error = classify_inquiry_pipeline(
         messages, min_score=important_score, batch_size=batch_size, provider=provider
     )
     error_messages += error
 
-    time.sleep(60)
-
     extracted_mess, error = extract_user_purpose_pipeline(
         classified_mess, batch_size=batch_size, provider=provider
     )
     extracted_messages += extracted_mess
     error_messages += error
 
-    time.sleep(60)
-
     # classifiy important questions
     if question_keywords is not None:
         messages = keyword_filter(question_keywords, messages, get_keyword=True)
@@ -419,10 +756,105 @@ def analyse_message_pipeline(
     error_messages += error
 
     # deduplicate error messages
-    error_messages = [
-        json.loads(item)
-        for item in {json.dumps(d, sort_keys=True) for d in error_messages}
-    ]
+    error_messages = unique_messages(error_messages)
+
+    return extracted_messages, questions, error_messages
+
+
+async def async_analyse_message_pipeline(
+    messages: List[dict],
+    question_keywords: List[str] = None,
+    template: Optional[dict] = None,
+    important_score: Optional[float] = 0.7,
+    batch_size: int = 50,
+    provider: Literal["google", "groq"] = "google",
+    max_concurrency: int = NUM_WORKERS,
+):
+    """
+    Analyzes a list of messages like `analyse_message_pipeline`, on a single event loop.
+
+    Inquiry and question classification are independent, so they run concurrently, and
+    user and purpose extraction starts once the inquiries are known. Every stage shares
+    one budget of `max_concurrency` requests in flight, while the rate limits of the
+    provider are enforced by its caller.
+
+    Args:
+        messages (List[dict]): A list of messages to be analyzed.
+        question_keywords (List[str], optional): A list of keywords to identify questions. Defaults to None.
+        template (Optional[dict], optional): A dictionary of template messages. Defaults to None.
+        important_score (Optional[float], optional): The minimum score threshold for classifying an inquiry. Defaults to 0.7.
+        batch_size (int, optional): The number of messages to process in each batch. Defaults to 50.
+        provider (Literal['google', 'groq'], optional): The LLM provider to use. Defaults to 'google'.
+        max_concurrency (int, optional): The maximum number of requests in flight. Defaults to NUM_WORKERS.
+
+    Returns:
+        Tuple[List[dict], List[dict], List[dict]]: The extracted messages, the questions and
+            the error messages, like `analyse_message_pipeline`.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    # Initialize results
+    extracted_messages = []
+    error_messages = []
+
+    if template is not None:
+        template_messages, messages = handle_template_message(template, messages)
+        extracted_messages += template_messages
+
+    question_messages = messages
+    if question_keywords is not None:
+        question_messages = keyword_filter(
+            question_keywords, messages, get_keyword=True
+        )
+
+    # classify inquiries and important questions concurrently
+    inquiry_output, question_output = await asyncio.gather(
+        acall_llm_with_memo(
+            messages=[m["message"] for m in messages],
+            prompt=classifying_inquiry_prompt,
+            stage="inquiry",
+            response_format=ScoredMessages,
+            batch_size=batch_size,
+            provider=provider,
+            desc="Classify inquiry",
+            semaphore=semaphore,
+        ),
+        acall_llm_with_memo(
+            messages=[m["message"] for m in question_messages],
+            prompt=classifying_important_question_prompt,
+            stage="question",
+            response_format=ImportantQuestions,
+            batch_size=batch_size,
+            provider=provider,
+            desc="Classify question",
+            semaphore=semaphore,
+        ),
+    )
+    classified_mess, error = _split_scored_messages(
+        messages, inquiry_output, important_score
+    )
+    error_messages += error
+
+    questions, error = _split_labeled_messages(question_messages, question_output)
+    error_messages += error
+
+    # extract user and purpose
+    extract_output = await acall_llm_with_memo(
+        messages=[m["message"] for m in classified_mess],
+        prompt=extracting_user_purpose_prompt,
+        stage="user-purpose",
+        response_format=UserMessagesInfo,
+        batch_size=batch_size,
+        provider=provider,
+        desc="Extract inquiry",
+        semaphore=semaphore,
+    )
+    extracted_mess, error = _split_extracted_messages(classified_mess, extract_output)
+    extracted_messages += extracted_mess
+    error_messages += error
+
+    # deduplicate error messages
+    error_messages = unique_messages(error_messages)
 
     return extracted_messages, questions, error_messages
 
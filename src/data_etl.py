@@ -1,3 +1,4 @@
+import asyncio
 import os
 import sys
 
@@ -10,19 +11,18 @@ from typing import Any, Dict, List
 import pandas as pd
 from tqdm import tqdm
 
+from aggregates import *
 from data_analysing import *
 from data_presentation import *
+from message_queue import *
 from pancake import *
+from table_store import *
 from utils import *
 
 
 # --------------------- Crawling Messages sub-processes ---------------------
 def filter_pages(name: str, patterns: List):
-    for p in patterns:
-        if re.search(p, name):
-            return True
-
-    return False
+    return get_pattern_matcher(patterns, ignore_case=False).matches(name)
 
 
 def update_page(
@@ -80,7 +80,7 @@ def update_page(
     return page_schema
 
 
-def update_conversation(page_schema: dict, new_check: int):
+def update_conversation(page_schema: dict, new_check: int, prefetch: bool = False):
     # call newest conversations of all pages
     conversations = {}
     with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
@@ -93,6 +93,7 @@ def update_conversation(page_schema: dict, new_check: int):
                 new_check,  # until,
                 "update",  # order_by
                 ["inbox"],  # filter
+                prefetch,  # prefetch
             ): k
             for k, v in page_schema.items()
         }
@@ -113,6 +114,12 @@ def update_conversation(page_schema: dict, new_check: int):
 
             conversations[page_id] = data
 
+    return plan_conversation_updates(page_schema, conversations, new_check)
+
+
+def plan_conversation_updates(
+    page_schema: dict, conversations: Dict[str, List[dict]], new_check: int
+) -> List[tuple]:
     # check which conversation has new messages
     update_conversations = []
     for page_id, conversation_list in conversations.items():
@@ -123,38 +130,23 @@ def update_conversation(page_schema: dict, new_check: int):
         # update last check timestamp
         page_schema[page_id]["last_check"] = new_check
 
-        # get the conversations that need to be scraped
+        # get the conversations that need to be scraped, a conversation whose
+        # `updated_at` has not changed since the last crawl has no new messages
         for con in conversation_list:
             con_id = con["id"]
-            # if con_id not in last_conversations:
-            #     # update `last_crawled_conversations`
-            #     last_conversations[con_id] = {
-            #         'customer_id': con['customer_id'],
-            #         'last_updated': con['updated_at'],
-            #     }
-
-            #     # append to list to crawl data
-            #     update_conversations.append(
-            #         # append page_id, page_access_token, conversation_id, customer_id, last_update
-            #         (page_id, page_access_token, con_id, con['customer_id'], page_last_check)
-            #     )
-
-            # elif con['updated_at'] != last_conversations[con_id]['last_updated']:
-            #     # update last crawl time
-            #     last_conversations[con_id]['last_updated'] = con['updated_at']
-
-            #     # add to crawling list
-            #     last_update_timestamp = string_to_unix_second(con['updated_at'])
-            #     update_conversations.append(
-            #         (page_id, page_access_token, con_id, con['customer_id'], last_update_timestamp)
-            #     )
+            last_conversation = last_conversations.get(con_id)
+            if last_conversation is None:
+                # new conversation, crawl since the last check of its page
+                last_update_timestamp = page_last_check
+            elif con["updated_at"] != last_conversation["last_updated"]:
+                # changed conversation, crawl since its last seen message
+                last_update_timestamp = string_to_unix_second(
+                    last_conversation["last_updated"]
+                )
+            else:
+                continue
 
             # add to crawl list
-            last_update_timestamp = (
-                page_last_check
-                if con_id not in last_conversations
-                else string_to_unix_second(last_conversations[con_id]["last_updated"])
-            )
             update_conversations.append(
                 # append page_id, page_access_token, conversation_id, customer_id, last_update
                 (
@@ -176,6 +168,8 @@ def update_conversation(page_schema: dict, new_check: int):
 
 
 def update_messages(conversations: dict, new_check: int):
+    # every raw page is filtered as it arrives, so a worker keeps only the filtered
+    # messages of its conversation, returned in chronological order
     messages = []
     with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
         future_to_messages = {
@@ -205,13 +199,14 @@ def pancake_etl(
     schema_path: str,
     default_last_check: int = 30,
     filter_patterns: Optional[List] = None,
+    prefetch: bool = False,
 ):
     # 1. Update pages
     page_schema = update_page(schema_path, default_last_check, filter_patterns)
 
     # 2. Update conversations
     new_check = int(time.time())
-    conversations = update_conversation(page_schema, new_check)
+    conversations = update_conversation(page_schema, new_check, prefetch)
 
     # 3. Completing update schema, save it.
     save_json(schema_path, page_schema)
@@ -222,6 +217,85 @@ def pancake_etl(
     return messages
 
 
+# --------------------- Async crawling sub-processes ---------------------
+async def async_update_conversation(
+    client: AsyncPancakeClient, page_schema: dict, new_check: int
+):
+    async def fetch(page_id: str, page_info: dict):
+        try:
+            return await async_get_page_conversations(
+                client,
+                page_id,
+                page_info["page_access_token"],
+                page_info["last_check"],  # since
+                new_check,  # until
+                "update",  # order_by
+                ["inbox"],  # filter
+            )
+        except Exception as exc:
+            print(
+                f"Error occurred while fetching conversations for page {page_id}: {exc}"
+            )
+            return []
+
+    # call newest conversations of all pages concurrently
+    page_ids = list(page_schema.keys())
+    results = await asyncio.gather(
+        *[fetch(page_id, page_schema[page_id]) for page_id in page_ids]
+    )
+    conversations = dict(zip(page_ids, results))
+
+    return plan_conversation_updates(page_schema, conversations, new_check)
+
+
+async def async_update_messages(
+    client: AsyncPancakeClient, conversations: List[tuple], new_check: int
+):
+    async def fetch(m: tuple):
+        try:
+            return await async_get_messages(
+                client, m[0], m[1], m[2], m[3], m[4], new_check
+            )
+        except Exception as exc:
+            print(
+                f"Error occurred while fetching messages for conversation {m[2]}: {exc}"
+            )
+            return []
+
+    messages = []
+    for future in tqdm(
+        asyncio.as_completed([fetch(m) for m in conversations]),
+        total=len(conversations),
+        desc="Request messages",
+    ):
+        messages += await future
+
+    return messages
+
+
+async def async_pancake_etl(
+    schema_path: str,
+    default_last_check: int = 30,
+    filter_patterns: Optional[List] = None,
+    max_concurrency: int = 100,
+):
+    # 1. Update pages
+    page_schema = update_page(schema_path, default_last_check, filter_patterns)
+
+    async with AsyncPancakeClient(max_concurrency=max_concurrency) as client:
+        # 2. Update conversations
+        new_check = int(time.time())
+        conversations = await async_update_conversation(client, page_schema, new_check)
+
+        # 3. Completing update schema, save it.
+        save_json(schema_path, page_schema)
+
+        # 4. Get new messages
+        messages = await async_update_messages(client, conversations, new_check)
+
+    return messages
+
+
 # --------------------- ETL Utilities ---------------------
 def post_process_messages(messages: Dict[str, List[dict]]):
     result = {}
@@ -245,28 +319,24 @@ def load_table(
     list_cols: Optional[List[str]] = None,
     datetime_cols: Optional[List[str]] = None,
     datetime_format: str = "%Y-%m-%d %H:%M:%S",
+    dtypes: Optional[Dict[str, Any]] = None,
 ) -> DataFrame:
+    # declare dtypes up front, list and datetime columns are read as strings
+    dtypes = {
+        **{col: "object" for col in (list_cols or []) + (datetime_cols or [])},
+        **(dtypes or {}),
+    }
+
     # Read the CSV file into a DataFrame
     try:
-        df = pd.read_csv(path)
+        df = pd.read_csv(path, dtype=dtypes)
     except Exception as exc:
         return pd.DataFrame()
 
-    # Process list columns
+    # Process list columns with vectorized string operations
     if list_cols:
         for col in list_cols:
-            # Apply the following steps to clean and convert the string into a list
-            def process_list(item):
-                if pd.isna(item):  # Handle missing values
-                    return []
-
-                # Remove square brackets if present, and then split by comma
-                item = item.strip("[]")  # Remove surrounding brackets
-                return [
-                    x.strip().strip("'") for x in item.split(",")
-                ]  # Split by commas and strip extra spaces
-
-            df[col] = df[col].apply(process_list)
+            df[col] = parse_list_column(df[col])
 
     # Convert datetime columns
     if datetime_cols:
@@ -278,11 +348,53 @@ def load_table(
     return df
 
 
+def open_table(
+    config: dict, table_key: Literal["message-table", "question-table"]
+) -> PartitionedTable:
+    # the partitions are stored next to the legacy CSV file, without its extension
+    path = get_project_path(config[table_key])
+    table = PartitionedTable(os.path.splitext(path)[0])
+
+    # import the legacy CSV table once
+    if os.path.exists(path) and path.endswith(".csv"):
+        list_cols = ["user", "purpose"] if table_key == "message-table" else None
+        legacy_df = load_table(path, list_cols=list_cols, datetime_cols=["inserted_at"])
+        if not legacy_df.empty:
+            appended_df = table.append(legacy_df)
+
+            # the CSV is kept until every of its rows is stored
+            missing = ~hash_dataframe_rows(legacy_df).isin(table.row_hashes())
+            print(
+                f"Migrated {len(appended_df)} of {len(legacy_df)} rows from {path}, "
+                f"{missing.sum()} rows missing"
+            )
+            if missing.any():
+                raise RuntimeError(f"{missing.sum()} rows of {path} were not migrated")
+        os.replace(path, path + ".migrated")
+
+    return table
+
+
+def open_aggregates(config: dict, table: PartitionedTable) -> MessageAggregates:
+    aggregates = MessageAggregates(get_aggregates_path(config))
+
+    # count the existing message table once
+    if not aggregates.initialized:
+        aggregates.rebuild(table.load(), row_hashes=table.row_hashes())
+    else:
+        # the table and the counts are not written atomically
+        aggregates.reconcile(table)
+
+    return aggregates
+
+
 # --------------------- ETL tasks ---------------------
 # task 2: remove old data at beginning of a day
 def remove_old_data(config: dict):
     # check data has been collected
-    if not os.path.exists(get_project_path(config["queue-message"])):
+    if not os.path.exists(get_queue_path(config)) and not os.path.exists(
+        get_project_path(config["queue-message"])
+    ):
         return
 
     # just remove data once per day
@@ -293,43 +405,40 @@ def remove_old_data(config: dict):
     date_bound = get_day_before(config["oldest-date"], return_type="date")
 
     # remove data on queue
-    if os.path.exists(get_project_path(config["queue-message"])):
-        queue_messsages = load_json(get_project_path(config["queue-message"]))
-        print(f"Before removing old data, queue size {len(queue_messsages)}")
-
-        queue_messsages = [
-            m
-            for m in queue_messsages
-            if string_to_unix_second(m["inserted_at"]) > int(date_bound.timestamp())
-        ]
-        print(f"After removing old data, queue size {len(queue_messsages)}")
-
-        save_json(get_project_path(config["queue-message"]), queue_messsages)
-
-    # remove data on sheet
-    for path, sheet_name in zip(
-        (
-            get_project_path(config["message-table"]),
-            get_project_path(config["question-table"]),
-        ),
+    with open_message_queue(config) as queue:
+        print(f"Before removing old data, queue size {len(queue)}")
+        queue.delete_before(int(date_bound.timestamp()))
+        print(f"After removing old data, queue size {len(queue)}")
+
+    # remove data on sheet, published together
+    publisher = SheetPublisher()
+    for table_key, sheet_name in zip(
+        ("message-table", "question-table"),
         (config["message-sheet"], config["question-sheet"]),
     ):
-        # remove
-        load_table_args = {"path": path, "datetime_cols": ["inserted_at"]}
-        name = "question"
-        if sheet_name == config["message-sheet"]:
-            load_table_args.update({"list_cols": ["user", "purpose"]})
-            name = "message"
-        message_df = load_table(**load_table_args)
-
-        if not message_df.empty:
-            print(f"Before removing old data, {name} table: {message_df.shape}")
-            message_df = message_df.loc[message_df["inserted_at"] > date_bound]
+        # remove whole day partitions
+        table = open_table(config, table_key)
+        name = table_key.split("-")[0]
+        if len(table):
+            print(f"Before removing old data, {name} table: {len(table)} rows")
+            if table_key == "message-table":
+                # opened before the table changes, so the counts still match it
+                with open_aggregates(config, table) as aggregates:
+                    table.drop_before(date_bound)
+                    aggregates.drop_before(date_bound)
+            else:
+                table.drop_before(date_bound)
+            message_df = table.load()
             print(f"After removing old data, {name} table: {message_df.shape}")
 
-            # update
-            update_worksheet(message_df, sheet_name=sheet_name, mode="replace")
-            message_df.to_csv(path, index=False)
+            # update, only the expired rows are deleted
+            publisher.sync(
+                message_df.drop(columns="page_id", errors="ignore"),
+                sheet_name=sheet_name,
+                sorted_by="inserted_at",
+            )
+
+    publisher.publish()
 
 
 # task 3: update new data (pages, conversations, messages)
@@ -343,7 +452,22 @@ def update_new_data(
     schema = os.path.join(PROJECT_DIRECTORY, config["schema"])
     default_last_check = config["default-last-check"]
     filter_patterns = config["filter-page-keywords"]
-    messages = pancake_etl(schema, default_last_check, filter_patterns)
+    if config.get("crawl-mode", "thread") == "async":
+        messages = asyncio.run(
+            async_pancake_etl(
+                schema,
+                default_last_check,
+                filter_patterns,
+                max_concurrency=config.get("crawl-concurrency", 100),
+            )
+        )
+    else:
+        messages = pancake_etl(
+            schema,
+            default_last_check,
+            filter_patterns,
+            prefetch=config.get("prefetch-conversations", False),
+        )
     messages = [m for m in messages if m["from"] == "customer"]
 
     # analyse messages by keywords
@@ -358,95 +482,88 @@ def update_new_data(
     if templates:
         template_messages, messages = handle_template_message(templates, messages)
 
-    # store messages lists
-    queue_message_path = get_project_path(config["queue-message"])
-    if os.path.exists(queue_message_path):
-        messages = load_json(queue_message_path) + messages
-
     return template_messages, messages
 
 
 # task 4: load data to be analysed
 def load_analyse_data(config: dict, messages: List[str], num_sample: int = 500):
-    # load queue messages
-    queue_path = get_project_path(config["queue-message"])
-    queue_messages = messages
-    if os.path.exists(queue_path):
-        queue_messages = load_json(queue_path) + messages
-        # deduplicate
-        queue_messages = [
-            json.loads(item)
-            for item in {json.dumps(d, sort_keys=True) for d in queue_messages}
-        ]
+    with open_message_queue(config) as queue:
+        # store new messages, messages seen in earlier runs are skipped
+        queue.enqueue(queue.mark_seen(messages))
 
-    # load messages needed to analyse
-    analyse_messages = queue_messages[-num_sample:]
-    queue_messages = queue_messages[:-num_sample]
-
-    # store queue messages
-    save_json(queue_path, queue_messages)
+        # load messages needed to analyse
+        analyse_messages = queue.dequeue(num_sample)
 
     return analyse_messages
 
 
 # task 6: update tables
 def update_table(config: dict, extracted_messages: List[dict], questions: List[dict]):
-    # update message and question sheet
-    updated_message_df = None  # keep this df for later
-    for new_table, sheet_name, path in zip(
-        (extracted_messages, questions),
-        (config["message-sheet"], config["question-sheet"]),
-        (
-            get_project_path(config["message-table"]),
-            get_project_path(config["question-table"]),
-        ),
-    ):
-        if new_table:  # avoid empty list
-            # load existence df
-            load_table_args = {"path": path, "datetime_cols": ["inserted_at"]}
-            name = "question"
-            if sheet_name == config["message-sheet"]:
-                load_table_args.update({"list_cols": ["user", "purpose"]})
-                name = "message"
-            last_df = load_table(**load_table_args)
-
-            print(f"Before updating, {name} table: {last_df.shape}")
-
-            # convert new extracted messages to df
-            new_df = create_dataframe(new_table)
-
-            # concat to newest df
-            updated_df = pd.concat([last_df, new_df], axis=0)
-            print(f"After updating, {name} table: {updated_df.shape}")
-
-            # deduplicate
-            updated_df = drop_dataframe_duplicates(updated_df)
-            if sheet_name == config["message-sheet"]:
-                updated_message_df = updated_df.copy()
-
-            # upload to google sheet and store local
-            update_worksheet(
-                updated_df,
-                sheet_name=sheet_name,
-                mode="replace",
-                sorted_by="inserted_at",
-            )
-            updated_df.to_csv(os.path.join(PROJECT_DIRECTORY, path), index=False)
+    # every sheet mutation is published at the end, in one transaction
+    publisher = SheetPublisher()
+
+    # the counts of the message table are opened, and reconciled, once per run
+    message_table = open_table(config, "message-table")
+    with open_aggregates(config, message_table) as aggregates:
+        # update message and question sheet
+        for new_table, sheet_name, table_key in zip(
+            (extracted_messages, questions),
+            (config["message-sheet"], config["question-sheet"]),
+            ("message-table", "question-table"),
+        ):
+            if new_table:  # avoid empty list
+                # open the day-partitioned table
+                table = (
+                    message_table
+                    if table_key == "message-table"
+                    else open_table(config, table_key)
+                )
+                name = table_key.split("-")[0]
+
+                print(f"Before updating, {name} table: {len(table)} rows")
 
-    # update 2 stats sheet
-    if extracted_messages:  # avoid empty list
-        user_sheet_name = config["user-sheet"]
-        purpose_sheet_name = config["purpose-sheet"]
-        user_df, purpose_df = quantify_data(updated_message_df)
+                # convert new extracted messages to df, the message id stays internal
+                new_df = create_dataframe(new_table).drop(
+                    columns="message_id", errors="ignore"
+                )
 
-        update_worksheet(user_df, sheet_name=user_sheet_name, mode="replace")
-        user_df.to_csv(get_project_path(config["user-table"]))
-        update_worksheet(purpose_df, sheet_name=purpose_sheet_name, mode="replace")
-        purpose_df.to_csv(get_project_path(config["purpose-table"]))
+                # append new rows, duplicates are dropped within their day partition
+                appended_df = table.append(new_df)
+                if table_key == "message-table":
+                    aggregates.add(appended_df)
+                print(
+                    f"After updating, {name} table: {len(table)} rows, {len(appended_df)} new rows"
+                )
+
+                # upload to google sheet, only the partitions of the new rows are read and
+                # diffed, the older rows of the worksheet are kept
+                first_day = appended_df["inserted_at"].min()
+                if pd.notna(first_day):
+                    publisher.sync(
+                        table.load(since=first_day.date()).drop(
+                            columns="page_id", errors="ignore"
+                        ),
+                        sheet_name=sheet_name,
+                        sorted_by="inserted_at",
+                        since=f"{first_day:%Y-%m-%d}",
+                    )
+
+        # update 2 stats sheet
+        if extracted_messages:  # avoid empty list
+            user_sheet_name = config["user-sheet"]
+            purpose_sheet_name = config["purpose-sheet"]
+            # running counts, only the new rows were counted
+            user_df = aggregates.counts("user")
+            purpose_df = aggregates.counts("purpose")
+
+            publisher.replace(user_df, sheet_name=user_sheet_name)
+            user_df.to_csv(get_project_path(config["user-table"]))
+            publisher.replace(purpose_df, sheet_name=purpose_sheet_name)
+            purpose_df.to_csv(get_project_path(config["purpose-table"]))
 
     # clean spreadsheet
-    clean_spreadsheet(
-        sheets=[
+    publisher.keep_only(
+        [
             config["message-sheet"],
             config["question-sheet"],
             config["user-sheet"],
@@ -454,6 +571,8 @@ def update_table(config: dict, extracted_messages: List[dict], questions: List[d
         ]
     )
 
+    publisher.publish()
+
 
 # complete ETL
 def analyse_customer_message_pipeline():
@@ -482,19 +601,29 @@ def analyse_customer_message_pipeline():
         return
 
     # 5. analysing
-    extracted_messages, questions, error_messages = analyse_message_pipeline(
-        messages,
-        question_keywords=config["question-keywords"],
-        important_score=config["important-score"],
-        provider=config["provider"],
-    )
+    if config.get("llm-mode", "thread") == "async":
+        extracted_messages, questions, error_messages = asyncio.run(
+            async_analyse_message_pipeline(
+                messages,
+                question_keywords=config["question-keywords"],
+                important_score=config["important-score"],
+                provider=config["provider"],
+                max_concurrency=config.get("llm-concurrency", NUM_WORKERS),
+            )
+        )
+    else:
+        extracted_messages, questions, error_messages = analyse_message_pipeline(
+            messages,
+            question_keywords=config["question-keywords"],
+            important_score=config["important-score"],
+            provider=config["provider"],
+        )
     extracted_messages.extend(template_messages)
 
     # 6. store error messages to queue
-    queue_path = get_project_path(config["queue-message"])
     if error_messages:
-        queue_message = load_json(queue_path) + error_messages
-        save_json(queue_path, queue_message)
+        with open_message_queue(config) as queue:
+            queue.enqueue(error_messages)
 
     # 7. update tables
     update_table(config, extracted_messages, questions)
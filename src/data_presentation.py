@@ -1,23 +1,276 @@
+import gzip
+import hashlib
+import json
 import os
-from typing import List, Literal, Optional
+import re
+from datetime import datetime, timezone
+from difflib import SequenceMatcher
+from functools import lru_cache
+from typing import List, Literal, Optional, Tuple, Union
 
 import gspread
 import pandas as pd
 from dotenv import load_dotenv
 from google.oauth2.service_account import Credentials
+from gspread.utils import absolute_range_name
 from pandas import DataFrame
 
-from utils import PROJECT_DIRECTORY
+from utils import PROJECT_DIRECTORY, hash_dataframe_rows
 
 load_dotenv()
 
 _SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
-_credential_file = os.path.join(PROJECT_DIRECTORY, "credentials.json")
-_creds = Credentials.from_service_account_file(_credential_file, scopes=_SCOPES)
-_client = gspread.authorize(_creds)
-sheet_id = os.environ["SHEET_ID"]
-spreadsheet = _client.open_by_key(sheet_id)
+# "gspread" talks to Google Sheets, "noop" accepts and drops every write
+SHEETS_BACKEND = os.environ.get("SHEETS_BACKEND", "gspread")
+
+# opened worksheets, by title
+_worksheets = {}
+
+
+class NoopWorksheet:
+    """
+    A worksheet that accepts and drops every write, for offline runs and benchmarks.
+    """
+
+    def __init__(self, title: str):
+        self.title = title
+
+    def get_all_records(self) -> List[dict]:
+        return []
+
+    def clear(self) -> None:
+        pass
+
+    def update(self, *args, **kwargs) -> None:
+        pass
+
+    def insert_rows(self, *args, **kwargs) -> None:
+        pass
+
+    def delete_rows(self, *args, **kwargs) -> None:
+        pass
+
+
+class NoopSpreadsheet:
+    """
+    A spreadsheet that keeps its worksheet titles but drops every value.
+    """
+
+    def __init__(self):
+        self._sheets = {}
+
+    def worksheet(self, title: str) -> NoopWorksheet:
+        if title not in self._sheets:
+            raise gspread.WorksheetNotFound(title)
+        return NoopWorksheet(title)
+
+    def add_worksheet(self, title: str, rows: int, cols: int) -> NoopWorksheet:
+        self._sheets[title] = max(self._sheets.values(), default=0) + 1
+        return NoopWorksheet(title)
+
+    def worksheets(self) -> List[NoopWorksheet]:
+        return [NoopWorksheet(title) for title in self._sheets]
+
+    def del_worksheet(self, worksheet: NoopWorksheet) -> None:
+        self._sheets.pop(worksheet.title, None)
+
+    def fetch_sheet_metadata(self) -> dict:
+        return {
+            "sheets": [
+                {"properties": {"title": title, "sheetId": worksheet_id}}
+                for title, worksheet_id in self._sheets.items()
+            ]
+        }
+
+    def batch_update(self, body: dict) -> None:
+        for request in body["requests"]:
+            if "addSheet" in request:
+                properties = request["addSheet"]["properties"]
+                self._sheets[properties["title"]] = properties["sheetId"]
+            elif "deleteSheet" in request:
+                worksheet_id = request["deleteSheet"]["sheetId"]
+                self._sheets = {
+                    k: v for k, v in self._sheets.items() if v != worksheet_id
+                }
+
+    def values_batch_update(self, body: dict) -> None:
+        pass
+
+
+def get_sheet_id() -> Optional[str]:
+    return os.environ.get("SHEET_ID")
+
+
+@lru_cache(maxsize=None)
+def get_spreadsheet() -> Union[gspread.Spreadsheet, NoopSpreadsheet]:
+    # connect on first use, not at import
+    if SHEETS_BACKEND == "noop":
+        return NoopSpreadsheet()
+
+    credential_file = os.path.join(PROJECT_DIRECTORY, "credentials.json")
+    creds = Credentials.from_service_account_file(credential_file, scopes=_SCOPES)
+    client = gspread.authorize(creds)
+    return client.open_by_key(os.environ["SHEET_ID"])
+
+
+# fingerprints of the synced worksheets
+SHEET_STATE_DIRECTORY = os.environ.get(
+    "SHEET_STATE_DIRECTORY", os.path.join(PROJECT_DIRECTORY, "data", ".sheet_state")
+)
+
+# versioned copies of what was published, for rollback and restores
+SHEET_SNAPSHOT_DIRECTORY = os.environ.get(
+    "SHEET_SNAPSHOT_DIRECTORY",
+    os.path.join(PROJECT_DIRECTORY, "data", ".sheet_snapshots"),
+)
+SHEET_SNAPSHOT_RETENTION = int(os.environ.get("SHEET_SNAPSHOT_RETENTION", 30))
+
+
+def _sheet_state_path(sheet_name: str) -> str:
+    return os.path.join(
+        SHEET_STATE_DIRECTORY, re.sub(r"[^\w-]", "_", sheet_name) + ".json"
+    )
+
+
+def _load_sheet_state(sheet_name: str) -> Optional[dict]:
+    try:
+        with open(_sheet_state_path(sheet_name), "r", encoding="utf-8") as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        return None
+
+    # a state of another spreadsheet is useless
+    return state if state.get("spreadsheet") == get_sheet_id() else None
+
+
+def _save_sheet_state(
+    sheet_name: str, header: List[str], row_hashes: List[int]
+) -> None:
+    os.makedirs(SHEET_STATE_DIRECTORY, exist_ok=True)
+    path = _sheet_state_path(sheet_name)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(
+            {"spreadsheet": get_sheet_id(), "header": header, "rows": row_hashes},
+            file,
+            ensure_ascii=False,
+        )
+    os.replace(path + ".tmp", path)
+
+
+def _remove_sheet_state(sheet_name: str) -> None:
+    try:
+        os.remove(_sheet_state_path(sheet_name))
+    except FileNotFoundError:
+        pass
+
+
+def _snapshot_directory(sheet_name: str) -> str:
+    return os.path.join(SHEET_SNAPSHOT_DIRECTORY, re.sub(r"[^\w-]", "_", sheet_name))
+
+
+def list_snapshots(sheet_name: str) -> List[str]:
+    """
+    List the snapshot versions of a worksheet, from the oldest to the newest one.
+    """
+    try:
+        names = os.listdir(_snapshot_directory(sheet_name))
+    except FileNotFoundError:
+        return []
+
+    return sorted(
+        name[: -len(".json.gz")] for name in names if name.endswith(".json.gz")
+    )
+
+
+def load_snapshot(
+    sheet_name: str, version: Optional[str] = None
+) -> Optional[Tuple[List[str], List[list]]]:
+    """
+    Load a snapshot of what was published to a worksheet.
+
+    Args:
+        sheet_name (str): The name of the worksheet.
+        version (Optional[str]): The version to load, the newest one by default.
+
+    Returns:
+        Optional[Tuple[List[str], List[list]]]: The header and the rows, or None if
+            there is no such snapshot.
+    """
+    versions = list_snapshots(sheet_name)
+    if version is None and versions:
+        version = versions[-1]
+    if version not in versions:
+        return None
+
+    path = os.path.join(_snapshot_directory(sheet_name), version + ".json.gz")
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        snapshot = json.load(file)
+
+    return snapshot["header"], snapshot["rows"]
+
+
+def _save_snapshot(sheet_name: str, header: List[str], rows: List[list]) -> None:
+    content = json.dumps(
+        {"spreadsheet": get_sheet_id(), "header": header, "rows": rows},
+        ensure_ascii=False,
+        default=str,
+    )
+    digest = hashlib.sha1(content.encode("utf-8")).hexdigest()[:12]
+
+    # an unchanged worksheet keeps its newest version
+    versions = list_snapshots(sheet_name)
+    if versions and versions[-1].endswith(digest):
+        return
+
+    directory = _snapshot_directory(sheet_name)
+    os.makedirs(directory, exist_ok=True)
+    version = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S%f}-{digest}"
+    path = os.path.join(directory, version + ".json.gz")
+    with gzip.open(path + ".tmp", "wt", encoding="utf-8") as file:
+        file.write(content)
+    os.replace(path + ".tmp", path)
+
+    # retain the newest versions only
+    for old_version in (versions + [version])[:-SHEET_SNAPSHOT_RETENTION]:
+        os.remove(os.path.join(directory, old_version + ".json.gz"))
+
+
+def _last_published(
+    sheet_name: str, worksheet: gspread.Worksheet
+) -> Tuple[List[str], List[list]]:
+    snapshot = load_snapshot(sheet_name)
+    if snapshot is not None:
+        return snapshot
+
+    # without a snapshot yet, the worksheet is downloaded once
+    last_df = DataFrame(worksheet.get_all_records())
+    header, rows = last_df.columns.values.tolist(), last_df.values.tolist()
+    _save_snapshot(sheet_name, header, rows)
+
+    return header, rows
+
+
+def restore_worksheet(sheet_name: str, version: Optional[str] = None) -> bool:
+    """
+    Rewrite a worksheet with one of its snapshots.
+
+    Args:
+        sheet_name (str): The name of the worksheet.
+        version (Optional[str]): The version to restore (see `list_snapshots`), the
+            newest one by default.
+
+    Returns:
+        bool: Whether the snapshot existed and was published.
+    """
+    snapshot = load_snapshot(sheet_name, version)
+    if snapshot is None:
+        return False
+
+    header, rows = snapshot
+    publisher = SheetPublisher()
+    publisher.replace(DataFrame(rows, columns=header), sheet_name)
+    return publisher.publish()
 
 
 def load_worksheet(
@@ -28,15 +281,19 @@ def load_worksheet(
 
     Args:
     sheet_name (str): The name of the worksheet to load or create.
-    spreadsheet (gspread.Spreadsheet): The spreadsheet object containing the worksheet.
 
     Returns:
     DataFrame: A DataFrame containing the worksheet data.
     """
-    try:
-        worksheet = spreadsheet.worksheet(sheet_name)
-    except gspread.WorksheetNotFound:
-        worksheet = spreadsheet.add_worksheet(title=sheet_name, rows=1000, cols=100)
+    worksheet = _worksheets.get(sheet_name)
+    if worksheet is None:
+        spreadsheet = get_spreadsheet()
+        try:
+            worksheet = spreadsheet.worksheet(sheet_name)
+        except gspread.WorksheetNotFound:
+            worksheet = spreadsheet.add_worksheet(title=sheet_name, rows=1000, cols=100)
+            _remove_sheet_state(sheet_name)
+        _worksheets[sheet_name] = worksheet
 
     if return_type == "sheet":
         return worksheet
@@ -49,32 +306,16 @@ def load_worksheet(
     return DataFrame(records)
 
 
-def update_worksheet(
-    dataframe: DataFrame,
-    sheet_name: str,
-    mode: Literal["update", "replace"] = "update",
-    sorted_by: Optional[str] = None,
-    ascending: bool = False,
-) -> None:
-    # load previous sheet
-    worksheet = load_worksheet(sheet_name=sheet_name, return_type="sheet")
-    last_df = load_worksheet(sheet_name=sheet_name, return_type="dataframe")
-
-    # update worksheet
-    if mode == "replace":
-        try:
-            worksheet.clear()
-        except Exception as exc:
-            worksheet.update(
-                [last_df.columns.values.tolist()] + last_df.values.tolist()
-            )
-
-    # preprocess df
+def _prepare_upload_df(
+    dataframe: DataFrame, sorted_by: Optional[str] = None, ascending: bool = False
+) -> DataFrame:
     upload_df = dataframe.copy()
 
     # sort df by datetime
     if sorted_by is not None:
-        upload_df = upload_df.sort_values(by=sorted_by, ascending=ascending)
+        upload_df = upload_df.sort_values(
+            by=sorted_by, ascending=ascending, kind="stable"
+        )
 
     # astype datetime to string
     datetime_columns = upload_df.select_dtypes(include=["datetime64[ns]"]).columns
@@ -87,26 +328,460 @@ def update_worksheet(
                 lambda x: ",".join(x) if isinstance(x, list) else x
             )
 
+    return upload_df
+
+
+def update_worksheet(
+    dataframe: DataFrame,
+    sheet_name: str,
+    mode: Literal["update", "replace", "sync"] = "update",
+    sorted_by: Optional[str] = None,
+    ascending: bool = False,
+) -> None:
+    if mode == "sync":
+        sync_worksheet(dataframe, sheet_name, sorted_by=sorted_by, ascending=ascending)
+        return
+
+    # load previous sheet, from its local snapshot
+    worksheet = load_worksheet(sheet_name=sheet_name, return_type="sheet")
+    last_header, last_rows = _last_published(sheet_name, worksheet)
+
+    # the fingerprint is rebuilt by the next sync
+    _remove_sheet_state(sheet_name)
+
+    # update worksheet
+    if mode == "replace":
+        try:
+            worksheet.clear()
+        except Exception as exc:
+            worksheet.update([last_header] + last_rows)
+
+    # preprocess df
+    upload_df = _prepare_upload_df(dataframe, sorted_by=sorted_by, ascending=ascending)
+
+    header, rows = upload_df.columns.values.tolist(), upload_df.values.tolist()
     try:
-        worksheet.update(
-            [upload_df.columns.values.tolist()] + upload_df.values.tolist()
-        )
+        worksheet.update([header] + rows)
     except Exception as exc:
         # logging error
         print(exc)
-        print(
-            f"Data:\n{[upload_df.columns.values.tolist()] + upload_df.values.tolist()}"
-        )
+        print(f"Data:\n{[header] + rows}")
 
         # load the old sheet
-        worksheet.update([last_df.columns.values.tolist()] + last_df.values.tolist())
+        worksheet.update([last_header] + last_rows)
+        return
+
+    # rows below the new ones are kept in update mode
+    if mode == "update":
+        rows = rows + last_rows[len(rows) :]
+    _save_snapshot(sheet_name, header, rows)
+
+
+def sync_worksheet(
+    dataframe: DataFrame,
+    sheet_name: str,
+    sorted_by: Optional[str] = None,
+    ascending: bool = False,
+    max_operations: int = 50,
+) -> bool:
+    """
+    Make a worksheet hold a DataFrame, uploading only what changed since the last sync.
+
+    See `SheetPublisher.sync`.
+    """
+    publisher = SheetPublisher()
+    publisher.sync(
+        dataframe,
+        sheet_name,
+        sorted_by=sorted_by,
+        ascending=ascending,
+        max_operations=max_operations,
+    )
+    return publisher.publish()
 
 
 def clean_spreadsheet(sheets: List[str]) -> None:
-    all_sheets = spreadsheet.worksheets()
-    for worksheet in all_sheets:
-        if worksheet.title not in sheets:
-            spreadsheet.del_worksheet(worksheet)
+    publisher = SheetPublisher()
+    publisher.keep_only(sheets)
+    publisher.publish()
+
+
+class SheetPublisher:
+    """
+    Collect the worksheet mutations of a run and publish them in one transaction.
+
+    Mutations are only recorded until `publish`, which then makes three requests
+    whatever the number of worksheets: one to read the spreadsheet metadata, one
+    `batch_update` for the structural changes (added and deleted worksheets,
+    inserted and deleted rows, cleared worksheets) and one `values_batch_update` for
+    the cell values.
+
+    Attributes:
+        spreadsheet (gspread.Spreadsheet): The spreadsheet to publish to, the
+            configured one by default.
+        _writes (Dict[str, dict]): The pending write of every worksheet.
+        _keep (Optional[List[str]]): The worksheets to keep, the others are deleted.
+    """
+
+    def __init__(self, spreadsheet: Optional[gspread.Spreadsheet] = None):
+        self.spreadsheet = spreadsheet or get_spreadsheet()
+        self._writes = {}
+        self._keep = None
+
+    def replace(
+        self,
+        dataframe: DataFrame,
+        sheet_name: str,
+        sorted_by: Optional[str] = None,
+        ascending: bool = False,
+    ) -> None:
+        """
+        Rewrite a worksheet with a DataFrame.
+        """
+        self._add_write(dataframe, sheet_name, sorted_by, ascending, None)
+
+    def sync(
+        self,
+        dataframe: DataFrame,
+        sheet_name: str,
+        sorted_by: Optional[str] = None,
+        ascending: bool = False,
+        max_operations: int = 50,
+        since: Optional[str] = None,
+    ) -> None:
+        """
+        Make a worksheet hold a DataFrame, uploading only what changed since the last sync.
+
+        A fingerprint of the synced worksheet (its header and a hash per row) is kept
+        locally. The rows are diffed against it: new rows are inserted, expired rows
+        are deleted and changed ranges are rewritten. The worksheet is rewritten
+        entirely when there is no fingerprint, the header changed or the diff needs
+        more than `max_operations` edits.
+
+        With `since`, the DataFrame only holds the rows whose `sorted_by` value is at or
+        after `since`: the older rows of the worksheet, at its bottom, are kept as
+        published and only the newer rows are diffed.
+
+        The fingerprint assumes the worksheet is only written by this module; writing
+        it with another mode drops the fingerprint.
+
+        Args:
+            dataframe (DataFrame): The rows the worksheet should hold.
+            sheet_name (str): The name of the worksheet.
+            sorted_by (Optional[str]): The column to sort the rows by. Defaults to None.
+            ascending (bool): Whether to sort in ascending order. Defaults to False.
+            max_operations (int): The number of edits above which the worksheet is
+                rewritten entirely. Defaults to 50.
+            since (Optional[str]): The first `sorted_by` value of the DataFrame, e.g. a
+                day, when it only holds the newest rows. Requires a descending order.
+                Defaults to None.
+        """
+        if since is not None and (sorted_by is None or ascending):
+            raise ValueError("`since` requires rows sorted in descending order")
+
+        self._add_write(
+            dataframe, sheet_name, sorted_by, ascending, max_operations, since
+        )
+
+    def keep_only(self, sheets: List[str]) -> None:
+        """
+        Delete every other worksheet when publishing.
+        """
+        self._keep = list(sheets)
+
+    def _add_write(
+        self,
+        dataframe: DataFrame,
+        sheet_name: str,
+        sorted_by: Optional[str],
+        ascending: bool,
+        max_operations: Optional[int],
+        since: Optional[str] = None,
+    ) -> None:
+        upload_df = _prepare_upload_df(
+            dataframe, sorted_by=sorted_by, ascending=ascending
+        )
+        header = upload_df.columns.values.tolist()
+        rows = upload_df.values.tolist()
+        row_hashes = [int(h) for h in hash_dataframe_rows(upload_df)]
+
+        state = _load_sheet_state(sheet_name) if max_operations is not None else None
+        if state is not None and state["header"] != header:
+            state = None
+        last_hashes = state["rows"] if state is not None else None
+
+        # the older rows are kept below the new ones, only the new ones are diffed
+        new_hashes = row_hashes
+        if since is not None:
+            older_rows, older_hashes, last_hashes = self._older_rows(
+                sheet_name, header, sorted_by, since, state
+            )
+            rows = rows + older_rows
+            row_hashes = row_hashes + older_hashes
+
+        # diff against the fingerprint of the worksheet
+        opcodes = None
+        if last_hashes is not None:
+            matcher = SequenceMatcher(None, last_hashes, new_hashes, autojunk=False)
+            opcodes = [op for op in matcher.get_opcodes() if op[0] != "equal"]
+            if len(opcodes) > max_operations:
+                opcodes = None
+
+        self._writes[sheet_name] = {
+            "header": header,
+            "rows": rows,
+            "row_hashes": row_hashes,
+            "opcodes": opcodes,
+        }
+
+    def _older_rows(
+        self,
+        sheet_name: str,
+        header: List[str],
+        sorted_by: str,
+        since: str,
+        state: Optional[dict],
+    ) -> Tuple[List[list], List[int], Optional[List[int]]]:
+        """
+        Read the published rows before `since`, at the bottom of a worksheet sorted in
+        descending order.
+
+        Returns:
+            Tuple[List[list], List[int], Optional[List[int]]]: The older rows, their
+                hashes, and the fingerprint of the newer rows, or None if there is no
+                fingerprint of the published rows.
+        """
+        published = load_snapshot(sheet_name)
+        if published is None:
+            try:
+                worksheet = self.spreadsheet.worksheet(sheet_name)
+            except gspread.WorksheetNotFound:
+                return [], [], None
+            published = _last_published(sheet_name, worksheet)
+
+        last_header, last_rows = published
+        if last_header != header:
+            # realign the columns by name
+            positions = [
+                last_header.index(col) if col in last_header else None for col in header
+            ]
+            last_rows = [
+                [row[i] if i is not None else "" for i in positions]
+                for row in last_rows
+            ]
+            state = None
+
+        col = header.index(sorted_by)
+        start = next(
+            # rows without a time are sorted last
+            (
+                i
+                for i, row in enumerate(last_rows)
+                if str(row[col]) < since or str(row[col]) == "NaT"
+            ),
+            len(last_rows),
+        )
+        older_rows = last_rows[start:]
+        if state is not None and len(state["rows"]) == len(last_rows):
+            return older_rows, state["rows"][start:], state["rows"][:start]
+
+        older_hashes = []
+        if older_rows:
+            older_df = DataFrame(older_rows, columns=header)
+            older_hashes = [int(h) for h in hash_dataframe_rows(older_df)]
+        return older_rows, older_hashes, None
+
+    def publish(self, rollback: bool = True) -> bool:
+        """
+        Send every recorded mutation, then forget them.
+
+        The structural changes are atomic. If writing the values fails afterwards,
+        the written worksheets are restored from their local snapshots.
+
+        Args:
+            rollback (bool): Whether to restore the snapshots on failure. Defaults to
+                True.
+
+        Returns:
+            bool: Whether the mutations were published.
+        """
+        writes, keep = self._writes, self._keep
+        self._writes, self._keep = {}, None
+        if not writes and keep is None:
+            return True
+
+        metadata = self.spreadsheet.fetch_sheet_metadata()
+        sheets = {
+            sheet["properties"]["title"]: sheet["properties"]
+            for sheet in metadata["sheets"]
+        }
+        used_ids = {properties["sheetId"] for properties in sheets.values()}
+
+        requests = []
+        data = []
+        for sheet_name, write in writes.items():
+            header, rows, opcodes = write["header"], write["rows"], write["opcodes"]
+            num_rows, num_cols = len(rows) + 1, max(len(header), 1)
+
+            properties = sheets.get(sheet_name)
+            if properties is None:
+                # an explicit id lets the next requests refer to the new worksheet
+                worksheet_id = max(used_ids, default=0) + 1
+                used_ids.add(worksheet_id)
+                requests.append(
+                    {
+                        "addSheet": {
+                            "properties": {
+                                "sheetId": worksheet_id,
+                                "title": sheet_name,
+                                "gridProperties": {
+                                    "rowCount": max(num_rows, 1000),
+                                    "columnCount": max(num_cols, 100),
+                                },
+                            }
+                        }
+                    }
+                )
+                opcodes = None
+            else:
+                worksheet_id = properties["sheetId"]
+                grid = properties.get("gridProperties", {})
+                if opcodes is None and (
+                    grid.get("rowCount", 0) < num_rows
+                    or grid.get("columnCount", 0) < num_cols
+                ):
+                    requests.append(
+                        {
+                            "updateSheetProperties": {
+                                "properties": {
+                                    "sheetId": worksheet_id,
+                                    "gridProperties": {
+                                        "rowCount": max(
+                                            grid.get("rowCount", 0), num_rows
+                                        ),
+                                        "columnCount": max(
+                                            grid.get("columnCount", 0), num_cols
+                                        ),
+                                    },
+                                },
+                                "fields": "gridProperties(rowCount,columnCount)",
+                            }
+                        }
+                    )
+
+            if opcodes is None:
+                # rewrite the whole worksheet
+                if properties is not None:
+                    requests.append(
+                        {
+                            "updateCells": {
+                                "range": {"sheetId": worksheet_id},
+                                "fields": "userEnteredValue",
+                            }
+                        }
+                    )
+                data.append(
+                    {
+                        "range": absolute_range_name(sheet_name, "A1"),
+                        "values": [header] + rows,
+                    }
+                )
+                continue
+
+            # bottom-up, so the row indices of earlier edits stay valid; the header
+            # is the first row, so row i of the table is the row index i + 1
+            for _, i1, i2, j1, j2 in reversed(opcodes):
+                overlap = min(i2 - i1, j2 - j1)
+                start = i1 + overlap + 1
+                if i2 - i1 > overlap:
+                    requests.append(
+                        {
+                            "deleteDimension": {
+                                "range": _row_range(worksheet_id, start, i2 + 1)
+                            }
+                        }
+                    )
+                if j2 - j1 > overlap:
+                    requests.append(
+                        {
+                            "insertDimension": {
+                                "range": _row_range(
+                                    worksheet_id, start, start + j2 - j1 - overlap
+                                ),
+                                "inheritFromBefore": False,
+                            }
+                        }
+                    )
+
+            # values are written once the rows are in place, at their final rows
+            for _, i1, i2, j1, j2 in opcodes:
+                if j2 > j1:
+                    data.append(
+                        {
+                            "range": absolute_range_name(sheet_name, f"A{j1 + 2}"),
+                            "values": rows[j1:j2],
+                        }
+                    )
+
+        if keep is not None:
+            for title, properties in sheets.items():
+                if title not in keep and title not in writes:
+                    requests.append({"deleteSheet": {"sheetId": properties["sheetId"]}})
+
+        try:
+            if requests:
+                self.spreadsheet.batch_update({"requests": requests})
+        except Exception as exc:
+            # nothing changed, a batch update is atomic
+            print(exc)
+            return False
+
+        try:
+            if data:
+                self.spreadsheet.values_batch_update(
+                    {"valueInputOption": "RAW", "data": data}
+                )
+        except Exception as exc:
+            # the worksheets no longer match their fingerprints
+            print(exc)
+            for sheet_name in writes:
+                _remove_sheet_state(sheet_name)
+            if rollback:
+                self._restore_snapshots(list(writes))
+            return False
+
+        for sheet_name, write in writes.items():
+            _save_sheet_state(sheet_name, write["header"], write["row_hashes"])
+            _save_snapshot(sheet_name, write["header"], write["rows"])
+        if keep is not None:
+            for title in sheets:
+                if title not in keep and title not in writes:
+                    _remove_sheet_state(title)
+                    _worksheets.pop(title, None)
+
+        print(
+            f"Published {len(writes)} worksheets with {len(requests)} structural "
+            f"and {len(data)} value updates"
+        )
+        return True
+
+    def _restore_snapshots(self, sheet_names: List[str]) -> None:
+        publisher = SheetPublisher(self.spreadsheet)
+        for sheet_name in sheet_names:
+            if (snapshot := load_snapshot(sheet_name)) is not None:
+                header, rows = snapshot
+                publisher.replace(DataFrame(rows, columns=header), sheet_name)
+
+        publisher.publish(rollback=False)
+
+
+def _row_range(worksheet_id: int, start: int, end: int) -> dict:
+    return {
+        "sheetId": worksheet_id,
+        "dimension": "ROWS",
+        "startIndex": start,
+        "endIndex": end,
+    }
 
 
 # --------------------- Specific functions ---------------------
@@ -160,10 +835,8 @@ def sheet_to_df(raw_sheet: DataFrame) -> DataFrame:
 
     # convert string -> list[str]
     for col in ["user", "purpose"]:
-        try:
-            df[col] = df[col].apply(lambda x: x.split(",") if "," in x else [x])
-        except Exception as exc:
-            continue
+        if col in df.columns:
+            df[col] = df[col].astype(str).str.split(",")
 
     return df
 
@@ -1,8 +1,7 @@
 import logging
+import os
 import re
-import time
 from ast import literal_eval
-from threading import Condition, Lock
 from typing import Dict, List, Optional
 
 from langchain.prompts import ChatPromptTemplate, PromptTemplate
@@ -12,58 +11,93 @@ from langchain_groq import ChatGroq
 from langchain_mistralai import ChatMistralAI
 from pydantic import BaseModel
 
+from rate_limiter import get_rate_limiter
+from utils import estimate_tokens
+
+
+# keys of the llm config read by the rate limiter, not by the models
+RATE_LIMIT_KEYS = ("max_request_per_minute", "max_token_per_minute")
+
+
+def _get_api_key(provider: str, llm_config: dict) -> Optional[str]:
+    env_key = (
+        "SAMBANOVA_API_KEY" if provider == "snc" else provider.upper() + "_API_KEY"
+    )
+    return (
+        llm_config.get("api_key")
+        or llm_config.get(env_key.lower())
+        or os.getenv(env_key)
+    )
+
+
+def _get_model_config(llm_config: dict) -> dict:
+    return {k: v for k, v in llm_config.items() if k not in RATE_LIMIT_KEYS}
+
 
 class LLMCaller:
     """
     A class to manage the rate of requests to an LLM.
 
-    This class implements a simple rate limiting mechanism to prevent exceeding the maximum number of requests per minute allowed by the LLM API.
+    Requests are admitted by a process-wide `RateLimiter`, shared by every caller of the same provider, model and
+    API key, which limits both the requests and the (estimated) tokens sent per minute. Limits default to the ones
+    given by the subclass and can be overridden by the `max_request_per_minute` and `max_token_per_minute` keys of
+    the llm config.
 
     Attributes:
         max_request_per_minute (int): The maximum number of requests allowed per minute.
-        _request_counter (int): The number of requests made in the current minute.
-        _last_reset_time (float): The timestamp of the last time the request counter was reset.
-        _state_lock (Lock): A lock to protect the request counter and last reset time from concurrent access.
-        _condition (Condition): A condition variable to coordinate waiting between threads.
+        max_token_per_minute (Optional[int]): The maximum number of tokens allowed per minute, if any.
+        limiter (RateLimiter): The rate limiter shared with the callers of the same API key.
     """
 
-    _request_counter = 0
-    _last_reset_time = 0.0
-
-    def __init__(self, max_request_per_minute: int):
-        self.max_request_per_minute = max_request_per_minute
-        self._state_lock = Lock()
-        self._condition = Condition(self._state_lock)
-
-    def _reset_counter(self) -> None:
-        current_time = time.time()
-        if self._last_reset_time == 0.0 or current_time - self._last_reset_time >= 60:
-            self._request_counter = 0
-            self._last_reset_time = current_time
-
-    def _wait_to_next_minute(self) -> None:
+    def __init__(
+        self,
+        provider: str,
+        llm_config: dict,
+        max_request_per_minute: int,
+        max_token_per_minute: Optional[int] = None,
+    ):
+        self.max_request_per_minute = llm_config.get(
+            "max_request_per_minute", max_request_per_minute
+        )
+        self.max_token_per_minute = llm_config.get(
+            "max_token_per_minute", max_token_per_minute
+        )
+        self.limiter = get_rate_limiter(
+            provider,
+            llm_config.get("model", llm_config.get("model_name")),
+            _get_api_key(provider, llm_config),
+            self.max_request_per_minute,
+            self.max_token_per_minute,
+        )
+
+    def _estimate_tokens(self, input: dict) -> int:
+        # the response repeats the messages of the input
+        return estimate_tokens(self.prompt.pretty_repr()) + 2 * estimate_tokens(
+            str(input)
+        )
+
+    def _increment_counter(self, num_request: int, num_token: int = 0) -> None:
         """
-        Wait until the start of the next minute.
+        Wait until the rate limiter admits the requests.
         """
-        with self._state_lock:
-            wait_time = max(0, self._last_reset_time + 60 - time.time())
-            if wait_time > 0:
-                self._condition.wait(timeout=wait_time)
-            self._reset_counter()
+        self.limiter.acquire(num_request, num_token)
 
-    def _increment_counter(self, num_request: int) -> None:
-        """
-        Increment the request counter and wait if the limit is reached.
+    async def _async_increment_counter(
+        self, num_request: int, num_token: int = 0
+    ) -> None:
+        await self.limiter.async_acquire(num_request, num_token)
 
-        This method increments the internal request counter by the specified number of requests.
-        If the total number of requests exceeds the maximum allowed per minute, it waits until the start of the next minute before incrementing the counter.
+    def _wait_to_next_minute(self, num_token: int = 0) -> None:
         """
-        with self._state_lock:
-            self._reset_counter()
-            while self._request_counter + num_request > self.max_request_per_minute:
-                self._wait_to_next_minute()
-            self._request_counter += num_request
-            self._condition.notify_all()
+        Pause every caller of the API key for a minute, then wait until the retried
+        request is admitted.
+        """
+        self.limiter.pause()
+        self.limiter.acquire(1, num_token)
+
+    async def _async_wait_to_next_minute(self, num_token: int = 0) -> None:
+        self.limiter.pause()
+        await self.limiter.async_acquire(1, num_token)
 
 
 class GroqAICaller(LLMCaller):
@@ -80,10 +114,10 @@ class GroqAICaller(LLMCaller):
     """
 
     def __init__(self, llm_config: dict, prompt: ChatPromptTemplate):
-        super().__init__(max_request_per_minute=30)
+        super().__init__("groq", llm_config, max_request_per_minute=30)
 
         config = {"max_retries": 0}
-        config.update(llm_config)
+        config.update(_get_model_config(llm_config))
 
         self.llm = ChatGroq(**config)
         self.prompt = prompt
@@ -127,14 +161,15 @@ class GroqAICaller(LLMCaller):
         Returns:
             str: The response from the LLM.
         """
-        self._increment_counter(1)
+        num_token = self._estimate_tokens(input)
+        self._increment_counter(1, num_token)
         chain = self.get_chain(response_format)
         try:
             result = chain.invoke(input)
         except Exception as exc:
             if self._extract_error_code(exc) == 429:
                 logging.info("Reaching maximum resources, wait to next minutes!")
-                self._wait_to_next_minute()
+                self._wait_to_next_minute(num_token)
 
             result = chain.invoke(input)
 
@@ -142,6 +177,37 @@ class GroqAICaller(LLMCaller):
             return result.content
         return result
 
+    async def ainvoke(
+        self, input: dict, response_format: Optional[BaseModel] = None
+    ) -> str:
+        """
+        Invoke the Groq AI LLM with the given input, asynchronously.
+
+        This method increments the request counter, invokes the LLM with the given input, and handles potential errors.
+        If a 429 error (rate limit exceeded) is encountered, it sleeps until the next minute before retrying the request.
+
+        Args:
+            input (dict): The input to provide to the LLM.
+
+        Returns:
+            str: The response from the LLM.
+        """
+        num_token = self._estimate_tokens(input)
+        await self._async_increment_counter(1, num_token)
+        chain = self.get_chain(response_format)
+        try:
+            result = await chain.ainvoke(input)
+        except Exception as exc:
+            if self._extract_error_code(exc) == 429:
+                logging.info("Reaching maximum resources, wait to next minutes!")
+                await self._async_wait_to_next_minute(num_token)
+
+            result = await chain.ainvoke(input)
+
+        if response_format is None:
+            return result.content
+        return result
+
 
 class GoogleAICaller(LLMCaller):
     """
@@ -159,10 +225,10 @@ class GoogleAICaller(LLMCaller):
             llm_config (dict): A dictionary containing the configuration for the Google Generative AI LLM.
             prompt (PromptTemplate): The prompt template to use for invoking the LLM.
         """
-        super().__init__(max_request_per_minute=15)
+        super().__init__("google", llm_config, max_request_per_minute=15)
 
         config = {"max_retries": 0}
-        config.update(llm_config)
+        config.update(_get_model_config(llm_config))
 
         self.llm = ChatGoogleGenerativeAI(**config)
         self.prompt = prompt
@@ -206,14 +272,15 @@ class GoogleAICaller(LLMCaller):
         Returns:
             str: The response from the LLM.
         """
-        self._increment_counter(1)
+        num_token = self._estimate_tokens(input)
+        self._increment_counter(1, num_token)
         chain = self.get_chain(response_format)
         try:
             result = chain.invoke(input)
         except Exception as exc:
             if self._extract_error_code(exc) == 429:
                 logging.info("Reaching maximum resources, wait to next minutes!")
-                self._wait_to_next_minute()
+                self._wait_to_next_minute(num_token)
 
             result = chain.invoke(input)
 
@@ -221,27 +288,58 @@ class GoogleAICaller(LLMCaller):
             return result.content
         return result
 
+    async def ainvoke(
+        self, input: dict, response_format: Optional[BaseModel] = None
+    ) -> str:
+        """
+        Invoke the Google Generative AI LLM with the given input, asynchronously.
+
+        This method increments the request counter, invokes the LLM with the given input, and handles potential errors.
+        If a 429 error (rate limit exceeded) is encountered, it sleeps until the next minute before retrying the request.
+
+        Args:
+            input (dict): The input to provide to the LLM.
+
+        Returns:
+            str: The response from the LLM.
+        """
+        num_token = self._estimate_tokens(input)
+        await self._async_increment_counter(1, num_token)
+        chain = self.get_chain(response_format)
+        try:
+            result = await chain.ainvoke(input)
+        except Exception as exc:
+            if self._extract_error_code(exc) == 429:
+                logging.info("Reaching maximum resources, wait to next minutes!")
+                await self._async_wait_to_next_minute(num_token)
+
+            result = await chain.ainvoke(input)
+
+        if response_format is None:
+            return result.content
+        return result
+
 
 class SambaNovaCloudAICaller(LLMCaller):
     """
-    A class to call the Google Generative AI LLM.
+    A class to call the SambaNova Cloud LLM.
 
-    This class inherits from LLMCaller and provides a wrapper for invoking the Google Generative AI LLM.
+    This class inherits from LLMCaller and provides a wrapper for invoking the SambaNova Cloud LLM.
     It handles rate limiting and error handling, and provides a consistent interface for invoking the LLM.
     """
 
     def __init__(self, llm_config: dict, prompt: PromptTemplate):
         """
-        Initialize the GoogleAICaller object.
+        Initialize the SambaNovaCloudAICaller object.
 
         Args:
-            llm_config (dict): A dictionary containing the configuration for the Google Generative AI LLM.
+            llm_config (dict): A dictionary containing the configuration for the SambaNova Cloud LLM.
             prompt (PromptTemplate): The prompt template to use for invoking the LLM.
         """
-        super().__init__(max_request_per_minute=15)
+        super().__init__("snc", llm_config, max_request_per_minute=15)
 
         config = {"max_retries": 0}
-        config.update(llm_config)
+        config.update(_get_model_config(llm_config))
 
         self.llm = ChatSambaNovaCloud(**config)
         self.prompt = prompt
@@ -276,7 +374,7 @@ class SambaNovaCloudAICaller(LLMCaller):
 
     def invoke(self, input: dict, response_format: Optional[BaseModel] = None) -> str:
         """
-        Invoke the Google Generative AI LLM with the given input.
+        Invoke the SambaNova Cloud LLM with the given input.
 
         This method increments the request counter, invokes the LLM with the given input, and handles potential errors.
         If a 429 error (rate limit exceeded) is encountered, it waits until the next minute before retrying the request.
@@ -287,14 +385,15 @@ class SambaNovaCloudAICaller(LLMCaller):
         Returns:
             str: The response from the LLM.
         """
-        self._increment_counter(1)
+        num_token = self._estimate_tokens(input)
+        self._increment_counter(1, num_token)
         chain = self.get_chain(response_format)
         try:
             result = chain.invoke(input)
         except Exception as exc:
             if self._extract_error_code(exc) == 429:
                 logging.info("Reaching maximum resources, wait to next minutes!")
-                self._wait_to_next_minute()
+                self._wait_to_next_minute(num_token)
 
             result = chain.invoke(input)
 
@@ -302,6 +401,37 @@ class SambaNovaCloudAICaller(LLMCaller):
             return result.content
         return result
 
+    async def ainvoke(
+        self, input: dict, response_format: Optional[BaseModel] = None
+    ) -> str:
+        """
+        Invoke the SambaNova Cloud LLM with the given input, asynchronously.
+
+        This method increments the request counter, invokes the LLM with the given input, and handles potential errors.
+        If a 429 error (rate limit exceeded) is encountered, it sleeps until the next minute before retrying the request.
+
+        Args:
+            input (dict): The input to provide to the LLM.
+
+        Returns:
+            str: The response from the LLM.
+        """
+        num_token = self._estimate_tokens(input)
+        await self._async_increment_counter(1, num_token)
+        chain = self.get_chain(response_format)
+        try:
+            result = await chain.ainvoke(input)
+        except Exception as exc:
+            if self._extract_error_code(exc) == 429:
+                logging.info("Reaching maximum resources, wait to next minutes!")
+                await self._async_wait_to_next_minute(num_token)
+
+            result = await chain.ainvoke(input)
+
+        if response_format is None:
+            return result.content
+        return result
+
 
 class MistralAICaller(LLMCaller):
     """
@@ -319,10 +449,10 @@ class MistralAICaller(LLMCaller):
             llm_config (dict): A dictionary containing the configuration for the Mistral AI LLM.
             prompt (PromptTemplate): The prompt template to use for invoking the LLM.
         """
-        super().__init__(max_request_per_minute=llm_config.get("max_request_per_minute", 15))
+        super().__init__("mistral", llm_config, max_request_per_minute=15)
 
         config = {"max_retries": 0}
-        config.update(llm_config)
+        config.update(_get_model_config(llm_config))
 
         self.llm = ChatMistralAI(**config)
         self.prompt = prompt
@@ -374,14 +504,15 @@ class MistralAICaller(LLMCaller):
         Returns:
             str: The response from the LLM.
         """
-        self._increment_counter(1)
+        num_token = self._estimate_tokens(input)
+        self._increment_counter(1, num_token)
         chain = self.get_chain(response_format)
         try:
             result = chain.invoke(input)
         except Exception as exc:
             if self._extract_error_code(exc) == 429:
                 logging.info("Reaching maximum resources, wait to next minutes!")
-                self._wait_to_next_minute()
+                self._wait_to_next_minute(num_token)
                 result = chain.invoke(input)
             else:
                 logging.exception("An error occurred during LLM invocation.")  # Log the full traceback
@@ -389,3 +520,37 @@ class MistralAICaller(LLMCaller):
         if response_format is None:
             return result.content
         return result
+
+    async def ainvoke(
+        self, input: dict, response_format: Optional[BaseModel] = None
+    ) -> str:
+        """
+        Invoke the Mistral AI LLM with the given input, asynchronously.
+
+        This method increments the request counter, invokes the LLM with the given input, and handles potential errors.
+        If a 429 error (rate limit exceeded) is encountered, it sleeps until the next minute before retrying the request.
+        If any other error is encountered during the initial invocation, it logs the error and re-raises the exception.
+
+        Args:
+            input (dict): The input to provide to the LLM.
+            response_format (Optional[BaseModel]): The expected response format.
+
+        Returns:
+            str: The response from the LLM.
+        """
+        num_token = self._estimate_tokens(input)
+        await self._async_increment_counter(1, num_token)
+        chain = self.get_chain(response_format)
+        try:
+            result = await chain.ainvoke(input)
+        except Exception as exc:
+            if self._extract_error_code(exc) == 429:
+                logging.info("Reaching maximum resources, wait to next minutes!")
+                await self._async_wait_to_next_minute(num_token)
+                result = await chain.ainvoke(input)
+            else:
+                logging.exception("An error occurred during LLM invocation.")  # Log the full traceback
+                raise
+        if response_format is None:
+            return result.content
+        return result
@@ -0,0 +1,261 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from functools import lru_cache
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+from langchain.prompts import ChatPromptTemplate
+
+from utils import PROJECT_DIRECTORY
+
+LLM_CACHE_PATH = os.environ.get(
+    "LLM_CACHE_PATH", os.path.join(PROJECT_DIRECTORY, "data", "llm_cache.db")
+)
+LLM_CACHE_TTL = float(os.environ.get("LLM_CACHE_TTL", 7 * 24 * 60 * 60))
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 50000))
+LLM_MEMO_TTL = float(os.environ.get("LLM_MEMO_TTL", 30 * 24 * 60 * 60))
+
+
+def prompt_hash(prompt: ChatPromptTemplate) -> str:
+    return hashlib.sha256(prompt.pretty_repr().encode("utf-8")).hexdigest()
+
+
+def make_cache_key(
+    provider: str, model: Optional[str], prompt: ChatPromptTemplate, batch: List[Any]
+) -> str:
+    """
+    Build the key of an LLM response.
+
+    The batch is serialized canonically but its texts are kept as they are, since the
+    responses repeat them and are matched against them. The expected output format is
+    part of the prompt, the requests carry no other schema.
+    """
+    content = json.dumps(
+        [provider, model, prompt_hash(prompt), batch],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    A persistent cache of LLM responses, shared by every stage and run.
+
+    Responses are stored in a SQLite database. Entries older than `ttl` seconds are
+    ignored and removed, and the least recently used entries are evicted once the
+    cache holds more than `max_entries`. Hits and misses are counted to report the hit
+    rate.
+
+    Attributes:
+        path (str): The path of the database file.
+        ttl (float): The lifetime of an entry, in seconds.
+        max_entries (int): The number of entries above which entries are evicted.
+        hits (int): The number of hits since the cache was opened.
+        misses (int): The number of misses since the cache was opened.
+        _conn (sqlite3.Connection): The connection to the database.
+        _lock (Lock): A lock to share the connection between threads.
+        _num_writes (int): The number of writes since the last eviction.
+    """
+
+    def __init__(
+        self,
+        path: str = LLM_CACHE_PATH,
+        ttl: float = LLM_CACHE_TTL,
+        max_entries: int = LLM_CACHE_MAX_ENTRIES,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._num_writes = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+
+        return row[0]
+
+    def set(self, key: str, response: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT OR REPLACE INTO responses (key, response, created_at, accessed_at)
+                VALUES (?, ?, ?, ?)
+                """,
+                (key, response, now, now),
+            )
+
+            self._num_writes += 1
+            if self._num_writes >= 100:
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        self._num_writes = 0
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+            )
+
+            # keep the most recently used entries
+            num_entries = self._conn.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()[0]
+            if num_entries > self.max_entries:
+                self._conn.execute(
+                    """
+                    DELETE FROM responses WHERE key IN (
+                        SELECT key FROM responses ORDER BY accessed_at LIMIT ?
+                    )
+                    """,
+                    (num_entries - self.max_entries,),
+                )
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_llm_cache() -> LLMResponseCache:
+    return LLMResponseCache()
+
+
+class MessageResultMemo:
+    """
+    A persistent store of the result of every message, per pipeline stage.
+
+    Customers send the same short texts again and again, so results are kept by
+    normalized message text and a known message is resolved without calling the LLM.
+    Results are stored without the echoed message text, which is restored from the
+    message being resolved.
+
+    Attributes:
+        path (str): The path of the database file.
+        ttl (float): The lifetime of a result, in seconds.
+        _conn (sqlite3.Connection): The connection to the database.
+        _lock (Lock): A lock to share the connection between threads.
+    """
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl: float = LLM_MEMO_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS message_results (
+                stage TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                text TEXT NOT NULL,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (stage, prompt, text)
+            ) WITHOUT ROWID
+            """
+        )
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def get_many(self, stage: str, prompt: str, texts: List[str]) -> Dict[str, dict]:
+        """
+        Look up the results of normalized texts.
+
+        Returns:
+            Dict[str, dict]: The known results, by text.
+        """
+        results = {}
+        min_created_at = time.time() - self.ttl
+        with self._lock:
+            for text in set(texts):
+                row = self._conn.execute(
+                    """
+                    SELECT result FROM message_results
+                    WHERE stage = ? AND prompt = ? AND text = ? AND created_at >= ?
+                    """,
+                    (stage, prompt, text, min_created_at),
+                ).fetchone()
+                if row is not None:
+                    results[text] = json.loads(row[0])
+
+        return results
+
+    def set_many(self, stage: str, prompt: str, results: Dict[str, dict]) -> None:
+        now = time.time()
+        rows = [
+            (stage, prompt, text, json.dumps(result, ensure_ascii=False), now)
+            for text, result in results.items()
+        ]
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                """
+                INSERT OR REPLACE INTO message_results
+                (stage, prompt, text, result, created_at) VALUES (?, ?, ?, ?, ?)
+                """,
+                rows,
+            )
+            self._conn.execute(
+                "DELETE FROM message_results WHERE created_at < ?", (now - self.ttl,)
+            )
+
+
+@lru_cache(maxsize=None)
+def get_message_memo() -> MessageResultMemo:
+    return MessageResultMemo()
@@ -0,0 +1,163 @@
+import json
+import os
+import sqlite3
+from typing import Any, List
+
+from utils import *
+
+
+class MessageQueue:
+    """
+    An append-only, indexed store for the messages waiting to be analysed.
+
+    Messages are kept in a SQLite database in WAL mode, so enqueueing appends rows
+    instead of rewriting a JSON file, and a crash never leaves a half-written queue.
+    Each row is keyed by the message id, enqueueing a message twice is a no-op, and
+    `inserted_at` is indexed for dequeueing the newest messages and for retention.
+
+    The database also keeps the ids of every message seen by the pipeline, so a
+    message crawled again in a later run is not analysed twice.
+
+    Attributes:
+        path (str): The path of the database file.
+        _conn (sqlite3.Connection): The connection to the database.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                hash TEXT NOT NULL UNIQUE,
+                inserted_at INTEGER NOT NULL,
+                payload TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS queue_inserted_at ON queue (inserted_at)"
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS seen (
+                hash TEXT PRIMARY KEY,
+                inserted_at INTEGER NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS seen_inserted_at ON seen (inserted_at)"
+        )
+
+    def __enter__(self) -> "MessageQueue":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def enqueue(self, messages: List[dict]) -> int:
+        """
+        Append messages to the queue, skipping those already queued.
+
+        Returns:
+            int: The number of appended messages.
+        """
+        timestamps = strings_to_unix_seconds([m["inserted_at"] for m in messages])
+        rows = [
+            (get_message_id(m), timestamp, json.dumps(m, ensure_ascii=False))
+            for m, timestamp in zip(messages, timestamps)
+        ]
+
+        before = self._conn.total_changes
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO queue (hash, inserted_at, payload) VALUES (?, ?, ?)",
+                rows,
+            )
+
+        return self._conn.total_changes - before
+
+    def mark_seen(self, messages: List[dict]) -> List[dict]:
+        """
+        Record messages as seen.
+
+        Returns:
+            List[dict]: The messages never seen before, in their original order.
+        """
+        timestamps = strings_to_unix_seconds([m["inserted_at"] for m in messages])
+        unseen = []
+        with self._conn:
+            self._conn.execute("BEGIN")
+            for m, timestamp in zip(messages, timestamps):
+                cursor = self._conn.execute(
+                    "INSERT OR IGNORE INTO seen (hash, inserted_at) VALUES (?, ?)",
+                    (get_message_id(m), timestamp),
+                )
+                if cursor.rowcount:
+                    unseen.append(m)
+
+        return unseen
+
+    def dequeue(self, num_messages: int) -> List[dict]:
+        """
+        Remove the newest messages from the queue.
+
+        Returns:
+            List[dict]: The removed messages, from the oldest to the newest one.
+        """
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            rows = self._conn.execute(
+                "SELECT id, payload FROM queue ORDER BY inserted_at DESC, id DESC LIMIT ?",
+                (num_messages,),
+            ).fetchall()
+            self._conn.executemany(
+                "DELETE FROM queue WHERE id = ?", [(row[0],) for row in rows]
+            )
+
+        return [json.loads(row[1]) for row in reversed(rows)]
+
+    def delete_before(self, timestamp: int) -> int:
+        """
+        Remove the messages, queued or seen, inserted at or before `timestamp` (unix
+        seconds).
+
+        Returns:
+            int: The number of removed queued messages.
+        """
+        with self._conn:
+            self._conn.execute("BEGIN")
+            cursor = self._conn.execute(
+                "DELETE FROM queue WHERE inserted_at <= ?", (timestamp,)
+            )
+            self._conn.execute("DELETE FROM seen WHERE inserted_at <= ?", (timestamp,))
+
+        return cursor.rowcount
+
+
+def get_queue_path(config: dict) -> str:
+    default_path = os.path.splitext(config["queue-message"])[0] + ".db"
+    return get_project_path(config.get("queue-database", default_path))
+
+
+def open_message_queue(config: dict) -> MessageQueue:
+    queue = MessageQueue(get_queue_path(config))
+
+    # import the legacy JSON queue once
+    legacy_path = get_project_path(config["queue-message"])
+    if os.path.exists(legacy_path) and legacy_path.endswith(".json"):
+        queue.enqueue(load_json(legacy_path))
+        os.replace(legacy_path, legacy_path + ".migrated")
+
+    return queue
@@ -1,18 +1,293 @@
+import asyncio
 import concurrent.futures
 import json
 import os
 import re
+import time
 from concurrent.futures import ThreadPoolExecutor
-from typing import Any, List, Literal, Optional, Union
+from functools import lru_cache
+from threading import Lock
+from typing import (Any, AsyncIterator, Iterator, List, Literal, Optional,
+                    Tuple, Union)
+from urllib.parse import urlsplit
 
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
 from tenacity import retry, stop_after_attempt, wait_exponential
 from tqdm import tqdm
 
 from utils import *
 
+PANCAKE_BASE_URL = "https://pages.fm"
+
+
+def get_pancake_url(path: str) -> str:
+    # `PANCAKE_BASE_URL` points the crawl at another server, e.g. `pancake_stub.py`
+    base_url = os.getenv("PANCAKE_BASE_URL", PANCAKE_BASE_URL)
+    return base_url.rstrip("/") + path
+
+
+class _TokenBucket:
+    """
+    A token bucket whose refill rate can be adjusted at runtime.
+
+    Attributes:
+        rate (float): The number of tokens refilled per second.
+        tokens (float): The number of tokens currently available.
+        blocked_until (float): A time before which no token is handed out.
+        last_refill (float): The time of the last refill.
+        last_decrease (float): The time of the last multiplicative decrease.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = 1.0
+        self.blocked_until = 0.0
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0.0
+
+    def refill(self, now: float) -> None:
+        # allow a burst of at most one second of requests
+        capacity = max(1.0, self.rate)
+        self.tokens = min(capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def wait_time(self, now: float) -> float:
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+
+class AdaptiveRateLimiter:
+    """
+    A process-wide AIMD rate limiter for the Pancake API.
+
+    Every request takes one token from the global bucket and one from the bucket of its
+    page access token. A 429 or 5xx response decreases the rate of both buckets
+    multiplicatively, a successful response increases it additively (about
+    `additive_increase` requests per second for every second of successes), so the crawl
+    settles close to the real API ceiling instead of alternating bursts and stalls.
+
+    Attributes:
+        global_rate (float): The initial global rate, in requests per second.
+        key_rate (float): The initial rate of each page access token.
+        min_rate (float): The lowest rate a bucket can decrease to.
+        max_global_rate (float): The highest global rate.
+        max_key_rate (float): The highest rate of each page access token.
+        additive_increase (float): The rate gained per second of successful requests.
+        multiplicative_decrease (float): The factor applied to the rate on throttling.
+        decrease_cooldown (float): The minimum number of seconds between two decreases,
+            so a burst of throttled in-flight requests counts as one congestion event.
+        _global_bucket (_TokenBucket): The bucket shared by all requests.
+        _key_buckets (dict[str, _TokenBucket]): The buckets, keyed by page access token.
+        _lock (Lock): A lock to protect the buckets.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = 20.0,
+        key_rate: float = 5.0,
+        min_rate: float = 0.5,
+        max_global_rate: float = 100.0,
+        max_key_rate: float = 20.0,
+        additive_increase: float = 1.0,
+        multiplicative_decrease: float = 0.5,
+        decrease_cooldown: float = 1.0,
+    ):
+        self.global_rate = global_rate
+        self.key_rate = key_rate
+        self.min_rate = min_rate
+        self.max_global_rate = max(max_global_rate, global_rate)
+        self.max_key_rate = max(max_key_rate, key_rate)
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.decrease_cooldown = decrease_cooldown
+        self._global_bucket = _TokenBucket(global_rate)
+        self._key_buckets = {}
+        self._lock = Lock()
+
+    def _get_buckets(self, key: Optional[str]) -> List[_TokenBucket]:
+        if key is None:
+            return [self._global_bucket]
+
+        if key not in self._key_buckets:
+            self._key_buckets[key] = _TokenBucket(self.key_rate)
+        return [self._global_bucket, self._key_buckets[key]]
+
+    def _reserve(self, key: Optional[str]) -> float:
+        """
+        Take a token from every bucket of `key` if all of them have one.
+
+        Returns:
+            float: 0.0 if the tokens were taken, otherwise the number of seconds to wait
+                before trying again.
+        """
+        now = time.monotonic()
+        with self._lock:
+            buckets = self._get_buckets(key)
+            for bucket in buckets:
+                bucket.refill(now)
+
+            wait_time = max(bucket.wait_time(now) for bucket in buckets)
+            if wait_time == 0.0:
+                for bucket in buckets:
+                    bucket.tokens -= 1.0
+
+        return wait_time
+
+    def acquire(self, key: Optional[str] = None) -> None:
+        while wait_time := self._reserve(key):
+            time.sleep(wait_time)
+
+    async def async_acquire(self, key: Optional[str] = None) -> None:
+        while wait_time := self._reserve(key):
+            await asyncio.sleep(wait_time)
+
+    def record(
+        self,
+        key: Optional[str],
+        status_code: int,
+        retry_after: Optional[str] = None,
+    ) -> None:
+        """
+        Adapt the rates of the buckets of `key` to the status of a response.
+
+        Args:
+            key (Optional[str]): The page access token used by the request.
+            status_code (int): The HTTP status code of the response.
+            retry_after (Optional[str]): The `Retry-After` header of the response, if any.
+        """
+        now = time.monotonic()
+        with self._lock:
+            buckets = self._get_buckets(key)
+            max_rates = [self.max_global_rate, self.max_key_rate]
+            for bucket, max_rate in zip(buckets, max_rates):
+                if status_code == 429 or status_code >= 500:
+                    if now - bucket.last_decrease >= self.decrease_cooldown:
+                        bucket.rate = max(
+                            self.min_rate, bucket.rate * self.multiplicative_decrease
+                        )
+                        bucket.last_decrease = now
+                elif status_code < 400:
+                    bucket.rate = min(
+                        max_rate, bucket.rate + self.additive_increase / bucket.rate
+                    )
+
+            # only the most specific budget honours `Retry-After`
+            if retry_after is not None and retry_after.isdigit():
+                bucket = buckets[-1]
+                bucket.blocked_until = max(bucket.blocked_until, now + int(retry_after))
+
+
+_rate_limiter = None
+_rate_limiter_lock = Lock()
+
+
+def get_rate_limiter() -> AdaptiveRateLimiter:
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = AdaptiveRateLimiter(
+                global_rate=float(os.getenv("PANCAKE_GLOBAL_RATE", 20)),
+                key_rate=float(os.getenv("PANCAKE_PAGE_RATE", 5)),
+            )
+
+    return _rate_limiter
+
+
+class PancakeClient:
+    """
+    A thread-safe HTTP client for the Pancake API.
+
+    The client keeps one pooled `requests.Session` per host, so the worker threads of
+    the crawl reuse keep-alive connections instead of opening a new TCP+TLS connection
+    on every request.
+
+    Attributes:
+        pool_size (int): The maximum number of pooled connections per host.
+        timeout (tuple[float, float]): The connect and read timeouts in seconds.
+        _sessions (dict[str, requests.Session]): The sessions, keyed by host.
+        _lock (Lock): A lock to protect the creation of sessions.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = NUM_WORKERS,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 60.0,
+    ):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self._sessions = {}
+        self._lock = Lock()
+
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+        session.headers.update(
+            {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+        )
+
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size, pool_block=True
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        return session
+
+    def get_session(self, url: str) -> requests.Session:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                self._sessions[host] = self._create_session()
+
+            return self._sessions[host]
+
+    def request(
+        self,
+        method: Literal["get", "post"],
+        url: str,
+        rate_key: Optional[str] = None,
+        **kwargs: Any,
+    ) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+
+        rate_limiter = get_rate_limiter()
+        rate_limiter.acquire(rate_key)
+        response = self.get_session(url).request(method.upper(), url, **kwargs)
+        rate_limiter.record(
+            rate_key, response.status_code, response.headers.get("Retry-After")
+        )
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=60))
+        return response
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+_pancake_client = None
+_pancake_client_lock = Lock()
+
+
+def get_pancake_client() -> PancakeClient:
+    global _pancake_client
+    with _pancake_client_lock:
+        if _pancake_client is None:
+            _pancake_client = PancakeClient(
+                connect_timeout=float(os.getenv("PANCAKE_CONNECT_TIMEOUT", 10)),
+                read_timeout=float(os.getenv("PANCAKE_READ_TIMEOUT", 60)),
+            )
+
+    return _pancake_client
+
+
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=10))
 def call_pancake_api(
     url: str,
     parameters: Optional[dict] = None,
@@ -35,13 +310,12 @@ def call_pancake_api(
     # Add any additional keyword arguments
     request_args.update(kwargs)
 
-    # Make the request
-    if call_type == "get":
-        response = requests.get(**request_args)
-    elif call_type == "post":
-        response = requests.post(**request_args)
-    else:
+    # Make the request through the shared, pooled and rate limited client
+    if call_type not in ("get", "post"):
         raise ValueError(f"Unsupported call_type: {call_type}")
+    response = get_pancake_client().request(
+        call_type, rate_key=request_params.get("page_access_token"), **request_args
+    )
 
     # check request status
     response.raise_for_status()
@@ -60,7 +334,7 @@ def call_pancake_api(
 def get_page(
     return_type: Literal["id", "standard", "full"] = "standard"
 ) -> Union[dict, list]:
-    request_page_list_url = "https://pages.fm/api/v1/pages"
+    request_page_list_url = get_pancake_url("/api/v1/pages")
     response = call_pancake_api(url=request_page_list_url, return_type="dictionary")
     if not response["success"]:
         raise Exception("Failed to get pages data from Pancake API.")
@@ -87,7 +361,7 @@ def get_page_access_token(page_info: dict) -> tuple[dict[str, str], list[str]]:
 
     # generate page's access token
     request_page_access_token = lambda page_id: call_pancake_api(
-        url=f"https://pages.fm/api/v1/pages/{page_id}/generate_page_access_token",
+        url=get_pancake_url(f"/api/v1/pages/{page_id}/generate_page_access_token"),
         call_type="post",
         return_type="dictionary",
     )
@@ -118,55 +392,153 @@ def get_page_access_token(page_info: dict) -> tuple[dict[str, str], list[str]]:
     return page_access_tokens, not_accessible_page_ids
 
 
-def get_page_conversations(
+def _conversations_request(
     page_id: str,
     page_access_token: str,
     since: int,
     until: int,
+    page_number: int,
     order_by: Literal["insert", "update"] = "update",
-    filter: List[str] = ["inbox", "comment", "rating"],
-):
-    # split the timestamp in case of the time range is longer than 1 month
-    timestamp_list = split_time_stamp(since, until)
+) -> dict:
+    return {
+        "url": get_pancake_url(f"/api/public_api/v1/pages/{page_id}/conversations"),
+        "parameters": {
+            "page_access_token": page_access_token,
+            "since": since,
+            "until": until,
+            "page_id": page_id,
+            "page_number": page_number,
+            "order_by": "updated_at" if order_by == "update" else "inserted_at",
+        },
+        "return_type": "dictionary",
+        "add_access_token": False,
+    }
+
+
+def _messages_request(
+    page_id: str,
+    page_access_token: str,
+    conversation_id: str,
+    customer_id: str,
+    current_count: int,
+) -> dict:
+    return {
+        "url": get_pancake_url(
+            f"/api/public_api/v1/pages/{page_id}/conversations/{conversation_id}/messages"
+        ),
+        "parameters": {
+            "current_count": current_count,
+            "page_access_token": page_access_token,
+            "customer_id": customer_id,
+            "conversation_id": conversation_id,
+            "page_id": page_id,
+        },
+        "return_type": "dictionary",
+        "add_access_token": False,
+    }
+
+
+# the number of conversations of a full page of the conversations API
+CONVERSATIONS_PAGE_SIZE = int(os.getenv("PANCAKE_CONVERSATIONS_PAGE_SIZE", 60))
+
+
+@lru_cache(maxsize=None)
+def _get_prefetch_executor() -> ThreadPoolExecutor:
+    # shared by every time range, so prefetching adds at most NUM_WORKERS threads
+    return ThreadPoolExecutor(max_workers=NUM_WORKERS, thread_name_prefix="prefetch")
+
+
+@lru_cache(maxsize=None)
+def _get_window_executor() -> ThreadPoolExecutor:
+    # shared by every page, so the time ranges of concurrent pages add at most
+    # NUM_WORKERS threads, window tasks only wait on the prefetch executor
+    return ThreadPoolExecutor(max_workers=NUM_WORKERS, thread_name_prefix="window")
+
+
+def _get_window_conversations(
+    page_id: str,
+    page_access_token: str,
+    since: int,
+    until: int,
+    order_by: Literal["insert", "update"] = "update",
+    prefetch: bool = False,
+) -> List[dict]:
+    fetch = lambda page_number: call_pancake_api(
+        **_conversations_request(
+            page_id, page_access_token, since, until, page_number, order_by
+        )
+    )
 
-    # loop over each time range
+    # go through all pages of response in this time range, with `prefetch` the next
+    # page is requested while the current one is being processed
     result = []
-    for s, u in timestamp_list:
-        # in each time range, go through all pages of response
-        page_number = 1
-        while True:
-            response = call_pancake_api(
-                url=f"https://pages.fm/api/public_api/v1/pages/{page_id}/conversations",
-                parameters={
-                    "page_access_token": page_access_token,
-                    "since": s,
-                    "until": u,
-                    "page_id": page_id,
-                    "page_number": page_number,
-                    "order_by": "updated_at" if order_by == "update" else "inserted_at",
-                },
-                return_type="dictionary",
-                add_access_token=False,
+    page_number = 1
+    next_response = None
+    while True:
+        response = next_response.result() if next_response else fetch(page_number)
+        next_response = None
+
+        if not response["success"]:
+            print(
+                f"UserWarning: Failed to get conversations for page {page_id}. Respone's message: {response['message']}"
             )
+            break
+        elif len(response["conversations"]) == 0:
+            break
 
-            if not response["success"]:
-                print(
-                    f"UserWarning: Failed to get conversations for page {page_id}. Respone's message: {response['message']}"
-                )
-                break
-            elif len(response["conversations"]) == 0:
-                break
+        # update result
+        result += response["conversations"]
 
-            # update result
-            result += response["conversations"]
+        if prefetch:
+            # a page that is not full is the last one
+            if len(response["conversations"]) < CONVERSATIONS_PAGE_SIZE:
+                break
+            next_response = _get_prefetch_executor().submit(fetch, page_number + 1)
 
-            # update `page_number`
-            page_number += 1
+        # update `page_number`
+        page_number += 1
 
-    result = [c for c in result if c["type"].lower() in filter]
     return result
 
 
+def _merge_conversations(windows: List[List[dict]], filter: List[str]) -> List[dict]:
+    # keep the order of time ranges, a conversation updated on a boundary may be
+    # returned by two time ranges
+    result = {}
+    for conversations in windows:
+        for c in conversations:
+            result.setdefault(c["id"], c)
+
+    return [c for c in result.values() if c["type"].lower() in filter]
+
+
+def get_page_conversations(
+    page_id: str,
+    page_access_token: str,
+    since: int,
+    until: int,
+    order_by: Literal["insert", "update"] = "update",
+    filter: List[str] = ["inbox", "comment", "rating"],
+    prefetch: bool = False,
+):
+    # split the timestamp in case of the time range is longer than 1 month
+    timestamp_list = split_time_stamp(since, until)
+    if not timestamp_list:
+        return []
+
+    # fetch all time ranges concurrently, `map` keeps the order of time ranges
+    windows = list(
+        _get_window_executor().map(
+            lambda window: _get_window_conversations(
+                page_id, page_access_token, *window, order_by, prefetch
+            ),
+            timestamp_list,
+        )
+    )
+
+    return _merge_conversations(windows, filter)
+
+
 def get_sender(
     sender_dict: dict, is_sender_patterns: Optional[list] = None
 ) -> Literal["customer", "admin"]:
@@ -174,14 +546,20 @@ def get_sender(
         return "admin"
 
     admin_patterns = ["Trường Bào Ngư"] + (is_sender_patterns or [])
-    for pattern in admin_patterns:
-        if re.search(pattern, sender_dict["name"]):
-            return "admin"
+    if get_pattern_matcher(admin_patterns, ignore_case=False).matches(
+        sender_dict["name"]
+    ):
+        return "admin"
 
     return "customer"
 
 
-def filter_message(message_response: dict, attrs: Optional[list] = None) -> dict:
+def filter_message(
+    message_response: dict,
+    attrs: Optional[list] = None,
+    page_id: Optional[str] = None,
+    conversation_id: Optional[str] = None,
+) -> dict:
     if not message_response["original_message"]:
         return None
 
@@ -190,6 +568,19 @@ def filter_message(message_response: dict, attrs: Optional[list] = None) -> dict
     result["message"] = message_response["original_message"]
     # time
     result["inserted_at"] = message_response["inserted_at"]
+    # identity, used to deduplicate across runs, from the sender id before it is
+    # collapsed to a role
+    result["message_id"] = message_hash(
+        {
+            "id": message_response.get("id"),
+            "page_id": page_id,
+            "conversation_id": conversation_id
+            or message_response.get("conversation_id"),
+            "from": message_response["from"].get("id"),
+            "inserted_at": message_response["inserted_at"],
+            "message": message_response["original_message"],
+        }
+    )
     # from
     result["from"] = get_sender(message_response["from"])
 
@@ -201,56 +592,301 @@ def filter_message(message_response: dict, attrs: Optional[list] = None) -> dict
     return result
 
 
-def get_messages(
+def _filter_message_page(
+    page: List[dict], since: int, until: int, page_id: str, conversation_id: str
+) -> Tuple[List[dict], bool]:
+    # a page is sorted from the oldest to the newest message
+    messages = []
+    for m in page:
+        timestamp = string_to_unix_second(m["inserted_at"])
+        if since <= timestamp <= until and (
+            message := filter_message(
+                m, page_id=page_id, conversation_id=conversation_id
+            )
+        ):
+            message["page_id"] = page_id
+            messages.append(message)
+
+    # older pages can be skipped once a page reaches `since`
+    reached_since = string_to_unix_second(page[0]["inserted_at"]) <= since
+
+    return messages, reached_since
+
+
+def iter_message_pages(
     page_id: str,
     page_access_token: str,
     conversation_id: str,
     customer_id: str,
     since: int,
     until: int,
-):
-    # Get messages
+) -> Iterator[List[dict]]:
+    # pages are returned from the newest to the oldest one
     message_cnt = 0
-    update_timestamp = None
-    messages = []
-    while update_timestamp is None or update_timestamp > since:
+    while True:
         # call API
         response = call_pancake_api(
-            url=f"https://pages.fm/api/public_api/v1/pages/{page_id}/conversations/{conversation_id}/messages",
-            parameters={
-                "current_count": message_cnt,
-                "page_access_token": page_access_token,
-                "customer_id": customer_id,
-                "conversation_id": conversation_id,
-                "page_id": page_id,
-            },
-            return_type="dictionary",
-            add_access_token=False,
+            **_messages_request(
+                page_id, page_access_token, conversation_id, customer_id, message_cnt
+            )
         )
 
         # check response status
         if not response["success"]:
             print(
-                f"UserWarning: Failed to get conversations for page {page_id}. Respone's message: {response['message']}"
+                f"UserWarning: Failed to get messages for conversation {conversation_id}. Respone's message: {response['message']}"
             )
+            return
 
         # check messages
         if len(response["messages"]) == 0:
+            return
+
+        messages, reached_since = _filter_message_page(
+            response["messages"], since, until, page_id, conversation_id
+        )
+        yield messages
+
+        if reached_since:
+            return
+        message_cnt += len(response["messages"])
+
+
+def get_messages(
+    page_id: str,
+    page_access_token: str,
+    conversation_id: str,
+    customer_id: str,
+    since: int,
+    until: int,
+):
+    pages = list(
+        iter_message_pages(
+            page_id, page_access_token, conversation_id, customer_id, since, until
+        )
+    )
+
+    # restore the chronological order
+    return [m for messages in reversed(pages) for m in messages]
+
+
+# --------------------- Async crawling ---------------------
+class AsyncPancakeClient:
+    """
+    An asyncio HTTP client for the Pancake API.
+
+    All requests share one `aiohttp.ClientSession`, and a semaphore caps the number of
+    requests in flight, so hundreds of requests can be served from a single thread.
+    Use it as an async context manager.
+
+    Attributes:
+        max_concurrency (int): The maximum number of requests in flight.
+        timeout (aiohttp.ClientTimeout): The connect and read timeouts.
+        _semaphore (asyncio.Semaphore): The semaphore bounding the concurrency.
+        _session (aiohttp.ClientSession): The shared session, created on enter.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 100,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 60.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    async def __aenter__(self) -> "AsyncPancakeClient":
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=self.timeout,
+            headers={"Accept-Encoding": "gzip, deflate"},
+        )
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self._session.close()
+        self._session = None
+
+    async def request(
+        self,
+        method: Literal["get", "post"],
+        url: str,
+        params: dict,
+        rate_key: Optional[str] = None,
+    ) -> Tuple[int, bytes]:
+        # aiohttp rejects `None` query values, requests silently drops them
+        params = {k: v for k, v in params.items() if v is not None}
+
+        rate_limiter = get_rate_limiter()
+        await rate_limiter.async_acquire(rate_key)
+        async with self._semaphore:
+            async with self._session.request(
+                method.upper(), url, params=params
+            ) as response:
+                content = await response.read()
+                rate_limiter.record(
+                    rate_key, response.status, response.headers.get("Retry-After")
+                )
+                response.raise_for_status()
+                return response.status, content
+
+
+@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=10))
+async def async_call_pancake_api(
+    client: AsyncPancakeClient,
+    url: str,
+    parameters: Optional[dict] = None,
+    call_type: Literal["get", "post"] = "get",
+    add_access_token: bool = True,
+    return_type: Literal["raw", "string", "dictionary"] = "string",
+) -> Union[bytes, str, dict]:
+    # Initiate request parameters
+    request_params = {}
+    if add_access_token:
+        request_params["access_token"] = os.getenv("PANCAKE_API")
+    if parameters is not None:
+        request_params.update(parameters)
+
+    # Make the request
+    if call_type not in ("get", "post"):
+        raise ValueError(f"Unsupported call_type: {call_type}")
+    _, content = await client.request(
+        call_type, url, request_params, request_params.get("page_access_token")
+    )
+
+    # Process the response based on return_type
+    if return_type == "raw":
+        return content
+    elif return_type == "string":
+        return content.decode("utf-8")
+    elif return_type == "dictionary":
+        return json.loads(content)
+    else:
+        raise ValueError(f"Unsupported return_type: {return_type}")
+
+
+async def _async_get_window_conversations(
+    client: AsyncPancakeClient,
+    page_id: str,
+    page_access_token: str,
+    since: int,
+    until: int,
+    order_by: Literal["insert", "update"] = "update",
+) -> List[dict]:
+    # go through all pages of response in this time range
+    result = []
+    page_number = 1
+    while True:
+        response = await async_call_pancake_api(
+            client,
+            **_conversations_request(
+                page_id, page_access_token, since, until, page_number, order_by
+            ),
+        )
+
+        if not response["success"]:
+            print(
+                f"UserWarning: Failed to get conversations for page {page_id}. Respone's message: {response['message']}"
+            )
+            break
+        elif len(response["conversations"]) == 0:
             break
 
-        # store messages
-        messages = response["messages"] + messages
+        result += response["conversations"]
+        page_number += 1
+
+    return result
+
 
-        # update `update_timstamp` and `message_cnt`
-        update_timestamp = string_to_unix_second(response["messages"][0]["inserted_at"])
+async def async_get_page_conversations(
+    client: AsyncPancakeClient,
+    page_id: str,
+    page_access_token: str,
+    since: int,
+    until: int,
+    order_by: Literal["insert", "update"] = "update",
+    filter: List[str] = ["inbox", "comment", "rating"],
+) -> List[dict]:
+    # fetch all time ranges concurrently, results keep the order of time ranges
+    windows = await asyncio.gather(
+        *[
+            _async_get_window_conversations(
+                client, page_id, page_access_token, s, u, order_by
+            )
+            for s, u in split_time_stamp(since, until)
+        ]
+    )
+
+    return _merge_conversations(windows, filter)
+
+
+async def async_iter_message_pages(
+    client: AsyncPancakeClient,
+    page_id: str,
+    page_access_token: str,
+    conversation_id: str,
+    customer_id: str,
+    since: int,
+    until: int,
+) -> AsyncIterator[List[dict]]:
+    # pages are returned from the newest to the oldest one
+    message_cnt = 0
+    while True:
+        # call API
+        response = await async_call_pancake_api(
+            client,
+            **_messages_request(
+                page_id, page_access_token, conversation_id, customer_id, message_cnt
+            ),
+        )
+
+        # check response status
+        if not response["success"]:
+            print(
+                f"UserWarning: Failed to get messages for conversation {conversation_id}. Respone's message: {response['message']}"
+            )
+            return
+
+        # check messages
+        if len(response["messages"]) == 0:
+            return
+
+        messages, reached_since = _filter_message_page(
+            response["messages"], since, until, page_id, conversation_id
+        )
+        yield messages
+
+        if reached_since:
+            return
         message_cnt += len(response["messages"])
 
-    # filter messages
-    messages = [
-        filter_message(m)
-        for m in messages
-        if since <= string_to_unix_second(m["inserted_at"]) <= until
+
+async def async_get_messages(
+    client: AsyncPancakeClient,
+    page_id: str,
+    page_access_token: str,
+    conversation_id: str,
+    customer_id: str,
+    since: int,
+    until: int,
+) -> List[dict]:
+    pages = [
+        messages
+        async for messages in async_iter_message_pages(
+            client,
+            page_id,
+            page_access_token,
+            conversation_id,
+            customer_id,
+            since,
+            until,
+        )
     ]
-    messages = [m for m in messages if m]
 
-    return messages
+    # restore the chronological order
+    return [m for messages in reversed(pages) for m in messages]
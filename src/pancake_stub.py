@@ -0,0 +1,427 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from pancake import (_messages_request, call_pancake_api, get_page,
+                     get_page_conversations)
+from utils import *
+
+_SAMPLE_MESSAGES = [
+    "Shop ơi súp bào ngư giá bao nhiêu vậy",
+    "Còn hàng không shop",
+    "Tư vấn giúp em với",
+    "Mua cho mẹ bầu ăn được không ạ",
+    "Em muốn mua làm quà biếu ông bà",
+    "Cho khẩu phần 6 người ăn",
+    "Loại tiểu bảo gồm có thành phần gì ạ",
+    "Ship về Đà Nẵng mất mấy ngày",
+    "Người bệnh mới mổ ăn được không",
+    "Ok shop",
+]
+_SAMPLE_REPLIES = [
+    "Dạ shop chào anh/chị ạ",
+    "Dạ sản phẩm vẫn còn hàng ạ",
+    "Dạ shop gửi anh/chị bảng giá ạ",
+]
+
+
+def _format_timestamp(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+def generate_fixture(
+    num_pages: int = 3,
+    conversations_per_page: int = 100,
+    messages_per_conversation: int = 40,
+    days: int = 30,
+    seed: int = 0,
+) -> dict:
+    """
+    Generate a synthetic Pancake dataset.
+
+    Args:
+        num_pages (int): The number of pages.
+        conversations_per_page (int): The number of inbox conversations per page.
+        messages_per_conversation (int): The number of messages per conversation.
+        days (int): The number of days, until now, the messages are spread over.
+        seed (int): The seed of the random generator.
+
+    Returns:
+        dict: The dataset, with `pages`, `conversations` (keyed by page id) and
+            `messages` (keyed by conversation id) in the shape of the Pancake responses.
+    """
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    start = now - timedelta(days=days)
+
+    fixture = {"pages": [], "conversations": {}, "messages": {}}
+    for p in range(num_pages):
+        page_id = f"page_{p}"
+        fixture["pages"].append(
+            {
+                "id": page_id,
+                "name": f"Trường Bào Ngư {p}",
+                "settings": {"page_access_token": f"token_{page_id}"},
+            }
+        )
+
+        fixture["conversations"][page_id] = []
+        for c in range(conversations_per_page):
+            conversation_id = f"{page_id}_conversation_{c}"
+            customer_id = f"{page_id}_customer_{c}"
+
+            # messages are sorted from the oldest to the newest one
+            offsets = sorted(
+                rng.uniform(0, days * 24 * 60 * 60)
+                for _ in range(messages_per_conversation)
+            )
+            messages = []
+            for i, offset in enumerate(offsets):
+                from_customer = rng.random() < 0.6
+                messages.append(
+                    {
+                        "id": f"{conversation_id}_message_{i}",
+                        "original_message": rng.choice(
+                            _SAMPLE_MESSAGES if from_customer else _SAMPLE_REPLIES
+                        ),
+                        "inserted_at": _format_timestamp(
+                            start + timedelta(seconds=offset)
+                        ),
+                        "from": (
+                            {"id": customer_id, "name": f"Khách hàng {c}"}
+                            if from_customer
+                            else {"id": page_id, "name": "Admin", "admin_id": "admin"}
+                        ),
+                    }
+                )
+            fixture["messages"][conversation_id] = messages
+
+            fixture["conversations"][page_id].append(
+                {
+                    "id": conversation_id,
+                    "customer_id": customer_id,
+                    "type": "INBOX",
+                    "inserted_at": messages[0]["inserted_at"],
+                    "updated_at": messages[-1]["inserted_at"],
+                }
+            )
+
+    return fixture
+
+
+def record_fixture(path: str, since: int, until: int) -> dict:
+    """
+    Record a dataset from the real Pancake API, to be served by `PancakeStubServer`.
+
+    Args:
+        path (str): The JSON file to save the dataset to.
+        since (int): The start of the recorded time range, in unix seconds.
+        until (int): The end of the recorded time range, in unix seconds.
+
+    Returns:
+        dict: The recorded dataset.
+    """
+    pages = get_page(return_type="full")
+    fixture = {"pages": list(pages.values()), "conversations": {}, "messages": {}}
+    for page_id, page in pages.items():
+        page_access_token = page["settings"].get("page_access_token")
+        if not page_access_token:
+            continue
+
+        conversations = get_page_conversations(
+            page_id, page_access_token, since, until, filter=["inbox"]
+        )
+        fixture["conversations"][page_id] = conversations
+
+        # record the raw message pages, from the newest to the oldest one
+        for con in conversations:
+            message_pages = []
+            message_cnt = 0
+            while True:
+                response = call_pancake_api(
+                    **_messages_request(
+                        page_id,
+                        page_access_token,
+                        con["id"],
+                        con["customer_id"],
+                        message_cnt,
+                    )
+                )
+                if not response["success"] or not response["messages"]:
+                    break
+                message_pages.append(response["messages"])
+                message_cnt += len(response["messages"])
+
+            # restore the chronological order
+            fixture["messages"][con["id"]] = [
+                m for messages in reversed(message_pages) for m in messages
+            ]
+
+    save_json(path, fixture)
+    return fixture
+
+
+class _PancakeStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    _routes = [
+        ("GET", re.compile(r"^/api/v1/pages$"), "_get_pages"),
+        (
+            "POST",
+            re.compile(
+                r"^/api/v1/pages/(?P<page_id>[^/]+)/generate_page_access_token$"
+            ),
+            "_generate_page_access_token",
+        ),
+        (
+            "GET",
+            re.compile(r"^/api/public_api/v1/pages/(?P<page_id>[^/]+)/conversations$"),
+            "_get_conversations",
+        ),
+        (
+            "GET",
+            re.compile(
+                r"^/api/public_api/v1/pages/(?P<page_id>[^/]+)/conversations/(?P<conversation_id>[^/]+)/messages$"
+            ),
+            "_get_messages",
+        ),
+    ]
+
+    def do_GET(self) -> None:
+        self._dispatch("GET")
+
+    def do_POST(self) -> None:
+        self._dispatch("POST")
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # keep the console quiet under load
+        pass
+
+    def _dispatch(self, method: str) -> None:
+        server = self.server
+        url = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+        # simulate network and server latency
+        if server.latency or server.jitter:
+            time.sleep(server.latency + server.rng.uniform(0, server.jitter))
+
+        # inject throttling
+        if server.error_rate and server.rng.random() < server.error_rate:
+            server.record_request(throttled=True)
+            headers = {}
+            if server.retry_after is not None:
+                headers["Retry-After"] = str(server.retry_after)
+            self._send(429, {"success": False, "message": "Too many requests"}, headers)
+            return
+
+        server.record_request()
+        for route_method, pattern, handler in self._routes:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                status, body = getattr(self, handler)(params, **match.groupdict())
+                self._send(status, body)
+                return
+
+        self._send(404, {"success": False, "message": f"Unknown path {url.path}"})
+
+    def _send(self, status: int, body: dict, headers: Optional[dict] = None) -> None:
+        content = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _get_pages(self, params: dict) -> Tuple[int, dict]:
+        pages = self.server.fixture["pages"]
+        return 200, {
+            "success": True,
+            "categorized": {
+                "activated": pages,
+                "activated_page_id": [page["id"] for page in pages],
+            },
+        }
+
+    def _generate_page_access_token(
+        self, params: dict, page_id: str
+    ) -> Tuple[int, dict]:
+        if page_id not in self.server.fixture["conversations"]:
+            return 200, {"success": False, "message": "Page not found"}
+
+        return 200, {"success": True, "page_access_token": f"token_{page_id}"}
+
+    def _get_conversations(self, params: dict, page_id: str) -> Tuple[int, dict]:
+        server = self.server
+        if page_id not in server.fixture["conversations"]:
+            return 200, {"success": False, "message": "Page not found"}
+
+        since, until = int(params.get("since", 0)), int(params.get("until", 2**32))
+        key = "inserted_at" if params.get("order_by") == "inserted_at" else "updated_at"
+        conversations = [
+            c
+            for c in server.fixture["conversations"][page_id]
+            if since <= server.timestamps[(c["id"], key)] <= until
+        ]
+        conversations.sort(
+            key=lambda c: server.timestamps[(c["id"], key)], reverse=True
+        )
+
+        # `page_number` starts at 1
+        page_size = server.conversation_page_size
+        start = (int(params.get("page_number", 1)) - 1) * page_size
+        return 200, {
+            "success": True,
+            "conversations": conversations[start : start + page_size],
+        }
+
+    def _get_messages(
+        self, params: dict, page_id: str, conversation_id: str
+    ) -> Tuple[int, dict]:
+        server = self.server
+        if conversation_id not in server.fixture["messages"]:
+            return 200, {"success": False, "message": "Conversation not found"}
+
+        # `current_count` messages, counted from the newest one, were already returned
+        messages = server.fixture["messages"][conversation_id]
+        end = max(len(messages) - int(params.get("current_count", 0)), 0)
+        start = max(end - server.message_page_size, 0)
+        return 200, {"success": True, "messages": messages[start:end]}
+
+
+class PancakeStubServer(ThreadingHTTPServer):
+    """
+    A local stand-in for the Pancake API, serving a recorded or synthetic dataset.
+
+    It serves the `/pages`, `/generate_page_access_token`, `/conversations` and
+    `/messages` endpoints used by `pancake.py`. Point the crawl at it by setting the
+    `PANCAKE_BASE_URL` environment variable to `base_url`.
+
+    Attributes:
+        fixture (dict): The dataset, see `generate_fixture`.
+        latency (float): The fixed latency added to every response, in seconds.
+        jitter (float): The maximum random latency added on top of `latency`.
+        error_rate (float): The probability of answering with a 429.
+        retry_after (Optional[int]): The `Retry-After` header sent with a 429.
+        conversation_page_size (int): The number of conversations per page.
+        message_page_size (int): The number of messages per page.
+        stats (dict): The number of served and throttled requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        fixture: dict,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        retry_after: Optional[int] = None,
+        conversation_page_size: int = 60,
+        message_page_size: int = 30,
+        seed: int = 0,
+    ):
+        super().__init__((host, port), _PancakeStubHandler)
+        self.fixture = fixture
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.conversation_page_size = conversation_page_size
+        self.message_page_size = message_page_size
+        self.rng = random.Random(seed)
+        self.stats = {"requests": 0, "throttled": 0}
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+        # parse the conversation timestamps once
+        self.timestamps = {
+            (c["id"], key): string_to_unix_second(c[key])
+            for conversations in fixture["conversations"].values()
+            for c in conversations
+            for key in ("inserted_at", "updated_at")
+        }
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record_request(self, throttled: bool = False) -> None:
+        with self._stats_lock:
+            self.stats["requests"] += 1
+            self.stats["throttled"] += int(throttled)
+
+    def start(self) -> str:
+        """
+        Serve in a background thread.
+
+        Returns:
+            str: The base URL of the server.
+        """
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a local Pancake stand-in.")
+    parser.add_argument("--fixture", help="A recorded or saved dataset (JSON).")
+    parser.add_argument("--save-fixture", help="Save the synthetic dataset (JSON).")
+    parser.add_argument("--pages", type=int, default=3)
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=None)
+    parser.add_argument("--conversation-page-size", type=int, default=60)
+    parser.add_argument("--message-page-size", type=int, default=30)
+    args = parser.parse_args()
+
+    if args.fixture:
+        fixture = load_json(args.fixture)
+    else:
+        fixture = generate_fixture(
+            args.pages, args.conversations, args.messages, args.days
+        )
+        if args.save_fixture:
+            save_json(args.save_fixture, fixture)
+
+    server = PancakeStubServer(
+        fixture,
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        conversation_page_size=args.conversation_page_size,
+        message_page_size=args.message_page_size,
+    )
+    print(f"Serving Pancake stand-in, set PANCAKE_BASE_URL={server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Served {server.stats}")
+        server.server_close()
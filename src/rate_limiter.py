@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import time
+from collections import deque
+from threading import Condition, Lock
+from typing import Dict, Optional, Tuple
+
+
+class RateLimiter:
+    """
+    A sliding-window limit on the requests and tokens sent per window (a minute).
+
+    Every admitted request is remembered with its tokens until it leaves the window, and
+    a request is admitted only if both the requests and the tokens of the window stay
+    within their limits. Callers are admitted in FIFO order: each takes a ticket and
+    waits for its turn, so a large request is never starved by smaller ones. Threads wait
+    on a condition, and asyncio tasks sleep on their event loop.
+
+    Attributes:
+        max_requests (int): The maximum number of requests per window.
+        max_tokens (Optional[int]): The maximum number of tokens per window, if any.
+        window (float): The length of the window, in seconds.
+        poll_interval (float): The time asyncio tasks sleep while waiting for their turn.
+        _admitted (Deque[Tuple[float, int, int]]): The time, requests and tokens of the
+            admissions in the window.
+        _num_requests (int): The number of requests in the window.
+        _num_tokens (int): The number of tokens in the window.
+        _paused_until (float): The time before which no request is admitted.
+        _next_ticket (int): The ticket of the next caller.
+        _serving (int): The ticket of the caller allowed to be admitted.
+        _abandoned (Set[int]): The tickets of callers which stopped waiting.
+        _lock (Lock): A lock to protect the state from concurrent access.
+        _condition (Condition): A condition variable to coordinate waiting between threads.
+    """
+
+    def __init__(
+        self,
+        max_requests: int,
+        max_tokens: Optional[int] = None,
+        window: float = 60.0,
+        poll_interval: float = 0.05,
+    ):
+        self.max_requests = max_requests
+        self.max_tokens = max_tokens
+        self.window = window
+        self.poll_interval = poll_interval
+        self._admitted = deque()
+        self._num_requests = 0
+        self._num_tokens = 0
+        self._paused_until = 0.0
+        self._next_ticket = 0
+        self._serving = 0
+        self._abandoned = set()
+        self._lock = Lock()
+        self._condition = Condition(self._lock)
+
+    def _prune(self, now: float) -> None:
+        while self._admitted and self._admitted[0][0] <= now - self.window:
+            _, num_requests, num_tokens = self._admitted.popleft()
+            self._num_requests -= num_requests
+            self._num_tokens -= num_tokens
+
+    def _time_to_free(self, index: int, needed: int, now: float) -> float:
+        # the time until the oldest admissions free `needed` requests or tokens
+        freed = 0
+        for admitted_at, *amounts in self._admitted:
+            freed += amounts[index]
+            if freed >= needed:
+                return admitted_at + self.window - now
+
+        return self.window
+
+    def _wait_time(self, num_requests: int, num_tokens: int, now: float) -> float:
+        """
+        Compute the time to wait before admitting a request.
+
+        Returns:
+            float: 0.0 if the request fits in the window, otherwise the number of seconds
+                until it may fit.
+        """
+        self._prune(now)
+        wait_time = max(0.0, self._paused_until - now)
+
+        excess = self._num_requests + num_requests - self.max_requests
+        if excess > 0:
+            wait_time = max(wait_time, self._time_to_free(0, excess, now))
+
+        if self.max_tokens is not None:
+            excess = self._num_tokens + num_tokens - self.max_tokens
+            if excess > 0:
+                wait_time = max(wait_time, self._time_to_free(1, excess, now))
+
+        return wait_time
+
+    def _clamp(self, num_requests: int, num_tokens: int) -> Tuple[int, int]:
+        # a request larger than a limit is admitted alone in the window
+        num_requests = min(num_requests, self.max_requests)
+        if self.max_tokens is not None:
+            num_tokens = min(num_tokens, self.max_tokens)
+        return num_requests, num_tokens
+
+    def _admit(self, num_requests: int, num_tokens: int, now: float) -> None:
+        self._admitted.append((now, num_requests, num_tokens))
+        self._num_requests += num_requests
+        self._num_tokens += num_tokens
+
+    def _take_ticket(self) -> int:
+        ticket = self._next_ticket
+        self._next_ticket += 1
+        return ticket
+
+    def _release_ticket(self, ticket: int) -> None:
+        """
+        Give the turn to the next waiting caller, or skip `ticket` once its turn comes if
+        its caller stopped waiting (e.g. a cancelled task).
+        """
+        if ticket == self._serving:
+            self._serving += 1
+            while self._serving in self._abandoned:
+                self._abandoned.remove(self._serving)
+                self._serving += 1
+        else:
+            self._abandoned.add(ticket)
+        self._condition.notify_all()
+
+    def _try_admit(self, ticket: int, num_requests: int, num_tokens: int) -> float:
+        if ticket != self._serving:
+            return -1.0
+
+        # clamped on every try, so the head always fits in an empty window
+        num_requests, num_tokens = self._clamp(num_requests, num_tokens)
+        now = time.monotonic()
+        wait_time = self._wait_time(num_requests, num_tokens, now)
+        if wait_time == 0.0:
+            self._admit(num_requests, num_tokens, now)
+        return wait_time
+
+    def acquire(self, num_requests: int = 1, num_tokens: int = 0) -> None:
+        """
+        Wait for the turn of the caller and for the window to have room for the request.
+        """
+        with self._condition:
+            ticket = self._take_ticket()
+            try:
+                while wait_time := self._try_admit(ticket, num_requests, num_tokens):
+                    # callers behind the head wait until the turn changes
+                    self._condition.wait(timeout=wait_time if wait_time > 0 else None)
+            finally:
+                self._release_ticket(ticket)
+
+    async def async_acquire(self, num_requests: int = 1, num_tokens: int = 0) -> None:
+        """
+        Like `acquire`, but sleep without blocking the event loop.
+        """
+        with self._lock:
+            ticket = self._take_ticket()
+        try:
+            while True:
+                with self._lock:
+                    wait_time = self._try_admit(ticket, num_requests, num_tokens)
+                if wait_time == 0.0:
+                    return
+                await asyncio.sleep(wait_time if wait_time > 0 else self.poll_interval)
+        finally:
+            with self._lock:
+                self._release_ticket(ticket)
+
+    def pause(self, seconds: Optional[float] = None) -> None:
+        """
+        Admit no request for `seconds` (a window by default), e.g. after the API
+        rejected a request with a 429 error.
+        """
+        with self._condition:
+            until = time.monotonic() + (self.window if seconds is None else seconds)
+            self._paused_until = max(self._paused_until, until)
+            self._condition.notify_all()
+
+
+_rate_limiters: Dict[Tuple[str, Optional[str], str], RateLimiter] = {}
+_rate_limiters_lock = Lock()
+
+
+def get_rate_limiter(
+    provider: str,
+    model: Optional[str],
+    api_key: Optional[str],
+    max_requests: int,
+    max_tokens: Optional[int] = None,
+) -> RateLimiter:
+    """
+    Get the process-wide limiter of an API key of a model.
+
+    Every caller of the same provider, model and API key shares one limiter, whatever
+    the stage or thread it runs in, so they must all give the same limits.
+
+    Args:
+        provider (str): The LLM provider.
+        model (Optional[str]): The model name.
+        api_key (Optional[str]): The API key, only its hash is kept.
+        max_requests (int): The maximum number of requests per minute.
+        max_tokens (Optional[int]): The maximum number of tokens per minute, if any.
+
+    Returns:
+        RateLimiter: The shared limiter.
+
+    Raises:
+        ValueError: If the limiter exists with other limits.
+    """
+    key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()
+    key = (provider, model, key_hash)
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = RateLimiter(max_requests, max_tokens)
+
+        limiter = _rate_limiters[key]
+
+    # callers fighting over the limits would break the window of each other
+    if (limiter.max_requests, limiter.max_tokens) != (max_requests, max_tokens):
+        raise ValueError(
+            f"The rate limiter of {provider} {model} already limits "
+            f"{limiter.max_requests} requests and {limiter.max_tokens} tokens per "
+            f"window, not {max_requests} requests and {max_tokens} tokens"
+        )
+
+    return limiter
@@ -0,0 +1,216 @@
+import os
+import shutil
+import time
+from datetime import date, datetime
+from typing import List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas import DataFrame
+
+from utils import *
+
+# the partition of the rows without a time
+NULL_PARTITION = "__null__"
+
+
+class PartitionedTable:
+    """
+    A table stored as day-partitioned Parquet files.
+
+    Rows are partitioned by the day of `partition_col`, one directory per day
+    (`<root>/date=YYYY-MM-DD/part-<ns>.parquet`), and rows without a time are kept in
+    `<root>/date=__null__`, which only an unbounded `load` reads. Appending writes a new
+    file into the partitions of the new rows only, and retention removes whole
+    partitions, so the cost of a run does not grow with the history. List columns (e.g. `user`, `purpose`) are
+    stored natively as Parquet lists, and every row carries a persisted hash
+    (`hash_col`) so deduplication only hashes the new rows.
+
+    Attributes:
+        root (str): The directory of the table.
+        partition_col (str): The datetime column the table is partitioned by.
+        max_files_per_partition (int): The number of files after which a partition is
+            compacted into a single file.
+        hash_col (str): The column persisting the row hashes, hidden from `load`.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        partition_col: str = "inserted_at",
+        max_files_per_partition: int = 16,
+        hash_col: str = "row_hash",
+    ):
+        self.root = root
+        self.partition_col = partition_col
+        self.max_files_per_partition = max_files_per_partition
+        self.hash_col = hash_col
+        os.makedirs(root, exist_ok=True)
+
+    def __len__(self) -> int:
+        return sum(
+            pq.ParquetFile(path).metadata.num_rows
+            for day in self.partitions()
+            for path in self._partition_files(day)
+        )
+
+    def _partition_dir(self, day: str) -> str:
+        return os.path.join(self.root, f"date={day}")
+
+    def _partition_files(self, day: str) -> List[str]:
+        directory = self._partition_dir(day)
+        return sorted(
+            os.path.join(directory, name)
+            for name in os.listdir(directory)
+            if name.endswith(".parquet")
+        )
+
+    def _write_file(self, df: DataFrame, day: str) -> None:
+        directory = self._partition_dir(day)
+        os.makedirs(directory, exist_ok=True)
+
+        # write to a temporary file first, so a crash never leaves a partial file
+        path = os.path.join(directory, f"part-{time.time_ns()}.parquet")
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+
+    def _read_files(self, paths: List[str]) -> DataFrame:
+        if not paths:
+            return DataFrame()
+
+        table = pa.concat_tables(
+            [pq.read_table(path) for path in paths], promote_options="default"
+        )
+        # keep the hashes exact when older files have no hash column
+        df = table.to_pandas(types_mapper={pa.uint64(): pd.UInt64Dtype()}.get)
+
+        # keep list columns as python lists instead of numpy arrays
+        for field in table.schema:
+            if pa.types.is_list(field.type) or pa.types.is_large_list(field.type):
+                df[field.name] = table.column(field.name).to_pylist()
+
+        return df
+
+    def _read_hashes(self, paths: List[str]) -> Series:
+        # only the persisted hash column is read, files without it are hashed
+        hashes = []
+        for path in paths:
+            if self.hash_col in pq.read_schema(path).names:
+                table = pq.read_table(path, columns=[self.hash_col])
+                hashes.append(table.column(self.hash_col).to_pandas())
+            else:
+                hashes.append(hash_dataframe_rows(self._read_files([path])))
+
+        if not hashes:
+            return Series([], dtype="uint64")
+        return pd.concat(hashes, ignore_index=True).astype("uint64")
+
+    def partitions(self) -> List[str]:
+        return sorted(
+            name.split("=", 1)[1]
+            for name in os.listdir(self.root)
+            if name.startswith("date=")
+        )
+
+    def load(
+        self,
+        since: Optional[Union[date, str]] = None,
+        until: Optional[Union[date, str]] = None,
+    ) -> DataFrame:
+        """
+        Load the rows of the partitions between `since` and `until` (both included).
+        """
+        return self._read_files(self._range_files(since, until)).drop(
+            columns=self.hash_col, errors="ignore"
+        )
+
+    def row_hashes(
+        self,
+        since: Optional[Union[date, str]] = None,
+        until: Optional[Union[date, str]] = None,
+    ) -> Series:
+        """
+        Read the stored hashes of the rows of the partitions between `since` and `until`.
+        """
+        return self._read_hashes(self._range_files(since, until))
+
+    def _range_files(
+        self, since: Optional[Union[date, str]], until: Optional[Union[date, str]]
+    ) -> List[str]:
+        since = str(since) if since is not None else None
+        until = str(until) if until is not None else None
+        bounded = since is not None or until is not None
+        return [
+            path
+            for day in self.partitions()
+            if not (bounded and day == NULL_PARTITION)
+            and (since is None or day >= since)
+            and (until is None or day <= until)
+            for path in self._partition_files(day)
+        ]
+
+    def append(self, df: DataFrame) -> DataFrame:
+        """
+        Append rows, skipping those already stored.
+
+        Only the stored hashes of the partitions of the new rows are read, to find the
+        duplicates.
+
+        Returns:
+            DataFrame: The rows actually appended.
+        """
+        if df.empty:
+            return df
+
+        # rows without a time are kept apart instead of being dropped by `groupby`
+        days = df[self.partition_col].dt.strftime("%Y-%m-%d").fillna(NULL_PARTITION)
+        appended = []
+        for day, new_df in df.groupby(days, sort=True):
+            new_df = add_row_hash(new_df.reset_index(drop=True), self.hash_col)
+
+            # drop the rows already stored in this partition, by their stored hashes
+            existing = Series([], dtype="uint64")
+            if day in self.partitions():
+                existing = self._read_hashes(self._partition_files(day))
+            new_df = drop_dataframe_duplicates(new_df, self.hash_col)
+            new_df = new_df[~new_df[self.hash_col].isin(existing)]
+            if new_df.empty:
+                continue
+
+            self._write_file(new_df, day)
+            appended.append(new_df[df.columns])
+
+            # compact the partition once it holds too many small files
+            if len(self._partition_files(day)) > self.max_files_per_partition:
+                self.compact(day)
+
+        if not appended:
+            return df.iloc[0:0]
+        return pd.concat(appended, axis=0, ignore_index=True)
+
+    def compact(self, day: str) -> None:
+        paths = self._partition_files(day)
+        df = self._read_files(paths)
+        self._write_file(df, day)
+        for path in paths:
+            os.remove(path)
+
+    def drop_before(self, bound: Union[date, datetime]) -> List[str]:
+        """
+        Remove the partitions of the days before `bound`.
+
+        Returns:
+            List[str]: The removed days.
+        """
+        bound = bound.date() if isinstance(bound, datetime) else bound
+        dropped = [
+            day
+            for day in self.partitions()
+            if day != NULL_PARTITION and day < str(bound)
+        ]
+        for day in dropped:
+            shutil.rmtree(self._partition_dir(day))
+
+        return dropped
@@ -1,15 +1,23 @@
+import hashlib
 import json
+import math
 import os
 import re
+import unicodedata
 from ast import literal_eval
-from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Literal, Optional, Tuple, Union
+from collections import deque
+from datetime import datetime, timedelta, timezone, tzinfo
+from functools import lru_cache
+from typing import Dict, Iterable, List, Literal, Optional, Tuple, Union
 
 import json_repair
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import pytz
 import yaml
 from dotenv import load_dotenv
-from pandas import DataFrame
+from pandas import DataFrame, Series
 from pydantic import BaseModel
 
 load_dotenv()
@@ -42,12 +50,14 @@ def get_project_path(relevant_path: str) -> str:
     return os.path.join(PROJECT_DIRECTORY, relevant_path)
 
 
-def string_to_unix_second(
-    s: str,
-    format: str = "%Y-%m-%dT%H:%M:%S",
-    tz: str = "UTC",
-    return_tz: str = "Asia/Bangkok",
-) -> int:
+@lru_cache(maxsize=None)
+def get_timezone(name: str) -> tzinfo:
+    if name == "UTC":
+        return timezone.utc
+    return pytz.timezone(name)
+
+
+def _slow_string_to_unix_second(s: str, format: str, tz: str) -> int:
     added_second = 0
     try:
         rounded_s = s.split(".")[0]
@@ -57,16 +67,68 @@ def string_to_unix_second(
 
     # convert to `datetime`
     dt = datetime.strptime(rounded_s, format)
-    tz = pytz.timezone(tz)
-    dt = tz.localize(dt)
+    tz = get_timezone(tz)
+    dt = tz.localize(dt) if hasattr(tz, "localize") else dt.replace(tzinfo=tz)
+
+    return int(dt.timestamp()) + added_second
+
+
+def string_to_unix_second(
+    s: str,
+    format: str = "%Y-%m-%dT%H:%M:%S",
+    tz: str = "UTC",
+    return_tz: str = "Asia/Bangkok",
+) -> int:
+    # `return_tz` does not change the unix timestamp, it is kept for compatibility
+    if format != "%Y-%m-%dT%H:%M:%S":
+        return _slow_string_to_unix_second(s, format, tz)
 
-    if return_tz:
-        tz = pytz.timezone(return_tz)
-        dt = dt.astimezone(tz)
+    # fast path, `fromisoformat` is implemented in C
+    try:
+        dt = datetime.fromisoformat(s)
+    except ValueError:
+        return _slow_string_to_unix_second(s, format, tz)
+
+    if dt.tzinfo is None:
+        tz = get_timezone(tz)
+        dt = tz.localize(dt) if hasattr(tz, "localize") else dt.replace(tzinfo=tz)
 
-    timestamp = int(dt.timestamp())
+    # a fractional second is rounded up
+    return int(dt.timestamp()) + (1 if dt.microsecond else 0)
 
-    return timestamp + added_second
+
+def strings_to_unix_seconds(
+    values: Union[List[str], Series], tz: str = "UTC"
+) -> Union[List[int], Series]:
+    """
+    Convert ISO 8601 timestamps to unix seconds in one vectorized pass.
+
+    It returns the same values as `string_to_unix_second`, a fractional second is
+    rounded up.
+
+    Args:
+        values (Union[List[str], Series]): The timestamps to convert.
+        tz (str): The timezone of timestamps without offset. Defaults to "UTC".
+
+    Returns:
+        Union[List[int], Series]: The unix seconds, a Series if `values` is a Series.
+    """
+    strings = Series(values, dtype=object).reset_index(drop=True)
+    dt = pd.to_datetime(strings, format="ISO8601", utc=True)
+    if tz != "UTC" and len(strings):
+        # timestamps without offset are in `tz`, like `string_to_unix_second`
+        naive = ~strings.str.contains(r"(?:Z|[+-]\d{2}:?\d{2})$", regex=True)
+        if naive.any():
+            local = pd.to_datetime(strings[naive], format="ISO8601")
+            dt[naive] = local.dt.tz_localize(tz, ambiguous=False).dt.tz_convert("UTC")
+
+    nanoseconds = dt.astype("int64")
+    seconds = nanoseconds // 10**9 + (nanoseconds % 10**9 != 0)
+
+    if isinstance(values, Series):
+        seconds.index = values.index
+        return seconds
+    return seconds.tolist()
 
 
 def get_current_time_utc_plus_7():
@@ -104,34 +166,347 @@ def split_time_stamp(
     return result
 
 
-def drop_dataframe_duplicates(df: DataFrame) -> DataFrame:
-    # Create a copy to avoid modifying the original dataframe
-    df_copy = df.copy()
+# named groups and backreferences would clash or be renumbered once the patterns are
+# combined into a single regex
+_UNSUPPORTED_PATTERN = re.compile(r"\(\?P[<=]|(?<!\\)(?:\\\\)*\\[1-9]")
+
+# global inline flags must start the whole regex, so they cannot be combined either,
+# scoped flags such as `(?i:...)` are fine
+_GLOBAL_FLAGS = re.compile(r"(?<!\\)(?:\\\\)*\(\?[aiLmsux]+\)")
+
 
-    # Dictionary to track columns that need conversion back
-    conversion_columns = []
+class PatternMatcher:
+    """
+    A list of regex patterns compiled into combined regexes, built once and reused.
+
+    `search` tells which pattern matched with a single scan of the text: every pattern is
+    a named alternative of a lookahead, tried at each position of the text in list order,
+    so each match reports the first pattern matching at its position, and the lowest of
+    them is the first pattern of the list that matches anywhere in the text, as with a
+    loop of `re.search` calls. Patterns may not contain named groups, backreferences or
+    global inline flags.
+
+    Attributes:
+        patterns (List[str]): The patterns, in priority order.
+        _any_regex (re.Pattern): The alternation of all patterns.
+        _which_regex (re.Pattern): The lookahead of the named alternatives.
+    """
+
+    def __init__(
+        self,
+        patterns: Iterable[str],
+        word_boundary: bool = False,
+        ignore_case: bool = True,
+    ):
+        self.patterns = list(patterns)
+        for p in self.patterns:
+            if _UNSUPPORTED_PATTERN.search(p):
+                raise ValueError(
+                    f"Pattern {p!r} contains a named group or a backreference"
+                )
+            if _GLOBAL_FLAGS.search(p):
+                raise ValueError(
+                    f"Pattern {p!r} contains a global inline flag, use a scoped flag "
+                    "such as '(?i:...)' instead"
+                )
+
+        wrapped = [
+            rf"\b(?:{p})\b" if word_boundary else f"(?:{p})" for p in self.patterns
+        ]
+        flags = re.IGNORECASE if ignore_case else 0
+        self._any_regex = re.compile("|".join(wrapped) or r"(?!)", flags)
+        alternatives = "|".join(f"(?P<_{i}>{p})" for i, p in enumerate(wrapped))
+        self._which_regex = re.compile(
+            f"(?={alternatives})" if wrapped else r"(?!)", flags
+        )
+
+    def matches(self, text: str) -> bool:
+        return self._any_regex.search(text) is not None
+
+    def search(self, text: str) -> Optional[int]:
+        """
+        Find the first pattern, in list order, that matches `text`.
+
+        Returns:
+            Optional[int]: The index of the pattern, or None if no pattern matches.
+        """
+        index = None
+        for match in self._which_regex.finditer(text):
+            match_index = int(match.lastgroup[1:])
+            if index is None or match_index < index:
+                index = match_index
+                if index == 0:
+                    break
+
+        return index
+
+
+@lru_cache(maxsize=None)
+def _cached_pattern_matcher(
+    patterns: Tuple[str, ...], word_boundary: bool, ignore_case: bool
+) -> PatternMatcher:
+    return PatternMatcher(patterns, word_boundary, ignore_case)
+
+
+def get_pattern_matcher(
+    patterns: Union[Iterable[str], PatternMatcher],
+    word_boundary: bool = False,
+    ignore_case: bool = True,
+) -> PatternMatcher:
+    # matchers are compiled once per process for each list of patterns
+    if isinstance(patterns, PatternMatcher):
+        return patterns
+    return _cached_pattern_matcher(tuple(patterns), word_boundary, ignore_case)
+
+
+def estimate_tokens(text: str) -> int:
+    # Vietnamese diacritics split into many tokens, about one per 3 bytes of UTF-8
+    return max(1, math.ceil(len(str(text).encode("utf-8")) / 3))
+
+
+def plan_batches(
+    messages: List[str],
+    prompt_tokens: int = 0,
+    max_input_tokens: int = 6000,
+    max_output_tokens: int = 4000,
+    output_tokens_per_message: int = 30,
+    max_batch_size: int = 50,
+) -> List[Tuple[int, int]]:
+    """
+    Packs consecutive messages into batches that fit the token budget of a provider.
+
+    The tokens of every message are estimated (see `estimate_tokens`). A batch is closed
+    when the next message would exceed the input budget (including the prompt), the
+    output budget (the response repeats every message with its result), or the maximum
+    number of messages.
+
+    Args:
+        messages (List[str]): A list of messages to be processed by the LLM.
+        prompt_tokens (int, optional): The estimated tokens of the prompt. Defaults to 0.
+        max_input_tokens (int, optional): The input budget of a request. Defaults to 6000.
+        max_output_tokens (int, optional): The output budget of a request. Defaults to 4000.
+        output_tokens_per_message (int, optional): The estimated tokens of the result of a
+            message, besides its text. Defaults to 30.
+        max_batch_size (int, optional): The maximum number of messages in a batch. Defaults to 50.
+
+    Returns:
+        List[Tuple[int, int]]: The start and end indices of the batches.
+    """
+    batches = []
+    start = 0
+    input_tokens = prompt_tokens
+    output_tokens = 0
+    for i, message in enumerate(messages):
+        # quotes and separator of the serialized list
+        message_tokens = estimate_tokens(message) + 2
+        message_output_tokens = message_tokens + output_tokens_per_message
+        if i > start and (
+            i - start >= max_batch_size
+            or input_tokens + message_tokens > max_input_tokens
+            or output_tokens + message_output_tokens > max_output_tokens
+        ):
+            batches.append((start, i))
+            start = i
+            input_tokens = prompt_tokens
+            output_tokens = 0
+
+        input_tokens += message_tokens
+        output_tokens += message_output_tokens
+
+    if start < len(messages):
+        batches.append((start, len(messages)))
+
+    return batches
+
+
+class BatchPlanner:
+    """
+    Plans the batches of a list of messages one at a time, adapting to failed batches.
+
+    Batches are packed like `plan_batches`, but only when they are about to be sent, so
+    a failed batch shrinks the batches planned after it: they hold at most half of its
+    messages. A failed batch is retried once split in two, and the messages of a failed
+    half (or of a failed batch of one message) are retried once each, so a batch of n
+    messages costs at most n + 3 requests.
+
+    Attributes:
+        messages (List[str]): The messages to be processed by the LLM.
+        prompt_tokens (int): The estimated tokens of the prompt.
+        budget (dict): The budget of a request, as the arguments of `plan_batches`.
+        _start (int): The index of the first message not planned yet.
+        _retries (Deque[Tuple[int, int, int]]): The batches to retry, with their level.
+    """
 
-    # Iterate over columns
-    for col in df_copy.columns:
-        # Check if the column contains unhashable types (e.g., lists or dictionaries)
-        if df_copy[col].apply(lambda x: isinstance(x, (list, dict))).any():
-            # Convert the unhashable column to tuples
-            df_copy[col] = df_copy[col].apply(
-                lambda x: tuple(x) if isinstance(x, list) else x
+    # the level of a batch tells how it is retried: planned, half of a batch, or a
+    # single message
+    PLANNED, HALF, SINGLE = 0, 1, 2
+
+    def __init__(self, messages: List[str], prompt_tokens: int = 0, **budget: int):
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens
+        self.budget = budget
+        self._start = 0
+        self._retries = deque()
+
+    def __bool__(self) -> bool:
+        return bool(self._retries) or self._start < len(self.messages)
+
+    def next(self) -> Tuple[int, int, int]:
+        """
+        Plan the next batch to send, retries first.
+
+        Returns:
+            Tuple[int, int, int]: The start and end indices of the batch, and its level.
+        """
+        if self._retries:
+            return self._retries.popleft()
+
+        # a batch never holds more than `max_batch_size` messages
+        start = self._start
+        window = self.messages[start : start + self.budget.get("max_batch_size", 50)]
+        _, end = plan_batches(window, self.prompt_tokens, **self.budget)[0]
+        self._start = start + end
+
+        return start, self._start, self.PLANNED
+
+    def fail(self, start: int, end: int, level: int) -> bool:
+        """
+        Record a truncated or mismatched batch and plan its retries.
+
+        Returns:
+            bool: Whether the batch is retried.
+        """
+        if level == self.PLANNED:
+            max_batch_size = self.budget.get("max_batch_size", 50)
+            self.budget["max_batch_size"] = min(
+                max_batch_size, max(1, (end - start) // 2)
             )
-            # Track the columns that were converted
-            conversion_columns.append(col)
 
-    # Drop duplicates
-    df_copy = df_copy.drop_duplicates()
+        if level == self.PLANNED and end - start > 1:
+            mid = (start + end) // 2
+            self._retries += [(start, mid, self.HALF), (mid, end, self.HALF)]
+        elif level != self.SINGLE:
+            self._retries += [(k, k + 1, self.SINGLE) for k in range(start, end)]
+
+        return level != self.SINGLE
+
+
+def message_hash(message: dict) -> str:
+    # identity of a message: its Pancake id in its page, otherwise its sender,
+    # conversation, time and text
+    if message.get("id"):
+        fields = ("page_id", "id")
+    else:
+        fields = ("page_id", "conversation_id", "from", "inserted_at", "message")
+    key = "\x1f".join(str(message.get(k) or "") for k in fields)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def normalize_message_text(text: str) -> str:
+    # case, unicode composition and spacing do not change what a message means
+    return " ".join(unicodedata.normalize("NFC", str(text)).casefold().split())
+
+
+def get_message_id(message: dict) -> str:
+    # messages queued before `message_id` existed are hashed on the fly
+    return message.get("message_id") or message_hash(message)
 
-    # Convert the columns that were modified back to their original types (lists, etc.)
-    for col in conversion_columns:
-        df_copy[col] = df_copy[col].apply(
-            lambda x: list(x) if isinstance(x, tuple) else x
+
+def unique_messages(messages: Iterable[dict]) -> List[dict]:
+    # keep the first occurrence of every message, in order
+    seen = set()
+    result = []
+    for m in messages:
+        if (message_id := get_message_id(m)) not in seen:
+            seen.add(message_id)
+            result.append(m)
+
+    return result
+
+
+def parse_list_column(values: Series) -> Series:
+    """
+    Parse a column of stringified lists (e.g. "['a', 'b']") into lists of strings.
+
+    Brackets, the spaces around items and their surrounding quotes are removed with
+    vectorized Arrow string kernels, and missing values become empty lists.
+
+    Args:
+        values (Series): The stringified lists.
+
+    Returns:
+        Series: The parsed lists, indexed like `values`.
+    """
+    stripped = (
+        values.astype("string[pyarrow]")
+        .str.strip("[]")
+        .str.replace(r"\s*,\s*", ",", regex=True)
+        .str.strip()
+        .str.replace(r"'*,'*", ",", regex=True)
+        .str.strip("'")
+    )
+    items = pc.split_pattern(pa.array(stripped), ",")
+    items = pc.if_else(pc.is_null(items), pa.scalar([], type=items.type), items)
+
+    return Series(items.to_pylist(), index=values.index, dtype=object)
+
+
+def hash_dataframe_rows(df: DataFrame) -> Series:
+    """
+    Compute a stable 64-bit hash of every row of a DataFrame in one vectorized pass.
+
+    Cells of object columns, including lists and dictionaries, are hashed through their
+    string representation, and columns are hashed in name order, so the same row always
+    gets the same hash across runs.
+
+    Args:
+        df (DataFrame): The DataFrame to hash.
+
+    Returns:
+        Series: The uint64 hashes, indexed like `df`.
+    """
+    keys = df[sorted(df.columns)]
+    object_columns = keys.select_dtypes(include=["object"]).columns
+    if len(object_columns):
+        keys = keys.astype({col: str for col in object_columns})
+
+    return pd.util.hash_pandas_object(keys, index=False)
+
+
+def add_row_hash(df: DataFrame, hash_col: str = "row_hash") -> DataFrame:
+    # only rows without a hash yet are hashed
+    df = df.copy()
+    if hash_col not in df.columns:
+        df[hash_col] = hash_dataframe_rows(df)
+    elif (missing := df[hash_col].isna()).any():
+        df[hash_col] = df[hash_col].astype("UInt64")
+        df.loc[missing, hash_col] = hash_dataframe_rows(
+            df.loc[missing].drop(columns=hash_col)
         )
 
-    return df_copy
+    df[hash_col] = df[hash_col].astype("uint64")
+    return df
+
+
+def drop_dataframe_duplicates(
+    df: DataFrame, hash_col: Optional[str] = None
+) -> DataFrame:
+    """
+    Drop duplicated rows, list columns included, keeping the first occurrence.
+
+    Args:
+        df (DataFrame): The DataFrame to deduplicate.
+        hash_col (Optional[str]): A column persisting the row hashes. If given, only the
+            rows without a hash are hashed and the column is kept in the result.
+
+    Returns:
+        DataFrame: The deduplicated DataFrame.
+    """
+    if hash_col is None:
+        return df[~hash_dataframe_rows(df).duplicated()]
+
+    df = add_row_hash(df, hash_col)
+    return df[~df[hash_col].duplicated()]
 
 
 def update_env_variable(provider: Literal["groq", "google"] = "groq"):
@@ -0,0 +1,101 @@
+from datetime import date
+
+import pandas as pd
+from pandas import DataFrame
+
+from aggregates import MessageAggregates
+from table_store import PartitionedTable
+
+
+def make_df(texts, times) -> DataFrame:
+    return DataFrame(
+        {
+            "message": texts,
+            "inserted_at": pd.to_datetime(times),
+            "page_id": "p1",
+            "user": [["a"]] * len(texts),
+            "purpose": [["b"]] * len(texts),
+        }
+    )
+
+
+def message_counts(aggregates: MessageAggregates) -> dict:
+    series = aggregates.query_rollup()
+    return {f"{bucket:%Y-%m-%d}": count for bucket, count in series["count"].items()}
+
+
+def test_add_counts_rows_per_day(tmp_path):
+    with MessageAggregates(str(tmp_path / "aggregates.db")) as aggregates:
+        aggregates.add(
+            make_df(
+                ["a", "b", "c"],
+                ["2024-12-01 10:00", "2024-12-01 11:00", "2024-12-02 10:00"],
+            )
+        )
+
+        assert message_counts(aggregates) == {"2024-12-01": 2, "2024-12-02": 1}
+        assert aggregates.counts("user").values.tolist() == [["a", 3]]
+        assert len(aggregates.counted_rows()) == 3
+
+
+def test_reconcile_counts_rows_appended_by_an_interrupted_run(tmp_path):
+    table = PartitionedTable(str(tmp_path / "table"))
+    with MessageAggregates(str(tmp_path / "aggregates.db")) as aggregates:
+        aggregates.add(table.append(make_df(["a"], ["2024-12-01 10:00"])))
+
+        # the run stopped before counting its rows
+        table.append(make_df(["b", "c"], ["2024-12-01 11:00", "2024-12-02 10:00"]))
+        aggregates.reconcile(table)
+        aggregates.reconcile(table)
+
+        assert message_counts(aggregates) == {"2024-12-01": 2, "2024-12-02": 1}
+
+
+def test_reconcile_drops_the_days_removed_from_the_table(tmp_path):
+    table = PartitionedTable(str(tmp_path / "table"))
+    with MessageAggregates(str(tmp_path / "aggregates.db")) as aggregates:
+        aggregates.add(
+            table.append(make_df(["a", "b"], ["2024-12-01 10:00", "2024-12-09 10:00"]))
+        )
+
+        # the run stopped before removing the day from the counts
+        table.drop_before(date(2024, 12, 2))
+        aggregates.reconcile(table)
+
+        assert message_counts(aggregates) == {"2024-12-09": 1}
+        # weekly counts are kept as history
+        assert aggregates.query_rollup(grain="week")["count"].tolist() == [1, 1]
+
+
+def test_reconcile_rebuilds_counts_of_missing_rows(tmp_path):
+    table = PartitionedTable(str(tmp_path / "table"))
+    with MessageAggregates(str(tmp_path / "aggregates.db")) as aggregates:
+        table.append(make_df(["a"], ["2024-12-01 10:00"]))
+        aggregates.add(make_df(["a", "x"], ["2024-12-01 10:00", "2024-12-01 11:00"]))
+
+        aggregates.reconcile(table)
+
+        assert message_counts(aggregates) == {"2024-12-01": 1}
+
+
+def test_reconcile_skips_matching_row_counts(tmp_path, monkeypatch):
+    table = PartitionedTable(str(tmp_path / "table"))
+    with MessageAggregates(str(tmp_path / "aggregates.db")) as aggregates:
+        aggregates.add(table.append(make_df(["a"], ["2024-12-01 10:00"])))
+
+        def fail(*args, **kwargs):
+            raise AssertionError("row hashes were read")
+
+        monkeypatch.setattr(table, "row_hashes", fail)
+        aggregates.reconcile(table)
+
+        assert aggregates.num_counted() == 1
+
+
+def test_rebuild_from_an_empty_table(tmp_path):
+    table = PartitionedTable(str(tmp_path / "table"))
+    with MessageAggregates(str(tmp_path / "aggregates.db")) as aggregates:
+        aggregates.rebuild(table.load(), row_hashes=table.row_hashes())
+
+        assert aggregates.initialized
+        assert aggregates.num_counted() == 0
@@ -0,0 +1,128 @@
+import json
+import os
+
+import pytest
+from langchain_core.prompts import ChatPromptTemplate
+
+from llm_cache import LLMResponseCache, MessageResultMemo, prompt_hash
+from utils import PROJECT_DIRECTORY
+
+# the pipeline reads the deployment config when it is imported
+if not os.path.exists(os.path.join(PROJECT_DIRECTORY, "config.yaml")):
+    pytest.skip("config.yaml is required by data_analysing", allow_module_level=True)
+
+import data_analysing
+from data_analysing import (
+    _echoes_batch,
+    _lookup_memo,
+    _merge_memo,
+    call_llm,
+    call_llm_with_memo,
+)
+
+PROMPT = ChatPromptTemplate.from_messages([("human", "{input}")])
+
+
+class FakeCaller:
+    """
+    Answers every message with an item repeating it, except the messages of `garbled`.
+    """
+
+    def __init__(self, garbled=()):
+        self.garbled = set(garbled)
+        self.batches = []
+
+    def invoke(self, inputs: dict) -> str:
+        batch = eval(inputs["input"])
+        self.batches.append(batch)
+        return json.dumps(
+            {
+                "items": [
+                    {"message": m.upper() if m in self.garbled else m, "score": 1}
+                    for m in batch
+                ]
+            }
+        )
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = LLMResponseCache(str(tmp_path / "cache.db"))
+    monkeypatch.setattr(data_analysing, "get_llm_cache", lambda: cache)
+    return cache
+
+
+def test_echoes_batch():
+    batch = ["hello", "price?"]
+
+    assert _echoes_batch([{"message": "hello"}, {"message": "price?"}], batch)
+    assert _echoes_batch([True, 0.5], batch)
+    assert not _echoes_batch([{"message": "hello"}, {"message": "PRICE?"}], batch)
+    assert not _echoes_batch([{"message": "hello"}, {"score": 1}], batch)
+
+
+def test_only_responses_echoing_their_messages_are_cached(cache, monkeypatch):
+    messages = ["hello", "price?", "ship to Hanoi?", "thanks"]
+    caller = FakeCaller(garbled=["ship to Hanoi?"])
+    monkeypatch.setattr(data_analysing, "get_llm_caller", lambda *args: caller)
+
+    call_llm(messages, PROMPT, batch_size=2)
+    assert len(cache) == 1
+
+    # the batch of the garbled response is sent again, the other one is cached
+    caller.batches.clear()
+    call_llm(messages, PROMPT, batch_size=2)
+    assert caller.batches == [["ship to Hanoi?", "thanks"]]
+    assert cache.stats()["hits"] == 1
+
+
+@pytest.fixture
+def memo(tmp_path, monkeypatch):
+    memo = MessageResultMemo(str(tmp_path / "memo.db"))
+    monkeypatch.setattr(data_analysing, "get_message_memo", lambda: memo)
+    return memo
+
+
+def test_merge_memo_remembers_only_echoing_results(memo):
+    messages = ["Hello", "price?", "hello ", "ship to Hanoi?", "thanks"]
+    memo.set_many("purpose", prompt_hash(PROMPT), {"thanks": {"purpose": "thanks"}})
+
+    keys, known, unseen = _lookup_memo(messages, PROMPT, "purpose", None)
+    assert list(unseen.values()) == ["Hello", "price?", "ship to Hanoi?"]
+
+    output = [
+        {"message": "Hello", "purpose": "greeting"},
+        {"message": "price?", "purpose": "price"},
+        {"message": "SHIP TO HANOI?", "purpose": "shipping"},
+    ]
+    result = _merge_memo(messages, PROMPT, "purpose", keys, known, unseen, output)
+
+    # known and new results carry their own message, failed ones are returned as given
+    assert result == [
+        {"message": "Hello", "purpose": "greeting"},
+        {"message": "price?", "purpose": "price"},
+        {"message": "hello ", "purpose": "greeting"},
+        {"message": "SHIP TO HANOI?", "purpose": "shipping"},
+        {"message": "thanks", "purpose": "thanks"},
+    ]
+    assert memo.get_many("purpose", prompt_hash(PROMPT), keys) == {
+        "hello": {"purpose": "greeting"},
+        "price?": {"purpose": "price"},
+        "thanks": {"purpose": "thanks"},
+    }
+
+
+def test_call_llm_with_memo_sends_unknown_messages_once(cache, memo, monkeypatch):
+    caller = FakeCaller(garbled=["ship to Hanoi?"])
+    monkeypatch.setattr(data_analysing, "get_llm_caller", lambda *args: caller)
+    messages = ["hello", "Hello", "ship to Hanoi?", "price?"]
+
+    first = call_llm_with_memo(messages, PROMPT, "score", batch_size=10)
+    assert caller.batches == [["hello", "ship to Hanoi?", "price?"]]
+    assert first[1] == {"message": "Hello", "score": 1}
+
+    # the failed message is not remembered, so it is sent again
+    caller.batches.clear()
+    second = call_llm_with_memo(messages, PROMPT, "score", batch_size=10)
+    assert caller.batches == [["ship to Hanoi?"]]
+    assert second == first
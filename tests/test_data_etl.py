@@ -0,0 +1,123 @@
+import asyncio
+import os
+
+import pytest
+
+from utils import PROJECT_DIRECTORY, string_to_unix_second
+
+# the pipeline reads the deployment config when it is imported
+if not os.path.exists(os.path.join(PROJECT_DIRECTORY, "config.yaml")):
+    pytest.skip("config.yaml is required by data_etl", allow_module_level=True)
+
+import pancake
+from data_etl import (
+    async_update_messages,
+    plan_conversation_updates,
+    update_messages,
+)
+from pancake import AsyncPancakeClient
+from pancake_stub import PancakeStubServer, generate_fixture
+
+
+@pytest.fixture
+def stub_server(monkeypatch):
+    fixture = generate_fixture(
+        num_pages=1, conversations_per_page=2, messages_per_conversation=25, seed=1
+    )
+    server = PancakeStubServer(fixture, message_page_size=10)
+    monkeypatch.setenv("PANCAKE_BASE_URL", server.start())
+    monkeypatch.setenv("PANCAKE_PAGE_RATE", "1000")
+    monkeypatch.setenv("PANCAKE_GLOBAL_RATE", "1000")
+    monkeypatch.setattr(pancake, "_rate_limiter", None)
+    yield server
+    server.stop()
+
+
+def test_crawl_modes_return_chronological_messages(stub_server):
+    fixture = stub_server.fixture
+    conversations = [
+        ("page_0", "token_page_0", c["id"], c["customer_id"], 0)
+        for c in fixture["conversations"]["page_0"]
+    ]
+    until = max(
+        string_to_unix_second(c["updated_at"])
+        for c in fixture["conversations"]["page_0"]
+    )
+
+    async def async_crawl(conversation: tuple) -> list:
+        async with AsyncPancakeClient() as client:
+            return await async_update_messages(client, [conversation], until)
+
+    for conversation in conversations:
+        messages = update_messages([conversation], until)
+        async_messages = asyncio.run(async_crawl(conversation))
+
+        # every page of the conversation is crawled, oldest message first
+        expected = [
+            m["inserted_at"]
+            for m in fixture["messages"][conversation[2]]
+            if m["original_message"]
+        ]
+        assert [m["inserted_at"] for m in messages] == expected
+        assert async_messages == messages
+
+
+def test_plan_conversation_updates_crawls_new_and_changed_conversations():
+    page_schema = {
+        "page_0": {
+            "page_access_token": "token_page_0",
+            "last_check": 1000,
+            "conversations": {
+                "changed": {
+                    "customer_id": "customer_1",
+                    "last_updated": "2024-12-01T10:00:00",
+                },
+                "unchanged": {
+                    "customer_id": "customer_2",
+                    "last_updated": "2024-12-01T11:00:00",
+                },
+            },
+        }
+    }
+    conversations = {
+        "page_0": [
+            {"id": "new", "customer_id": "customer_0", "updated_at": "2024-12-02"},
+            {
+                "id": "changed",
+                "customer_id": "customer_1",
+                "updated_at": "2024-12-02T09:00:00",
+            },
+            {
+                "id": "unchanged",
+                "customer_id": "customer_2",
+                "updated_at": "2024-12-01T11:00:00",
+            },
+        ]
+    }
+
+    updates = plan_conversation_updates(page_schema, conversations, new_check=2000)
+
+    # a new conversation is crawled since the last check of its page, a changed one
+    # since its last update
+    assert updates == [
+        ("page_0", "token_page_0", "new", "customer_0", 1000),
+        (
+            "page_0",
+            "token_page_0",
+            "changed",
+            "customer_1",
+            string_to_unix_second("2024-12-01T10:00:00"),
+        ),
+    ]
+    assert page_schema["page_0"]["last_check"] == 2000
+    assert page_schema["page_0"]["conversations"] == {
+        "new": {"customer_id": "customer_0", "last_updated": "2024-12-02"},
+        "changed": {"customer_id": "customer_1", "last_updated": "2024-12-02T09:00:00"},
+        "unchanged": {
+            "customer_id": "customer_2",
+            "last_updated": "2024-12-01T11:00:00",
+        },
+    }
+
+    # nothing changed since the last plan
+    assert plan_conversation_updates(page_schema, conversations, new_check=3000) == []
@@ -0,0 +1,117 @@
+import pytest
+from pandas import DataFrame
+
+import data_presentation
+from data_presentation import NoopSpreadsheet, SheetPublisher
+
+
+class RecordingSpreadsheet(NoopSpreadsheet):
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+        self.data = []
+
+    def batch_update(self, body: dict) -> None:
+        super().batch_update(body)
+        self.requests.append(body["requests"])
+
+    def values_batch_update(self, body: dict) -> None:
+        self.data.append(body["data"])
+
+
+@pytest.fixture
+def spreadsheet(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        data_presentation, "SHEET_STATE_DIRECTORY", str(tmp_path / "state")
+    )
+    monkeypatch.setattr(
+        data_presentation, "SHEET_SNAPSHOT_DIRECTORY", str(tmp_path / "snapshots")
+    )
+    return RecordingSpreadsheet()
+
+
+def make_df(texts) -> DataFrame:
+    return DataFrame({"message": texts, "user": [["a", "b"]] * len(texts)})
+
+
+def publish(spreadsheet, df, sheet_name="Sheet"):
+    spreadsheet.requests, spreadsheet.data = [], []
+    publisher = SheetPublisher(spreadsheet)
+    publisher.sync(df, sheet_name)
+    assert publisher.publish()
+    return sum(spreadsheet.requests, []), sum(spreadsheet.data, [])
+
+
+def test_publish_adds_a_new_sheet(spreadsheet):
+    requests, data = publish(spreadsheet, make_df(["a", "b"]))
+
+    assert requests == [
+        {
+            "addSheet": {
+                "properties": {
+                    "sheetId": 1,
+                    "title": "Sheet",
+                    "gridProperties": {"rowCount": 1000, "columnCount": 100},
+                }
+            }
+        }
+    ]
+    assert data == [
+        {
+            "range": "'Sheet'!A1",
+            "values": [["message", "user"], ["a", "a,b"], ["b", "a,b"]],
+        }
+    ]
+
+
+def test_publish_inserts_and_deletes_rows_of_a_sheet(spreadsheet):
+    publish(spreadsheet, make_df(["a", "b", "c", "d"]))
+
+    # "x" is inserted at the top and "c" is deleted
+    requests, data = publish(spreadsheet, make_df(["x", "a", "b", "d"]))
+
+    assert requests == [
+        {
+            "deleteDimension": {
+                "range": {
+                    "sheetId": 1,
+                    "dimension": "ROWS",
+                    "startIndex": 3,
+                    "endIndex": 4,
+                }
+            }
+        },
+        {
+            "insertDimension": {
+                "range": {
+                    "sheetId": 1,
+                    "dimension": "ROWS",
+                    "startIndex": 1,
+                    "endIndex": 2,
+                },
+                "inheritFromBefore": False,
+            }
+        },
+    ]
+    assert data == [{"range": "'Sheet'!A2", "values": [["x", "a,b"]]}]
+
+
+def test_publish_rewrites_changed_rows_in_place(spreadsheet):
+    publish(spreadsheet, make_df(["a", "b", "c"]))
+
+    requests, data = publish(spreadsheet, make_df(["a", "y", "c"]))
+
+    assert requests == []
+    assert data == [{"range": "'Sheet'!A3", "values": [["y", "a,b"]]}]
+
+
+def test_publish_deletes_the_sheets_not_kept(spreadsheet):
+    publish(spreadsheet, make_df(["a"]), "Kept")
+    publish(spreadsheet, make_df(["b"]), "Dropped")
+
+    publisher = SheetPublisher(spreadsheet)
+    publisher.keep_only(["Kept"])
+    assert publisher.publish()
+
+    assert spreadsheet.requests[-1] == [{"deleteSheet": {"sheetId": 2}}]
+    assert [worksheet.title for worksheet in spreadsheet.worksheets()] == ["Kept"]
@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+
+import pytest
+
+import llm_cache
+from llm_cache import LLMResponseCache, MessageResultMemo
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_cache, "time", SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def test_entries_expire_after_the_ttl(tmp_path, clock):
+    cache = LLMResponseCache(str(tmp_path / "cache.db"), ttl=60)
+    cache.set("key", "response")
+
+    clock[0] += 59
+    assert cache.get("key") == "response"
+
+    # an expired entry is a miss, even if it was read recently
+    clock[0] += 2
+    assert cache.get("key") is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = LLMResponseCache(str(tmp_path / "cache.db"), ttl=10**6, max_entries=60)
+    for i in range(50):
+        clock[0] += 1
+        cache.set(f"key {i}", f"response {i}")
+
+    # reading the oldest entries makes them the most recently used
+    for i in range(10):
+        clock[0] += 1
+        cache.get(f"key {i}")
+
+    # entries are evicted every 100 writes
+    for i in range(50, 100):
+        clock[0] += 1
+        cache.set(f"key {i}", f"response {i}")
+
+    assert len(cache) == 60
+    assert all(cache.get(f"key {i}") == f"response {i}" for i in range(10))
+    assert all(cache.get(f"key {i}") is None for i in range(10, 50))
+    assert all(cache.get(f"key {i}") == f"response {i}" for i in range(50, 100))
+
+
+def test_stats_count_hits_and_misses(tmp_path, clock):
+    cache = LLMResponseCache(str(tmp_path / "cache.db"))
+    assert cache.stats() == {"hits": 0, "misses": 0, "hit_rate": 0.0}
+
+    cache.get("key")
+    cache.set("key", "response")
+    cache.get("key")
+    cache.get("key")
+    cache.get("other key")
+
+    assert cache.stats() == {"hits": 2, "misses": 2, "hit_rate": 0.5}
+
+
+def test_entries_persist_across_connections(tmp_path, clock):
+    path = str(tmp_path / "cache.db")
+    cache = LLMResponseCache(path)
+    cache.set("key", "response")
+    cache.close()
+
+    assert LLMResponseCache(path).get("key") == "response"
+
+
+def test_memo_results_are_kept_per_stage_and_prompt(tmp_path, clock):
+    memo = MessageResultMemo(str(tmp_path / "cache.db"), ttl=60)
+    memo.set_many("purpose", "prompt", {"hello": {"purpose": "greeting"}})
+    memo.set_many("purpose", "other prompt", {"hello": {"purpose": "other"}})
+    memo.set_many("inquiry", "prompt", {"hello": {"is_inquiry": False}})
+
+    assert memo.get_many("purpose", "prompt", ["hello", "hello", "price?"]) == {
+        "hello": {"purpose": "greeting"}
+    }
+    assert memo.get_many("inquiry", "prompt", ["hello"]) == {
+        "hello": {"is_inquiry": False}
+    }
+    assert memo.get_many("score", "prompt", ["hello"]) == {}
+
+
+def test_memo_results_expire_and_are_replaced(tmp_path, clock):
+    memo = MessageResultMemo(str(tmp_path / "cache.db"), ttl=60)
+    memo.set_many("purpose", "prompt", {"hello": {"purpose": "greeting"}})
+
+    clock[0] += 30
+    memo.set_many("purpose", "prompt", {"price?": {"purpose": "price"}})
+    memo.set_many("purpose", "prompt", {"price?": {"purpose": "pricing"}})
+
+    clock[0] += 31
+    assert memo.get_many("purpose", "prompt", ["hello", "price?"]) == {
+        "price?": {"purpose": "pricing"}
+    }
@@ -0,0 +1,76 @@
+import json
+import os
+
+from message_queue import MessageQueue, open_message_queue
+from utils import string_to_unix_second
+
+
+def make_message(text: str, inserted_at: str, **kwargs) -> dict:
+    return {"message": text, "inserted_at": inserted_at, "from": "customer", **kwargs}
+
+
+def test_enqueue_skips_queued_messages(tmp_path):
+    with MessageQueue(str(tmp_path / "queue.db")) as queue:
+        messages = [
+            make_message("a", "2024-12-01T10:00:00"),
+            make_message("b", "2024-12-01T11:00:00"),
+        ]
+        assert queue.enqueue(messages) == 2
+        assert queue.enqueue(messages + [make_message("c", "2024-12-01T12:00:00")]) == 1
+        assert len(queue) == 3
+
+
+def test_dequeue_returns_newest_messages_oldest_first(tmp_path):
+    with MessageQueue(str(tmp_path / "queue.db")) as queue:
+        queue.enqueue(
+            [
+                make_message("b", "2024-12-01T11:00:00"),
+                make_message("a", "2024-12-01T10:00:00"),
+                make_message("c", "2024-12-01T12:00:00"),
+            ]
+        )
+
+        assert [m["message"] for m in queue.dequeue(2)] == ["b", "c"]
+        assert [m["message"] for m in queue.dequeue(2)] == ["a"]
+        assert queue.dequeue(2) == []
+
+
+def test_mark_seen_returns_unseen_messages_in_order(tmp_path):
+    with MessageQueue(str(tmp_path / "queue.db")) as queue:
+        a = make_message("a", "2024-12-01T10:00:00")
+        b = make_message("b", "2024-12-01T11:00:00")
+        c = make_message("c", "2024-12-01T12:00:00")
+
+        assert queue.mark_seen([b, a]) == [b, a]
+        assert queue.mark_seen([a, c, b, c]) == [c]
+
+
+def test_delete_before_prunes_queue_and_seen(tmp_path):
+    with MessageQueue(str(tmp_path / "queue.db")) as queue:
+        old = make_message("old", "2024-11-01T10:00:00")
+        new = make_message("new", "2024-12-01T10:00:00")
+        queue.enqueue([old, new])
+        queue.mark_seen([old, new])
+
+        assert queue.delete_before(string_to_unix_second("2024-11-15T00:00:00")) == 1
+        assert [m["message"] for m in queue.dequeue(10)] == ["new"]
+
+        # a pruned message is unseen again
+        assert queue.mark_seen([old, new]) == [old]
+
+
+def test_open_message_queue_migrates_legacy_json(tmp_path):
+    legacy_path = tmp_path / "queue.json"
+    legacy_path.write_text(
+        json.dumps([make_message("a", "2024-12-01T10:00:00")]), encoding="utf-8"
+    )
+    config = {"queue-message": str(legacy_path)}
+
+    with open_message_queue(config) as queue:
+        assert len(queue) == 1
+    assert not legacy_path.exists()
+    assert os.path.exists(str(legacy_path) + ".migrated")
+
+    # the legacy queue is imported once
+    with open_message_queue(config) as queue:
+        assert len(queue) == 1
@@ -0,0 +1,145 @@
+import asyncio
+import random
+import time
+from collections import deque
+from threading import Thread
+
+import pytest
+
+from rate_limiter import RateLimiter, get_rate_limiter
+
+
+class RecordingRateLimiter(RateLimiter):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.log = []
+
+    def _admit(self, num_requests: int, num_tokens: int, now: float) -> None:
+        super()._admit(num_requests, num_tokens, now)
+        self.log.append((now, num_requests, num_tokens))
+
+
+def start_thread(target, *args) -> Thread:
+    thread = Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_concurrent_callers_stay_within_the_limits():
+    # threads and asyncio tasks share one limiter, and one caller pauses it midway
+    num_threads, num_tasks, requests_per_caller = 24, 8, 5
+    max_requests, max_tokens, window, timeout = 40, 4000, 0.5, 30.0
+    limiter = RecordingRateLimiter(max_requests, max_tokens, window=window)
+
+    def caller(seed: int) -> None:
+        rng = random.Random(seed)
+        for i in range(requests_per_caller):
+            if seed == 0 and i == requests_per_caller // 2:
+                limiter.pause(window / 2)
+            limiter.acquire(num_tokens=rng.randint(1, max_tokens // 20))
+
+    async def async_callers() -> None:
+        async def task(seed: int) -> None:
+            rng = random.Random(seed)
+            for _ in range(requests_per_caller):
+                await limiter.async_acquire(num_tokens=rng.randint(1, max_tokens // 20))
+
+        await asyncio.gather(*[task(num_threads + i) for i in range(num_tasks)])
+
+    start = time.monotonic()
+    threads = [start_thread(caller, i) for i in range(num_threads)]
+    threads.append(start_thread(asyncio.run, async_callers()))
+    for thread in threads:
+        thread.join(timeout=max(0.0, start + timeout - time.monotonic()))
+
+    assert not any(thread.is_alive() for thread in threads)
+    assert len(limiter.log) == (num_threads + num_tasks) * requests_per_caller
+
+    # the requests and tokens of every window ending at an admission
+    window_log = deque()
+    num_requests = num_tokens = 0
+    for admitted_at, requests, tokens in sorted(limiter.log):
+        window_log.append((admitted_at, requests, tokens))
+        num_requests += requests
+        num_tokens += tokens
+        while window_log[0][0] <= admitted_at - window:
+            _, old_requests, old_tokens = window_log.popleft()
+            num_requests -= old_requests
+            num_tokens -= old_tokens
+        assert num_requests <= max_requests
+        assert num_tokens <= max_tokens
+
+
+def test_callers_are_admitted_in_order():
+    limiter = RateLimiter(2, window=0.3)
+    limiter.acquire(2)
+    order = []
+
+    def caller(name: str, num_requests: int) -> None:
+        limiter.acquire(num_requests)
+        order.append(name)
+
+    # the large request takes its ticket first and is not overtaken by the small one
+    large = start_thread(caller, "large", 2)
+    time.sleep(0.05)
+    small = start_thread(caller, "small", 1)
+    large.join(timeout=5)
+    small.join(timeout=5)
+
+    assert order == ["large", "small"]
+
+
+def test_tokens_limit_the_window():
+    limiter = RateLimiter(100, max_tokens=10, window=0.3)
+    limiter.acquire(num_tokens=8)
+
+    start = time.monotonic()
+    limiter.acquire(num_tokens=5)
+
+    assert time.monotonic() - start >= 0.25
+
+
+def test_a_request_over_the_limits_is_admitted_alone():
+    limiter = RateLimiter(2, max_tokens=10, window=0.2)
+    limiter.acquire(num_tokens=5)
+
+    start = time.monotonic()
+    limiter.acquire(num_requests=3, num_tokens=50)
+
+    assert 0.15 <= time.monotonic() - start < 5
+
+
+def test_pause_delays_every_caller():
+    limiter = RateLimiter(100, window=1.0)
+    limiter.pause(0.2)
+
+    start = time.monotonic()
+    limiter.acquire()
+
+    assert time.monotonic() - start >= 0.15
+
+
+def test_an_abandoned_ticket_is_skipped():
+    limiter = RateLimiter(1, window=0.2)
+    limiter.acquire()
+
+    async def run() -> None:
+        head = asyncio.create_task(limiter.async_acquire())
+        abandoned = asyncio.create_task(limiter.async_acquire())
+        tail = asyncio.create_task(limiter.async_acquire())
+        await asyncio.sleep(0.05)
+
+        # the ticket is given up before its turn comes
+        abandoned.cancel()
+        await asyncio.wait_for(asyncio.gather(head, tail), timeout=5)
+
+    asyncio.run(run())
+
+
+def test_callers_of_an_api_key_share_one_limiter():
+    limiter = get_rate_limiter("test", "model", "key", 10, 100)
+
+    assert get_rate_limiter("test", "model", "key", 10, 100) is limiter
+    assert get_rate_limiter("test", "model", "other key", 10, 100) is not limiter
+    with pytest.raises(ValueError):
+        get_rate_limiter("test", "model", "key", 20, 100)
@@ -0,0 +1,110 @@
+from datetime import date
+
+import pandas as pd
+from pandas import DataFrame
+
+from table_store import NULL_PARTITION, PartitionedTable
+from utils import hash_dataframe_rows
+
+
+def make_df(texts, times) -> DataFrame:
+    return DataFrame(
+        {
+            "message": texts,
+            "inserted_at": pd.to_datetime(times),
+            "user": [["a", "b"]] * len(texts),
+        }
+    )
+
+
+def test_append_partitions_rows_by_day(tmp_path):
+    table = PartitionedTable(str(tmp_path / "table"))
+    df = make_df(
+        ["a", "b", "c"],
+        ["2024-12-01 10:00:00", "2024-12-02 09:00:00", "2024-12-01 23:00:00"],
+    )
+
+    appended = table.append(df)
+
+    assert len(appended) == 3
+    assert table.partitions() == ["2024-12-01", "2024-12-02"]
+    loaded = table.load()
+    assert sorted(loaded["message"]) == ["a", "b", "c"]
+    assert loaded["user"].tolist() == [["a", "b"]] * 3
+
+
+def test_append_skips_stored_and_duplicated_rows(tmp_path):
+    table = PartitionedTable(str(tmp_path / "table"))
+    df = make_df(["a", "b"], ["2024-12-01 10:00:00", "2024-12-02 09:00:00"])
+    table.append(df)
+
+    new_df = pd.concat(
+        [df, make_df(["c", "c"], ["2024-12-02 10:00:00"] * 2)], ignore_index=True
+    )
+    appended = table.append(new_df)
+
+    assert appended["message"].tolist() == ["c"]
+    assert len(table) == 3
+
+
+def test_rows_without_time_are_kept_apart(tmp_path):
+    table = PartitionedTable(str(tmp_path / "table"))
+    df = make_df(["a", "b"], ["2024-12-01 10:00:00", None])
+
+    table.append(df)
+
+    assert table.partitions() == ["2024-12-01", NULL_PARTITION]
+    assert len(table.load()) == 2
+    assert table.load(since="2024-01-01")["message"].tolist() == ["a"]
+    assert table.drop_before(date(2025, 1, 1)) == ["2024-12-01"]
+    assert table.load()["message"].tolist() == ["b"]
+
+
+def test_load_reads_partitions_in_range(tmp_path):
+    table = PartitionedTable(str(tmp_path / "table"))
+    table.append(
+        make_df(
+            ["a", "b", "c"],
+            ["2024-12-01 10:00:00", "2024-12-02 10:00:00", "2024-12-03 10:00:00"],
+        )
+    )
+
+    assert table.load(since="2024-12-02")["message"].tolist() == ["b", "c"]
+    assert table.load(until=date(2024, 12, 2))["message"].tolist() == ["a", "b"]
+    assert table.load(since="2024-12-02", until="2024-12-02")["message"].tolist() == [
+        "b"
+    ]
+
+
+def test_drop_before_removes_whole_days(tmp_path):
+    table = PartitionedTable(str(tmp_path / "table"))
+    table.append(make_df(["a", "b"], ["2024-12-01 23:59:59", "2024-12-02 00:00:00"]))
+
+    assert table.drop_before(date(2024, 12, 2)) == ["2024-12-01"]
+    assert table.load()["message"].tolist() == ["b"]
+
+
+def test_compaction_keeps_rows_and_hashes(tmp_path):
+    table = PartitionedTable(str(tmp_path / "table"), max_files_per_partition=2)
+    for i in range(4):
+        table.append(make_df([f"m{i}"], [f"2024-12-01 1{i}:00:00"]))
+
+    assert len(table._partition_files("2024-12-01")) <= 2
+    assert len(table) == 4
+
+    df = make_df(["m0"], ["2024-12-01 10:00:00"])
+    assert table.append(df).empty
+    assert hash_dataframe_rows(df).isin(table.row_hashes()).all()
+
+
+def test_append_reads_only_the_stored_hashes(tmp_path, monkeypatch):
+    table = PartitionedTable(str(tmp_path / "table"))
+    table.append(make_df(["a"], ["2024-12-01 10:00:00"]))
+
+    def fail(paths):
+        raise AssertionError("partition rows were read")
+
+    monkeypatch.setattr(table, "_read_files", fail)
+    appended = table.append(make_df(["a", "b"], ["2024-12-01 10:00:00"] * 2))
+
+    assert appended["message"].tolist() == ["b"]
@@ -0,0 +1,262 @@
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import pandas as pd
+import pytest
+import pytz
+
+from utils import (
+    BatchPlanner,
+    PatternMatcher,
+    message_hash,
+    parse_list_column,
+    plan_batches,
+    string_to_unix_second,
+    strings_to_unix_seconds,
+)
+
+
+def legacy_string_to_unix_second(
+    s: str, format: str = "%Y-%m-%dT%H:%M:%S", tz: str = "UTC"
+) -> int:
+    # the strptime parsing the fast path replaced
+    added_second = 0
+    try:
+        rounded_s = s.split(".")[0]
+        added_second = 1 if int(s.split(".")[1]) >= 0.5 else 0
+    except Exception:
+        rounded_s = s
+
+    dt = pytz.timezone(tz).localize(datetime.strptime(rounded_s, format))
+    return int(dt.timestamp()) + added_second
+
+
+TIMESTAMPS = [
+    "2024-12-01T10:00:00",
+    "2024-12-01T10:00:00.000",
+    "2024-12-01T10:00:00.000001",
+    "2024-12-01T10:00:00.5",
+    "2024-12-31T23:59:59.999999",
+    "2024-02-29T00:00:00.123456",
+]
+
+
+def test_message_hash_prefers_the_pancake_id():
+    message = {"id": "m1", "page_id": "p1", "message": "Xin chào"}
+
+    assert message_hash(message) == message_hash({**message, "message": "Chào"})
+    assert message_hash(message) != message_hash({**message, "page_id": "p2"})
+
+
+def test_message_hash_tells_senders_and_conversations_apart():
+    message = {
+        "page_id": "p1",
+        "conversation_id": "c1",
+        "from": "customer-1",
+        "inserted_at": "2024-12-01T10:00:00",
+        "message": "Xin chào",
+    }
+
+    assert message_hash(message) == message_hash(dict(message))
+    assert message_hash(message) != message_hash({**message, "from": "customer-2"})
+    assert message_hash(message) != message_hash({**message, "conversation_id": "c2"})
+
+
+def test_parse_list_column_splits_stringified_lists():
+    values = pd.Series(["['a', 'b']", "['x']", "[ 'a' ,'b c' ]"], index=[3, 5, 7])
+
+    parsed = parse_list_column(values)
+
+    assert parsed.tolist() == [["a", "b"], ["x"], ["a", "b c"]]
+    assert parsed.index.tolist() == [3, 5, 7]
+
+
+def test_parse_list_column_matches_the_row_by_row_parsing():
+    def process_list(item):
+        if pd.isna(item):
+            return []
+        return [x.strip().strip("'") for x in item.strip("[]").split(",")]
+
+    values = pd.Series(["['a', 'b']", "[]", None, "a,b", "['Khách hàng', 'Admin']"])
+
+    assert parse_list_column(values).tolist() == values.apply(process_list).tolist()
+
+
+def test_plan_batches_limits_the_number_of_messages():
+    assert plan_batches(["a"] * 5, max_batch_size=2) == [(0, 2), (2, 4), (4, 5)]
+    assert plan_batches([]) == []
+
+
+def test_plan_batches_fits_the_token_budget():
+    # every message is estimated at 10 tokens, and 12 with its quotes
+    messages = ["x" * 30] * 6
+
+    assert plan_batches(messages, prompt_tokens=100, max_input_tokens=136) == [
+        (0, 3),
+        (3, 6),
+    ]
+    assert plan_batches(
+        messages, max_output_tokens=50, output_tokens_per_message=13
+    ) == [(0, 2), (2, 4), (4, 6)]
+
+
+def test_plan_batches_sends_a_message_over_budget_alone():
+    messages = ["a", "x" * 300, "b"]
+
+    assert plan_batches(messages, max_input_tokens=50) == [(0, 1), (1, 2), (2, 3)]
+
+
+def run_planner(planner: BatchPlanner, failing) -> list:
+    # send every planned batch, `failing` tells which batches fail
+    sent = []
+    while planner:
+        batch = planner.next()
+        sent.append(batch)
+        if failing(*batch):
+            planner.fail(*batch)
+    return sent
+
+
+def test_batch_planner_plans_like_plan_batches():
+    messages = ["x" * 30] * 7
+    planner = BatchPlanner(messages, max_input_tokens=36, max_batch_size=50)
+
+    batches = [(i, end_idx) for i, end_idx, _ in run_planner(planner, lambda *_: False)]
+
+    assert batches == plan_batches(messages, max_input_tokens=36, max_batch_size=50)
+
+
+def test_batch_planner_splits_once_then_retries_messages_once():
+    planner = BatchPlanner(["a"] * 8, max_batch_size=8)
+
+    sent = run_planner(planner, lambda i, end_idx, level: True)
+
+    assert sent == [
+        (0, 8, BatchPlanner.PLANNED),
+        (0, 4, BatchPlanner.HALF),
+        (4, 8, BatchPlanner.HALF),
+    ] + [(k, k + 1, BatchPlanner.SINGLE) for k in range(8)]
+
+
+def test_batch_planner_shrinks_the_batches_after_a_failure():
+    planner = BatchPlanner(["a"] * 20, max_batch_size=8)
+
+    sent = run_planner(planner, lambda i, end_idx, level: end_idx - i > 4)
+    planned = [(i, end_idx) for i, end_idx, level in sent if level == 0]
+
+    assert planned == [(0, 8), (8, 12), (12, 16), (16, 20)]
+    assert planner.budget["max_batch_size"] == 4
+
+
+@pytest.mark.parametrize("tz", ["UTC", "Asia/Bangkok", "America/New_York"])
+def test_string_to_unix_second_matches_strptime(tz):
+    for s in TIMESTAMPS:
+        assert string_to_unix_second(s, tz=tz) == legacy_string_to_unix_second(s, tz=tz)
+
+
+def test_string_to_unix_second_keeps_other_formats():
+    s = "01/12/2024 10:00:00"
+    format = "%d/%m/%Y %H:%M:%S"
+
+    assert string_to_unix_second(s, format) == legacy_string_to_unix_second(s, format)
+
+
+def test_string_to_unix_second_applies_offsets():
+    expected = datetime(2024, 12, 1, 3, tzinfo=timezone.utc).timestamp()
+
+    assert string_to_unix_second("2024-12-01T10:00:00+07:00") == expected
+    assert string_to_unix_second("2024-12-01T10:00:00.25+07:00") == expected + 1
+    assert string_to_unix_second("2024-12-01T03:00:00Z") == expected
+
+
+@pytest.mark.parametrize("tz", ["UTC", "Asia/Bangkok"])
+def test_strings_to_unix_seconds_matches_the_scalar_path(tz):
+    values = TIMESTAMPS + ["2024-12-01T10:00:00+07:00", "2024-12-01T10:00:00.1-05:00"]
+    expected = [string_to_unix_second(s, tz=tz) for s in values]
+
+    assert strings_to_unix_seconds(values, tz=tz) == expected
+    assert strings_to_unix_seconds([], tz=tz) == []
+
+    series = pd.Series(values, index=range(10, 10 + len(values)))
+    seconds = strings_to_unix_seconds(series, tz=tz)
+    assert seconds.tolist() == expected
+    assert seconds.index.tolist() == series.index.tolist()
+
+
+def legacy_keyword_match(patterns: list, text: str) -> bool:
+    # the single alternation the keyword filter used to build
+    return bool(re.search(r"\b(" + "|".join(patterns) + r")\b", text.lower()))
+
+
+def legacy_template_match(patterns: list, text: str) -> Optional[int]:
+    # the loop of searches the template matching used to run
+    for i, pattern in enumerate(patterns):
+        if re.compile(pattern, re.IGNORECASE).search(text.lower()):
+            return i
+    return None
+
+
+KEYWORDS = ["giá", "bao nhiêu", "ship", "còn hàng", r"size \d+"]
+TEMPLATES = [r"^xin chào", r"giá.*bao nhiêu", r"bao nhiêu", r"ship\w*", r"(?i:OK)$"]
+TEXTS = [
+    "Xin chào shop",
+    "Giá cái này bao nhiêu?",
+    "bao nhiêu tiền ship vậy",
+    "shipping mất mấy ngày",
+    "còn hàng size 40 không",
+    "sizes 40",
+    "ok",
+    "oke shop",
+    "",
+]
+
+
+def test_pattern_matcher_matches_like_the_keyword_alternation():
+    matcher = PatternMatcher(KEYWORDS, word_boundary=True)
+
+    for text in TEXTS:
+        assert matcher.matches(text) == legacy_keyword_match(KEYWORDS, text)
+
+
+def test_pattern_matcher_searches_like_the_template_loop():
+    matcher = PatternMatcher(TEMPLATES)
+
+    for text in TEXTS:
+        assert matcher.search(text) == legacy_template_match(TEMPLATES, text)
+
+
+@pytest.mark.parametrize(
+    "patterns, text, expected",
+    [
+        # list order wins over the position in the text
+        (["world", "hello"], "hello world", 0),
+        (["c", "a"], "abc", 0),
+        # and over the length of overlapping matches
+        (["ab", "abc"], "abc", 0),
+        (["abc", "ab"], "abc", 0),
+        (["x", "bc", "b"], "abc", 1),
+        (["x", "y"], "abc", None),
+        ([], "abc", None),
+    ],
+)
+def test_pattern_matcher_search_returns_the_first_pattern_of_the_list(
+    patterns, text, expected
+):
+    assert PatternMatcher(patterns).search(text) == expected
+
+
+@pytest.mark.parametrize(
+    "pattern", ["(?P<name>a)", r"(a)\1", "(?i)abc", "(?ms)^a.b", r"\\(?i)a"]
+)
+def test_pattern_matcher_rejects_patterns_it_cannot_combine(pattern):
+    with pytest.raises(ValueError):
+        PatternMatcher(["first", pattern])
+
+
+def test_pattern_matcher_accepts_scoped_flags_and_escaped_parentheses():
+    matcher = PatternMatcher([r"\(?i\)", "(?i:abc)", r"\\1"], ignore_case=False)
+
+    assert matcher.search("(?i)") == 0
+    assert matcher.search("xABC") == 1
+    assert matcher.search(r"\1") == 2